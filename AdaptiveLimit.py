@@ -0,0 +1,122 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Adaptive limits on the calls a process has in flight to Insightly and to the mail server.
+
+A fixed number of threads or workers is either too few while a service is fast or too many once it slows down,
+when more calls in flight only make every one of them slower until they time out. Instead, each service gets a
+limit which follows its latency (additive increase, multiplicative decrease): a call which comes back within the
+service's target latency while the limit was being reached raises the limit by 1/limit, about one more call per
+round of calls; a call slower than the target cuts it by adaptive_limit_backoff, at most once per target interval,
+so that the calls caught in one slow spell only count once. Calls beyond the limit wait for a turn, up to
+adaptive_limit_wait seconds, and then fail with Overloaded.
+
+The limits are for one process; under server.py --workers each worker has its own.
+"""
+
+import threading
+import time
+
+import config
+import Instrumentation
+
+# limit calls in flight to these services, aiming for this many seconds per call; {} for no limits
+adaptive_limit_targets = getattr(config, 'adaptive_limit_targets', {'insightly': 1.0, 'smtp': 1.0})
+# calls in flight to a service at first, and the least and most the limit may reach
+adaptive_limit_initial = getattr(config, 'adaptive_limit_initial', 8)
+adaptive_limit_min = getattr(config, 'adaptive_limit_min', 1)
+adaptive_limit_max = getattr(config, 'adaptive_limit_max', 64)
+# what a call slower than the target multiplies the limit by
+adaptive_limit_backoff = getattr(config, 'adaptive_limit_backoff', 0.8)
+# seconds a call waits for a turn before it fails
+adaptive_limit_wait = getattr(config, 'adaptive_limit_wait', 30)
+
+
+class Overloaded(Exception):
+    """
+    raised instead of making a call which waited adaptive_limit_wait seconds without getting a turn
+    """
+    pass
+
+
+class Adaptive_Limit:
+    """
+    Limit on calls in flight to one service, adjusted by the latency of the calls.
+    """
+
+    def __init__(self, service, target, initial=None, minimum=None, maximum=None, backoff=None, wait=None):
+        """
+        :param target: seconds per call to aim for
+        """
+        self.service = service
+        self.target = target
+        self.minimum = minimum or adaptive_limit_min
+        self.maximum = maximum or adaptive_limit_max
+        self.limit = float(min(self.maximum, max(self.minimum, initial or adaptive_limit_initial)))
+        self.backoff = backoff or adaptive_limit_backoff
+        self.wait = adaptive_limit_wait if wait is None else wait
+        self.in_flight = 0
+        # calls waiting for a turn
+        self.waiting = 0
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        wait for a turn to make a call
+        :raises Overloaded: if none came within self.wait seconds
+        """
+        start = time.time()
+        with self._condition:
+            while int(self.limit) <= self.in_flight:
+                remaining = start + self.wait - time.time()
+                if remaining <= 0:
+                    raise Overloaded('{n} calls to {service} in flight, waited {wait} s for another'.format(
+                        n=self.in_flight, service=self.service, wait=self.wait))
+                self.waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+        Instrumentation.histogram('limit_wait.' + self.service).add(time.time() - start)
+
+    def release(self, duration):
+        """
+        end a call, and adjust the limit by how long it took
+        :param duration: seconds
+        """
+        with self._condition:
+            # only a limit which is holding calls back has shown that it is too low
+            reached = 0 < self.waiting or int(self.limit) <= self.in_flight
+            self.in_flight -= 1
+            now = time.time()
+            if self.target < duration:
+                if self.target <= now - self._decreased:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._decreased = now
+            elif reached:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            free = int(self.limit) - self.in_flight
+            if 0 < free:
+                self._condition.notify(free)
+
+
+def install():
+    """
+    put this process's calls to the services in adaptive_limit_targets under adaptive limits
+    """
+    for (service, target) in adaptive_limit_targets.items():
+        if service not in Instrumentation.limiters:
+            Instrumentation.limiters[service] = Adaptive_Limit(service, target)
+
+
+def limits():
+    """
+    :return: dictionary of service -> calls it may have in flight now
+    """
+    return dict((service, int(limiter.limit)) for (service, limiter) in Instrumentation.limiters.items()
+                if isinstance(limiter, Adaptive_Limit))
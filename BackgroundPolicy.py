@@ -0,0 +1,146 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import re
+
+import config
+
+# longest BACKGROUND, in characters, that will be written to a contact
+background_max_length = getattr(config, 'background_max_length', 4000)
+
+_key_re = re.compile(r'^([A-Za-z0-9_\-]+): ')
+
+# the lines around the form entries in a BACKGROUND; everything outside them belongs to the people using Insightly
+form_fields_begin = u'--- form fields ---'
+form_fields_end = u'--- end of form fields ---'
+
+
+class Background_Policy:
+    """
+    Decide what goes into a contact's BACKGROUND when a form is submitted.
+
+    The form fields go in a block between the form_fields_begin and form_fields_end lines, one "key: value"
+    entry per field, with any further lines of a value indented by a space. Instead of appending every
+    submission, which makes the field (and every update that carries it) grow forever, the policy keeps only the
+    latest value of each key, leaves unchanged entries where they are and caps the total length, dropping the
+    entries updated longest ago first. Text outside the block, e.g. notes typed in by users, is kept as it is
+    unless the length cap leaves no choice. The complete submission is always in the note added by
+    Landing_Page._add_note.
+
+    A BACKGROUND without the block was written by earlier versions, which appended "key: value" lines with
+    values of several lines unindented. There, a line which does not start with "key: " continues the entry
+    above it, and only the text before the first entry is free text. The first merge moves the entries into the
+    block.
+    """
+
+    _max_length = None
+
+    def __init__(self, max_length=background_max_length):
+        self._max_length = max_length
+
+    def merge(self, background, values):
+        """
+        :param background: the contact's current BACKGROUND, or None
+        :param values: dictionary of form fields to record
+        :return: the new BACKGROUND, or None if there is nothing to record
+        """
+        (above, entries, below) = self.parse(background)
+        for key in sorted(values.keys()):
+            entry = (key, self.format(key, values[key]))
+            if entry in entries:
+                # unchanged: leave it where it is, so that a repeat submission leaves BACKGROUND as it was
+                latest = len(entries) - 1 - entries[::-1].index(entry)
+                entries = [e for (i, e) in enumerate(entries) if e[0] != key or i == latest]
+            else:
+                entries = [e for e in entries if e[0] != key]
+                entries.append(entry)
+
+        # drop duplicates, keeping the most recent copy
+        seen = set()
+        unique = []
+        for entry in reversed(entries):
+            if entry[1] not in seen:
+                seen.add(entry[1])
+                unique.insert(0, entry)
+        entries = unique
+
+        # drop the oldest form entries but the last, then the oldest free text, until it fits
+        while self._max_length < self._length(above, entries, below) and (1 < len(entries) or above or below):
+            if 1 < len(entries):
+                del entries[0]
+            elif above:
+                del above[0]
+            else:
+                del below[0]
+        excess = self._length(above, entries, below) - self._max_length
+        if 0 < excess and entries:
+            # a single value too long to fit is cut short, rather than lost
+            (key, text) = entries[0]
+            if len(key) + len(': ') < len(text) - excess:
+                entries[0] = (key, text[:len(text) - excess])
+            else:
+                entries = []
+
+        lines = list(above)
+        if entries:
+            lines += [form_fields_begin] + [entry[1] for entry in entries] + [form_fields_end]
+        lines += below
+        if 0 == len(lines):
+            return None
+        return u'\n'.join(lines)[:self._max_length]
+
+    @staticmethod
+    def format(key, value):
+        """
+        :return: the "key: value" entry for a form field, with the value's further lines indented
+        """
+        return u'%s: %s' % (key, u'\n '.join((u'%s' % value).splitlines()))
+
+    @staticmethod
+    def parse(background):
+        """
+        split a BACKGROUND into its form entries and the free text around them
+        :param background: string or None
+        :return: (lines of free text above the entries, list of (key, text) entries oldest first,
+                  lines of free text below the entries)
+        """
+        (above, entries, below) = ([], [], [])
+        if not background:
+            return (above, entries, below)
+        lines = background.split('\n')
+        if form_fields_begin not in lines:
+            # written by an earlier version: everything from the first entry on is form entries
+            for line in lines:
+                match = _key_re.match(line)
+                if match:
+                    entries.append((match.group(1), line))
+                elif entries:
+                    entries[-1] = (entries[-1][0], entries[-1][1] + '\n' + line)
+                else:
+                    above.append(line)
+            return (above, entries, below)
+
+        begin = lines.index(form_fields_begin)
+        above = lines[:begin]
+        in_block = True
+        for line in lines[begin + 1:]:
+            if form_fields_end == line:
+                in_block = False
+                continue
+            match = _key_re.match(line) if in_block else None
+            if match:
+                entries.append((match.group(1), line))
+            elif in_block and entries and line[:1] in (' ', '\t'):
+                entries[-1] = (entries[-1][0], entries[-1][1] + '\n' + line)
+            else:
+                # typed in after the entries, or in among them
+                below.append(line)
+        return (above, entries, below)
+
+    @staticmethod
+    def _length(above, entries, below):
+        lines = len(above) + len(below) + (len(entries) + 2 if entries else 0)
+        return sum(len(line) for line in above + below) + sum(len(entry[1]) for entry in entries) + \
+            (len(form_fields_begin) + len(form_fields_end) if entries else 0) + max(lines - 1, 0)
@@ -0,0 +1,139 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import threading
+import Queue
+
+from FreeEmailProviders import FreeEmailProviders
+from Instrumentation import observe_cache, submission
+
+# second-level labels under which country domains register names, e.g. example.co.uk
+_second_level_labels = ('ac', 'co', 'com', 'edu', 'gov', 'net', 'or', 'org', 'ne', 'gob', 'nic')
+
+
+def registrable_domain(domain):
+    """
+    the part of a domain that someone registered, e.g. mail.example.co.uk -> example.co.uk.
+    An approximation of the public suffix list, which is good enough for grouping.
+    :param domain:
+    :return: lower-case domain
+    """
+    labels = domain.lower().strip('.').split('.')
+    if 3 <= len(labels) and 2 == len(labels[-1]) and labels[-2] in _second_level_labels:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def group_key(email):
+    """
+    submissions with the same key touch the same organization or contact, so they belong in the same group:
+    the registrable domain for company addresses, the whole address for free email accounts
+    :param email:
+    :return: string
+    """
+    (username, domain) = email.lower().split('@')
+    if FreeEmailProviders.is_free(domain):
+        return email.lower()
+    return registrable_domain(domain)
+
+
+class Batch_Planner:
+    """
+    Process a batch of submissions so that each organization and each contact is touched once:
+    submissions are grouped by registrable domain (or by email address for free email accounts); within a group
+    each organization is looked up or created once, and each contact gets one merged update
+    (Landing_Page.do_forms), followed by one note per submission.
+    """
+
+    def group(self, submissions):
+        """
+        :param submissions: iterable of (key, form fields) where key identifies the submission to the caller
+        :return: list of groups, each a list of (key, form fields) in their original order
+        """
+        groups = dict()
+        order = []
+        for (key, form_fields) in submissions:
+            name = group_key(form_fields['email'])
+            if name not in groups:
+                groups[name] = []
+                order.append(name)
+            groups[name].append((key, form_fields))
+        return [groups[name] for name in order]
+
+    def run_group(self, lp, submissions, progress=None):
+        """
+        process one group from group()
+        :param lp: Landing_Page
+        :param submissions: list of (key, form fields)
+        :param progress: if not None, called with the results so far after each email address's submissions
+        :return: dictionary of key -> thank-you page URL, or the exception which stopped that submission
+        """
+        results = dict()
+        organizations = dict()
+        by_email = dict()
+        emails = []
+        for (key, form_fields) in submissions:
+            email = form_fields['email'].lower()
+            if email not in by_email:
+                by_email[email] = []
+                emails.append(email)
+            by_email[email].append((key, form_fields))
+
+        for email in emails:
+            keys = [key for (key, form_fields) in by_email[email]]
+            forms = [form_fields for (key, form_fields) in by_email[email]]
+            try:
+                with submission('batch'):
+                    (username, domain) = email.split('@')
+                    observe_cache('organization', domain in organizations)
+                    if domain not in organizations:
+                        # the first submission naming a company names a new organization
+                        companies = [form_fields for form_fields in forms if form_fields.get('company')]
+                        organizations[domain] = lp.organization_for(email, (companies or forms)[0])
+                    urls = lp.do_forms(forms[0]['email'], forms, organizations[domain])
+                results.update(zip(keys, urls))
+            except Exception as e:
+                for key in keys:
+                    results[key] = e
+            if progress is not None:
+                progress(results)
+        return results
+
+    def run(self, submissions, lp_factory, concurrency=4):
+        """
+        group a batch and process the groups on a pool of threads
+        :param submissions: list of (key, form fields)
+        :param lp_factory: callable returning a new Landing_Page; each thread gets its own
+        :param concurrency: number of threads
+        :return: dictionary of key -> thank-you page URL, or the exception which stopped that submission
+        """
+        queue = Queue.Queue()
+        for group in self.group(submissions):
+            queue.put(group)
+        results = dict()
+        lock = threading.Lock()
+
+        def work():
+            lp = None
+            while True:
+                try:
+                    group = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if lp is None:
+                        lp = lp_factory()
+                    group_results = self.run_group(lp, group)
+                except Exception as e:
+                    group_results = dict((key, e) for (key, form_fields) in group)
+                with lock:
+                    results.update(group_results)
+
+        threads = [threading.Thread(target=work) for i in range(min(concurrency, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
@@ -0,0 +1,178 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import cgi
+import time
+
+from config import recaptcha_secretkey
+from FormValidator import validate, Validation_Error
+from RateLimiter import Rate_Limiter, honeypot_tripped
+from IdempotencyStore import Idempotency_Store, fingerprint
+from Instrumentation import observe_cache, stage, submission
+import AdaptiveLimit
+import InsightlyQuota
+import Trace
+
+Trace.install()
+InsightlyQuota.install()
+AdaptiveLimit.install()
+
+
+class Response:
+    """
+    what to send back to the browser; lp.py prints it as CGI output, server.py returns it through WSGI
+    """
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = [(name, self._utf8(value)) for (name, value) in headers]
+        self.body = self._utf8(body)
+
+    @staticmethod
+    def _utf8(string):
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        return string
+
+
+class Rejected(Exception):
+    """
+    raised to turn a submission away with an error page
+    """
+
+    def __init__(self, lines):
+        Exception.__init__(self, '; '.join(lines))
+        self.lines = lines
+
+
+def error_page(lines):
+    body = ['<html><head><title>Error</title></head><body>']
+    for line in lines:
+        body.append('<p>' + cgi.escape(line) + '</p>')
+    body.append('</body></html>')
+    return Response('200 OK', [('Content-type', 'text/html')], '\n'.join(body) + '\n')
+
+
+def redirect(url):
+    return Response('302 Found', [('Content-type', 'text/html'), ('Location', url)], 'Redirecting to: ' + url + '\n')
+
+
+def read_fields(field_storage, remote_addr):
+    """
+    :param field_storage: cgi.FieldStorage
+    :param remote_addr: the visitor's IP address
+    :return: dictionary of unicode form fields, plus ip_address
+    """
+    form_fields = dict()
+    for key in field_storage.keys():
+        fieldname = str(key)
+        value = field_storage.getvalue(fieldname).decode('utf8')
+        form_fields[fieldname] = value
+    form_fields['ip_address'] = cgi.escape(remote_addr)
+    return form_fields
+
+
+def handle(form_fields):
+    """
+    check a submission and, if it passes, process it
+    :param form_fields: from read_fields()
+    :return: Response
+    """
+    if 1 >= len(form_fields):
+        return Response('200 OK', [('Content-type', 'text/html')], 'Error: This script can only be called from a form\n')
+
+    # the form's latency budget counts from here
+    started = time.time()
+    with submission(form_fields.get('form_name')) as timer:
+        try:
+            response = redirect(_check_and_process(form_fields, timer, started))
+        except Rejected as r:
+            if timer is not None:
+                timer.outcome = 'rejected'
+            response = error_page(r.lines)
+        if timer is not None:
+            response.headers.append(('X-Correlation-Id', timer.id))
+        return response
+
+
+def _check_and_process(form_fields, timer, started):
+    """
+    :return: the thank-you page URL
+    :raises Rejected:
+    """
+    # bots fill in the hidden honeypot fields; give them nothing to learn from
+    if honeypot_tripped(form_fields):
+        raise Rejected(['Error: form not submitted'])
+
+    # reject bad submissions before spending any reCAPTCHA or Insightly calls on them
+    try:
+        with stage('validate'):
+            validate(form_fields)
+    except Validation_Error as ve:
+        raise Rejected(ve.messages + ['Press BACK and try again'])
+
+    # double-clicks and resubmits get the original result instead of running everything again
+    submission_key = fingerprint(form_fields)
+    idempotency = Idempotency_Store()
+    url = idempotency.begin(submission_key)
+    observe_cache('idempotency', url is not None)
+    if url is None:
+        try:
+            url = _process(form_fields, timer, started)
+        finally:
+            if url is None:
+                idempotency.release(submission_key)
+            else:
+                idempotency.complete(submission_key, url)
+    return url
+
+
+def _process(form_fields, timer, started):
+    """
+    run a validated submission through reCAPTCHA and Insightly
+    :return: the thank-you page URL
+    :raises Rejected:
+    """
+    with stage('rate_limit'):
+        limiter = Rate_Limiter()
+        try:
+            allowed = limiter.allow(form_fields['ip_address'], form_fields['email'])
+        finally:
+            limiter.close()
+    if not allowed:
+        raise Rejected(['Too many submissions. Please try again later.'])
+
+    # verify reCAPTCHA in the background while looking up the organization and contact;
+    # if the token turns out to be bad, the lookups are simply thrown away
+    verification = None
+    if recaptcha_secretkey is not None:
+        # don't pass on the reCAPTCHA data; no one else cares about it
+        token = form_fields.pop('g-recaptcha-response', None)
+        if not token:
+            raise Rejected(['reCATPCHA failure. Only humans allowed.'])
+        # imported here, like Landing_Page below, so that rejected submissions don't wait for Requests,
+        # smtplib, email and the Insightly SDK to load
+        import recaptcha
+        verification = recaptcha.Verification(token, form_fields['ip_address'])
+        verification.start()
+
+    # live submissions always go ahead, but this warns when the Insightly quota is running short
+    InsightlyQuota.allow('live')
+    from LandingPage import Landing_Page
+    lp = Landing_Page()
+    lp.prefetch(form_fields)
+
+    if verification is not None:
+        verification.join()
+        if timer is not None:
+            timer.add_stage({'stage': 'recaptcha', 'calls': {'recaptcha': 1}}, verification.duration,
+                            'ok' if verification.success else 'failed')
+        if not verification.success:
+            raise Rejected(['reCATPCHA failure. Only humans allowed.'])
+
+    try:
+        return lp.do_form(form_fields, started)
+    except KeyError:
+        raise Rejected(['Missing field(s): email, first_name, or last_name', 'Press BACK and try again'])
@@ -0,0 +1,102 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import os
+import re
+
+import config
+
+try:
+    # form data files compiled into the bundle by build_bundle.py
+    from BundledForms import forms as bundled_forms
+except ImportError:
+    bundled_forms = {}
+
+# default limits; config.py may override any of them
+max_field_length = getattr(config, 'max_field_length', 5000)
+field_length_limits = getattr(config, 'field_length_limits', {
+    'email': 254,
+    'first_name': 100,
+    'last_name': 100,
+    'form_name': 64,
+})
+
+required_fields = ('email', 'first_name', 'last_name', 'form_name')
+
+_email_re = re.compile(r'^[^@\s]+@[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?)+$')
+_form_name_re = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class Validation_Error(ValueError):
+    """
+    Raised when a submission fails validation. messages is a list of human-readable problems.
+    """
+
+    def __init__(self, messages):
+        ValueError.__init__(self, '; '.join(messages))
+        self.messages = messages
+
+
+def field_name(name):
+    """
+    :param name: name of a submitted field: unicode, or UTF-8 bytes
+    :return: the name as a str if it is ASCII; otherwise as unicode, which validate() rejects
+    """
+    if isinstance(name, str):
+        name = name.decode('utf8', 'replace')
+    try:
+        return name.encode('ascii')
+    except UnicodeError:
+        return name
+
+
+def _is_ascii(name):
+    try:
+        name.decode('ascii') if isinstance(name, str) else name.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def validate(form_fields, form_data_directory='forms'):
+    """
+    Check a submission before anything expensive (reCAPTCHA, Insightly, SMTP) is done with it.
+    Only the form data file is looked at on disk (unless it is in the bundle); there is no network I/O.
+
+    :param form_fields: dictionary of submitted fields
+    :param form_data_directory: directory holding the FORM_NAME.txt files
+    :return: None
+    :raises Validation_Error: listing every problem found
+    """
+    messages = []
+
+    missing = [name for name in required_fields if not form_fields.get(name)]
+    if missing:
+        messages.append('Missing field(s): ' + ', '.join(missing))
+
+    # every field but the few Landing_Page uses goes into BACKGROUND as "name: value"
+    unusable = [key for key in form_fields if not _is_ascii(key)]
+    if unusable:
+        messages.append('Field names must be ASCII: ' + ', '.join(sorted(repr(key) for key in unusable)))
+
+    for key, value in form_fields.items():
+        if key in unusable:
+            continue
+        limit = field_length_limits.get(key, max_field_length)
+        if value is not None and limit < len(value):
+            messages.append('Field {key} is longer than {limit} characters'.format(key=key, limit=limit))
+
+    email = form_fields.get('email')
+    if email and not _email_re.match(email):
+        messages.append('Invalid email address')
+
+    form_name = form_fields.get('form_name')
+    if form_name:
+        if not _form_name_re.match(form_name) or form_name not in bundled_forms and \
+                not os.path.isfile(os.path.join(form_data_directory, form_name + '.txt')):
+            messages.append('Unknown form')
+
+    if messages:
+        raise Validation_Error(messages)
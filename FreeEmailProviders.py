@@ -2980,10 +2980,12 @@ class FreeEmailProviders:
         'zzn.com',
         'zzom.co.uk',
     )
+    # for lookups; a tuple has to be searched from the start
+    _domain_set = frozenset(domains)
 
     @staticmethod
     def is_free(domain):
-        return domain.lower() in FreeEmailProviders.domains
+        return domain.lower() in FreeEmailProviders._domain_set
 
 
 if '__main__' == __name__:
@@ -0,0 +1,131 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import errno
+import hashlib
+import os
+import random
+import time
+
+import config
+from SharedTable import state_path
+
+# seconds that a finished submission's redirect URL is remembered
+idempotency_ttl = getattr(config, 'idempotency_ttl', 600)
+# seconds a duplicate waits for the original submission to finish before doing the work itself
+idempotency_wait = getattr(config, 'idempotency_wait', 30)
+# optional form field carrying a client-supplied idempotency token
+idempotency_field = getattr(config, 'idempotency_field', 'idempotency_key')
+
+# fields which differ between otherwise identical submissions
+_volatile_fields = ('g-recaptcha-response', 'ip_address')
+
+
+def fingerprint(form_fields):
+    """
+    key identifying a submission. A client-supplied token wins; otherwise hash the submitted fields.
+    The token field is removed from form_fields.
+    :param form_fields: dictionary of submitted fields; modified in place
+    :return: hex string
+    """
+    token = form_fields.pop(idempotency_field, None)
+    h = hashlib.sha1()
+    if token:
+        h.update('token\0' + token.encode('utf-8'))
+    else:
+        for key in sorted(form_fields.keys()):
+            if key not in _volatile_fields:
+                h.update(key.encode('utf-8') + '\0' + form_fields[key].encode('utf-8') + '\0')
+    return h.hexdigest()
+
+
+class Idempotency_Store:
+    """
+    Remembers which submissions are in flight or finished, using one small file per key, so that duplicates
+    coming in through any CGI process get the original redirect URL instead of redoing the work.
+
+    An empty file means the submission is in flight; once finished the file holds the redirect URL.
+    """
+
+    _directory = None
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = state_path('idempotency')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                pass
+        self._directory = directory
+
+    def begin(self, key):
+        """
+        claim a key. If another process already holds it, wait for that process to finish.
+        :param key: from fingerprint()
+        :return: None if the caller now owns the key and must do the work, else the original redirect URL
+        """
+        path = self._path(key)
+        if random.random() < 0.01:
+            self._purge()
+        deadline = time.time() + idempotency_wait
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+                return None
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                age = time.time() - os.path.getmtime(path)
+                with open(path, 'r') as f:
+                    url = f.read()
+            except (IOError, OSError):
+                # released or purged while we looked; try to claim it again
+                continue
+            if url and age < idempotency_ttl:
+                return url.decode('utf-8')
+            if url or deadline < time.time():
+                # expired, or the original gave up without releasing it
+                self.release(key)
+                continue
+            time.sleep(0.1)
+
+    def complete(self, key, url):
+        """
+        record the redirect URL for a key claimed with begin()
+        :return: None
+        """
+        path = self._path(key)
+        temp = '{path}.{pid}'.format(path=path, pid=os.getpid())
+        with open(temp, 'w') as f:
+            f.write(url.encode('utf-8'))
+        os.rename(temp, path)
+
+    def release(self, key):
+        """
+        give up a key claimed with begin(), e.g. because the submission failed, so that a retry can run
+        :return: None
+        """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def _purge(self):
+        """
+        remove records older than idempotency_ttl
+        """
+        cutoff = time.time() - max(idempotency_ttl, idempotency_wait)
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
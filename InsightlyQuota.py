@@ -0,0 +1,277 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Count Insightly API calls against the daily quota.
+
+Every Insightly call is counted by endpoint, by form and by pipeline stage. Counts are added to a file per day
+(UTC) in the state directory, shared by every CGI process and server on the machine, and the current rate is
+used to forecast when the quota will run out. status() says whether to carry on ('ok'), warn ('warn') or put
+off low-priority work ('shed'); allow() answers that for one piece of work. Daily totals:
+
+    python InsightlyQuota.py [--days 7]
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import Instrumentation
+from SharedTable import state_path
+
+# Insightly API calls allowed per day; None just counts them
+insightly_daily_quota = getattr(config, 'insightly_daily_quota', None)
+# warn when this fraction of the quota is used, or when the current rate will use it all before the day is out
+quota_warn_at = getattr(config, 'quota_warn_at', 0.8)
+# put off low-priority work (bulk imports, the batch endpoint) when this fraction is used, or when the forecast
+# says the quota will run out and quota_warn_at is passed
+quota_shed_at = getattr(config, 'quota_shed_at', 0.95)
+# days of totals to keep
+quota_keep_days = getattr(config, 'quota_keep_days', 31)
+
+# seconds between writes of this process's counts, and between re-reads of the day's totals
+_flush_interval = 5.0
+_status_interval = 10.0
+
+_lock = threading.Lock()
+_pending = dict()
+_flushed = [time.time()]
+_status = [None, 0.0]
+_warned = set()
+
+# work which may be put off when the quota runs short; anything else always goes ahead
+low_priority = ('bulk',)
+
+
+def _today(now=None):
+    return time.strftime('%Y%m%d', time.gmtime(now))
+
+
+def _day_file(day):
+    return state_path('insightly-calls-{day}.json'.format(day=day))
+
+
+def call_name(method, endpoint):
+    """
+    :return: e.g. 'read contacts', 'create contacts/notes', 'ownerinfo'
+    """
+    if endpoint == method:
+        return method
+    return '{method} {endpoint}'.format(method=method, endpoint=endpoint).lower()
+
+
+def _on_call(service, method, endpoint, duration, status, nbytes):
+    if 'insightly' != service:
+        return
+    timer = Instrumentation.current_timer()
+    form = 'none'
+    stage = 'none'
+    if timer is not None:
+        form = timer.label or 'none'
+        stage = timer.current_stage() or 'none'
+    now = time.time()
+    hour = time.gmtime(now).tm_hour
+    with _lock:
+        for key in (('endpoint', call_name(method, endpoint)), ('form', form), ('stage', stage),
+                    ('hour', str(hour)), ('total', '')):
+            _pending[key] = _pending.get(key, 0) + 1
+        due = _flush_interval < now - _flushed[0]
+    if due:
+        flush()
+
+
+def flush():
+    """
+    add this process's counts to the day's totals
+    """
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _flushed[0] = time.time()
+    if not pending:
+        return
+    day = _today()
+    try:
+        with _locked_totals(day) as day_totals:
+            for ((kind, name), count) in pending.items():
+                if 'total' == kind:
+                    day_totals['total'] += count
+                else:
+                    bucket = day_totals.setdefault('by_' + kind, {})
+                    bucket[name] = bucket.get(name, 0) + count
+    except (IOError, OSError, ValueError):
+        # counting must never take the landing page down
+        pass
+    _status[1] = 0.0
+
+
+@contextmanager
+def _locked_totals(day):
+    """
+    with _locked_totals(day) as totals: ... reads, locks and rewrites one day's totals
+    """
+    filename = _day_file(day)
+    new = not os.path.exists(filename)
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.read(fd, 1 << 20)
+        day_totals = json.loads(data) if data else {'day': day, 'total': 0}
+        yield day_totals
+        data = json.dumps(day_totals, sort_keys=True)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    if new:
+        _purge()
+
+
+def _purge():
+    oldest = _today(time.time() - quota_keep_days * 86400)
+    directory = os.path.dirname(_day_file(oldest))
+    for name in os.listdir(directory):
+        if name.startswith('insightly-calls-') and name[16:24] < oldest:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def totals(day=None):
+    """
+    :param day: 'YYYYMMDD' (UTC), default today
+    :return: dictionary with total and by_endpoint, by_form, by_stage and by_hour counts
+    """
+    day = day or _today()
+    try:
+        with open(_day_file(day), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'day': day, 'total': 0}
+
+
+def forecast(day_totals, now=None, quota=None):
+    """
+    :param day_totals: from totals()
+    :param quota: calls allowed per day, default insightly_daily_quota
+    :return: dictionary: total, quota, used (fraction), rate (calls per hour), projected (total at the end of
+             the day), exhausted_at (epoch seconds, or None if the quota will last the day) and level
+    """
+    # only needed once there is a forecast to make; calendar imports locale, which is slow to load
+    import calendar
+    now = time.time() if now is None else now
+    quota = insightly_daily_quota if quota is None else quota
+    gm = time.gmtime(now)
+    midnight = calendar.timegm((gm.tm_year, gm.tm_mon, gm.tm_mday, 0, 0, 0))
+    by_hour = day_totals.get('by_hour', {})
+    # calls in the last hour: this hour so far, plus the part of the previous hour still within the hour
+    into_hour = (now - midnight) % 3600
+    previous = by_hour.get(str(gm.tm_hour - 1), 0) if 0 < gm.tm_hour else 0
+    rate = by_hour.get(str(gm.tm_hour), 0) + previous * (1 - into_hour / 3600.0)
+    if 0 == gm.tm_hour:
+        # nothing to go on but the hour so far
+        rate = by_hour.get('0', 0) * 3600.0 / max(into_hour, 60)
+    total = day_totals.get('total', 0)
+    seconds_left = midnight + 86400 - now
+    result = {
+        'day': day_totals.get('day'),
+        'total': total,
+        'quota': quota,
+        'rate': rate,
+        'projected': int(total + rate * seconds_left / 3600),
+        'used': None,
+        'exhausted_at': None,
+        'level': 'ok',
+    }
+    if quota is None:
+        return result
+    used = float(total) / quota
+    result['used'] = used
+    if quota <= total:
+        result['exhausted_at'] = now
+    elif 0 < rate and quota <= result['projected']:
+        result['exhausted_at'] = now + (quota - total) / rate * 3600
+    if quota_shed_at <= used or (result['exhausted_at'] is not None and quota_warn_at <= used):
+        result['level'] = 'shed'
+    elif quota_warn_at <= used or result['exhausted_at'] is not None:
+        result['level'] = 'warn'
+    return result
+
+
+def status():
+    """
+    :return: forecast() for today, re-read from disk at most every few seconds
+    """
+    now = time.time()
+    if _status[0] is None or _status_interval < now - _status[1]:
+        _status[0] = forecast(totals(), now)
+        _status[1] = now
+    return _status[0]
+
+
+def _first_warning(day):
+    """
+    :return: True for the first process on the machine to ask, once a day
+    """
+    if day in _warned:
+        return False
+    _warned.add(day)
+    try:
+        os.close(os.open(state_path('insightly-calls-{day}.warned'.format(day=day)), os.O_CREAT | os.O_EXCL, 0o600))
+        return True
+    except OSError:
+        return False
+
+
+def allow(priority):
+    """
+    :param priority: e.g. 'live' for a form submission, 'bulk' for imports and batches
+    :return: False if this work should be put off to save Insightly calls
+    """
+    current = status()
+    if 'ok' != current['level'] and _first_warning(current['day']):
+        message = 'Insightly API quota: {total} of {quota} calls used today, {rate:.0f}/hour, {forecast}\n'
+        sys.stderr.write(message.format(
+            total=current['total'], quota=current['quota'], rate=current['rate'],
+            forecast='runs out at ' + time.strftime('%H:%M UTC', time.gmtime(current['exhausted_at']))
+            if current['exhausted_at'] else 'should last the day'))
+    return not ('shed' == current['level'] and priority in low_priority)
+
+
+def install():
+    """
+    start counting this process's Insightly calls
+    """
+    if _on_call not in Instrumentation.observers:
+        Instrumentation.observers.append(_on_call)
+        atexit.register(flush)
+
+
+if '__main__' == __name__:
+    import argparse
+    parser = argparse.ArgumentParser(description='Daily Insightly API call totals and quota forecast.')
+    parser.add_argument('--days', type=int, default=1, help='number of days to show, most recent first')
+    args = parser.parse_args()
+    for n in range(args.days):
+        day_totals = totals(_today(time.time() - n * 86400))
+        print '{day}: {total} calls'.format(day=day_totals['day'], total=day_totals['total'])
+        for kind in ('endpoint', 'form', 'stage'):
+            for (name, count) in sorted(day_totals.get('by_' + kind, {}).items(), key=lambda item: -item[1]):
+                print '    {kind:8} {name:32} {count:8d}'.format(kind=kind, name=name, count=count)
+        if 0 == n:
+            current = forecast(day_totals)
+            print '    rate {rate:.0f}/hour, projected {projected} by midnight UTC'.format(**current)
+            if current['quota'] is not None:
+                print '    {used:.0%} of {quota} used; {level}{when}'.format(
+                    when=', runs out at ' + time.strftime('%H:%M UTC', time.gmtime(current['exhausted_at']))
+                    if current['exhausted_at'] else '', **current)
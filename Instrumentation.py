@@ -0,0 +1,382 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import binascii
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+# time each stage of every submission
+stage_timing_enabled = getattr(config, 'stage_timing_enabled', True)
+# file to append one JSON line per submission with its stage timings, or None
+stage_timing_log = getattr(config, 'stage_timing_log', None)
+
+
+class Histogram:
+    """
+    Latency histogram with geometric buckets from 0.5ms to about 10 minutes, each 25% wider than the last,
+    so percentiles are accurate to within 25% however the latencies are spread.
+    """
+
+    bounds = [0.0005 * 1.25 ** i for i in range(64)]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        i = bisect.bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def percentile(self, q):
+        """
+        :param q: 0 to 100
+        :return: upper bound, in seconds, of the bucket holding the q-th percentile; None if empty
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if 0 == count:
+            return None
+        rank = q / 100.0 * count
+        seen = 0
+        for (i, n) in enumerate(counts):
+            seen += n
+            if rank <= seen and 0 < n:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+_histograms = dict()
+_histograms_lock = threading.Lock()
+
+
+def histogram(name):
+    """
+    :param name: e.g. 'stage.upsert_contact'
+    :return: the process-wide Histogram of that name, created if need be
+    """
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        return _histograms[name]
+
+
+def histograms():
+    """
+    :return: dictionary of name -> Histogram, for everything recorded by this process
+    """
+    with _histograms_lock:
+        return dict(_histograms)
+
+
+def report():
+    """
+    :return: text table of count and p50/p95/p99 latency for each histogram
+    """
+    lines = ['{name:<32} {count:>8} {p50:>10} {p95:>10} {p99:>10}'.format(name='stage', count='count', p50='p50 ms',
+                                                                          p95='p95 ms', p99='p99 ms')]
+    for (name, h) in sorted(histograms().items()):
+        summary = h.summary()
+        if 0 == summary['count']:
+            continue
+        lines.append('{name:<32} {count:>8} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}'.format(
+            name=name, count=summary['count'], p50=summary['p50'] * 1000, p95=summary['p95'] * 1000,
+            p99=summary['p99'] * 1000))
+    return '\n'.join(lines)
+
+
+# observers are called as observer(service, method, endpoint, duration, status, nbytes) after every upstream call
+observers = []
+# cache_observers are called as observer(cache, hit) on every cache lookup
+cache_observers = []
+# submission_observers are called as observer(record) with the record from Stage_Timer.finish()
+submission_observers = []
+
+# set to True to work out the size of every Insightly response (costs a json.dumps per call)
+measure_bytes = False
+
+# service -> number of upstream calls in progress in this process
+in_flight = dict()
+# service -> object whose acquire() timed_call() calls before every call to that service, and release(duration)
+# after it, e.g. AdaptiveLimit.Adaptive_Limit
+limiters = dict()
+_in_flight_lock = threading.Lock()
+
+_local = threading.local()
+
+
+def observe_call(service, method, endpoint, duration, status, nbytes=None):
+    """
+    record one call to Insightly, SMTP or reCAPTCHA
+    :param service: 'insightly', 'smtp' or 'recaptcha'
+    :param method: e.g. 'read', 'sendmail', 'POST'
+    :param endpoint: e.g. 'contacts'
+    :param duration: seconds
+    :param status: 'ok', or the name of the exception raised
+    :param nbytes: size of the response, if known
+    """
+    timer = current_timer()
+    if timer is not None:
+        timer.add_call(service, method, endpoint, duration, status, nbytes)
+    for observer in observers:
+        observer(service, method, endpoint, duration, status, nbytes)
+
+
+def observe_cache(cache, hit):
+    """
+    record a cache lookup
+    :param cache: e.g. 'prefetch', 'form_data', 'idempotency'
+    :param hit: True if the cache had the answer
+    """
+    timer = current_timer()
+    if timer is not None:
+        timer.cache.append({'cache': cache, 'hit': hit})
+    for observer in cache_observers:
+        observer(cache, hit)
+
+
+def timed_call(service, method, endpoint, function, *args, **kwargs):
+    """
+    call function(*args, **kwargs) and report it to observe_call()
+    """
+    limiter = limiters.get(service)
+    if limiter is not None:
+        # before the clock starts: waiting for a turn is not the service being slow
+        limiter.acquire()
+    with _in_flight_lock:
+        in_flight[service] = in_flight.get(service, 0) + 1
+    start = time.time()
+    try:
+        result = function(*args, **kwargs)
+    except Exception as e:
+        observe_call(service, method, endpoint, time.time() - start, e.__class__.__name__)
+        raise
+    finally:
+        duration = time.time() - start
+        with _in_flight_lock:
+            in_flight[service] -= 1
+        if limiter is not None:
+            limiter.release(duration)
+    nbytes = None
+    if measure_bytes and result is not None:
+        nbytes = len(json.dumps(result, default=repr))
+    observe_call(service, method, endpoint, duration, 'ok', nbytes)
+    return result
+
+
+class Instrumented_Client:
+    """
+    Wraps the Insightly SDK so that every method call is counted and timed
+    """
+
+    def __init__(self, client, service='insightly'):
+        self._client = client
+        self._service = service
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            endpoint = args[0] if args and isinstance(args[0], basestring) else name
+            if kwargs.get('sub_type'):
+                endpoint += '/' + kwargs['sub_type']
+            return timed_call(self._service, name, endpoint, attribute, *args, **kwargs)
+        return call
+
+
+def current_timer():
+    """
+    :return: the Stage_Timer of the submission being processed by this thread, or None
+    """
+    return getattr(_local, 'timer', None)
+
+
+class Stage_Timer:
+    """
+    Times the stages of one submission: how long each took, how it ended and how many upstream calls it made.
+    Durations also go into the process-wide histograms (stage.NAME and submission).
+    """
+
+    def __init__(self, label=None):
+        # correlation ID, tying together everything logged about this submission
+        # what uuid4().hex would be, without importing uuid, which loads ctypes
+        self.id = binascii.hexlify(os.urandom(16))
+        self.label = label
+        # set this to override the outcome recorded by submission(), e.g. 'rejected'
+        self.outcome = None
+        # what went wrong, if the submission raised an exception
+        self.error = None
+        self.stages = []
+        # every upstream call and cache lookup made for this submission, on any thread
+        self.calls = []
+        self.cache = []
+        self._thread = threading.current_thread()
+        self._stack = []
+        self._start = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'calls': {}}
+        self._stack.append(record)
+        start = time.time()
+        outcome = 'ok'
+        try:
+            yield record
+        except BaseException as e:
+            outcome = e.__class__.__name__
+            raise
+        finally:
+            self._stack.pop()
+            self.add_stage(record, time.time() - start, outcome)
+
+    def add_stage(self, record, duration, outcome):
+        """
+        record a stage which was timed elsewhere, e.g. on another thread
+        :param record: dictionary with stage and calls elements
+        :param duration: seconds
+        :param outcome: 'ok', or the name of the exception raised
+        """
+        record['duration'] = duration
+        record['outcome'] = outcome
+        self.stages.append(record)
+        histogram('stage.' + record['stage']).add(duration)
+
+    def current_stage(self):
+        """
+        :return: name of the innermost stage in progress, if called on the submission's own thread, otherwise None
+        """
+        if self._stack and threading.current_thread() is self._thread:
+            return self._stack[-1]['stage']
+        return None
+
+    def add_call(self, service, method, endpoint, duration, status, nbytes):
+        self.calls.append({
+            'service': service,
+            'method': method,
+            'endpoint': endpoint,
+            'status': status,
+            'bytes': nbytes,
+            'duration': duration,
+        })
+        # calls made on other threads (e.g. reCAPTCHA) do not belong to the stage this thread is in
+        if self._stack and threading.current_thread() is self._thread:
+            calls = self._stack[-1]['calls']
+            calls[service] = calls.get(service, 0) + 1
+
+    def finish(self, outcome):
+        """
+        :param outcome: 'ok', or why the submission failed
+        :return: the per-submission record
+        """
+        duration = time.time() - self._start
+        histogram('submission').add(duration)
+        record = {
+            'id': self.id,
+            'time': self._start,
+            'label': self.label,
+            'duration': duration,
+            'outcome': outcome,
+            'error': self.error,
+            'stages': self.stages,
+            'calls': self.calls,
+            'cache': self.cache,
+        }
+        if stage_timing_log is not None:
+            with open(stage_timing_log, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        for observer in submission_observers:
+            observer(record)
+        return record
+
+
+class _No_Stage:
+    """
+    stand-in for Stage_Timer.stage() when timing is off or no submission is being timed
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_no_stage = _No_Stage()
+
+
+def stage(name):
+    """
+    time a stage of the current submission:  with stage('upsert_contact'): ...
+    """
+    timer = current_timer()
+    if timer is None:
+        return _no_stage
+    return timer.stage(name)
+
+
+@contextmanager
+def submission(label=None):
+    """
+    time one submission on this thread. Nested calls share the outermost timer.
+    :param label: e.g. the form name
+    :return: the Stage_Timer, or None when timing is off and nothing else wants the record
+    """
+    if not (stage_timing_enabled or submission_observers) or current_timer() is not None:
+        yield current_timer()
+        return
+    timer = Stage_Timer(label)
+    _local.timer = timer
+    outcome = 'ok'
+    try:
+        yield timer
+    except BaseException as e:
+        outcome = e.__class__.__name__
+        timer.error = repr(e)
+        raise
+    finally:
+        _local.timer = None
+        timer.finish(timer.outcome or outcome)
+
+
+def use_timer(timer):
+    """
+    make another thread's timer current on this thread, e.g. for work done on its behalf in the background
+    :param timer: Stage_Timer or None
+    """
+    _local.timer = timer
+
+
+if '__main__' == __name__:
+    # summarize a stage_timing_log, e.g. one written by many CGI processes
+    import sys
+    for filename in sys.argv[1:]:
+        with open(filename, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                histogram('submission').add(record['duration'])
+                for stage_record in record['stages']:
+                    histogram('stage.' + stage_record['stage']).add(stage_record['duration'])
+    print report()
@@ -0,0 +1,612 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Spool of work done in the background: the note, notification and thank-you email of a submission which used up
+its latency budget (see Landing_Page.do_forms), and leads queued by import_leads.py --queue.
+
+Each job is a JSON file in the jobs directory, so that any process can add one and any process can run it:
+server.py and async_server.py run them on background threads, and worker.py runs them for lp.py. A job is
+claimed by renaming its file, so only one process runs it. A job which fails is tried again later, waiting
+longer each time, and after job_max_attempts is moved to jobs/failed.
+
+Jobs wait in lanes, highest priority first: live (what submissions put off), high_value (queued leads for the
+forms in high_value_forms), bulk (other queued leads) and resync. An Executor runs the job from the highest lane
+which has one due, except that each lane has its own limit on jobs running at once and its own share of
+job_rate, and that a job moves up a lane for every job_aging seconds it has waited, so a long import neither
+holds up live submissions nor waits forever behind them.
+
+A job can have a key, e.g. Batch_Planner.group_key() of the email address it is for: the registrable domain of a
+company address (whose organization may be created), or the address itself for a free email account. Jobs with the
+same key run one at a time, in the order they were put, whichever processes and threads run them, so that two
+updates to one contact (or the creation of one organization) never race; jobs with different keys run in
+parallel. A job which fails holds up the later jobs with its key until it succeeds or is given up on. Every key
+is its own queue, so running more processes or threads never changes the order.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import config
+import InsightlyQuota
+import Metrics
+from Instrumentation import histogram
+from RateLimiter import Token_Bucket
+from SharedTable import state_path
+
+# directory of the spool; None for state_directory/jobs
+job_directory = getattr(config, 'job_directory', None)
+# tries before a job is given up on and moved to failed/
+job_max_attempts = getattr(config, 'job_max_attempts', 8)
+# seconds before the first retry; doubled for every retry after it, up to an hour
+job_retry_delay = getattr(config, 'job_retry_delay', 60)
+# seconds after which a job claimed by a process which has not finished or saved it is run again; the process
+# probably died. The process, if it is only slow, leaves the job to whoever runs it now. Also how long before a
+# key's place in line held by a job which no longer exists is let go.
+job_claim_timeout = getattr(config, 'job_claim_timeout', 600)
+# seconds between looks for jobs which have come due
+job_poll_interval = getattr(config, 'job_poll_interval', 5)
+# lanes, highest priority first: (name, most of its jobs a process runs at once, share of job_rate)
+job_lanes = getattr(config, 'job_lanes', (
+    ('live', 4, 0.4),
+    ('high_value', 2, 0.3),
+    ('bulk', 2, 0.2),
+    ('resync', 1, 0.1),
+))
+# jobs a process runs at once, across all lanes
+job_threads = getattr(config, 'job_threads', 4)
+# jobs a process starts per second, across all lanes; None for no limit (the lanes' shares then don't matter)
+job_rate = getattr(config, 'job_rate', None)
+# seconds a due job waits before it ranks with the lane above its own; None for never
+job_aging = getattr(config, 'job_aging', 60)
+# forms whose queued leads go in the high_value lane instead of bulk
+high_value_forms = getattr(config, 'high_value_forms', ())
+
+lane_names = tuple(name for (name, concurrency, share) in job_lanes)
+# lanes put off, like bulk imports, when the Insightly API quota runs short
+_quota_priority = {'bulk': 'bulk', 'resync': 'bulk'}
+_max_retry_delay = 3600
+# the last place in line handed out by this process, so that jobs it puts with one key always sort in order
+_last_place = [0.0]
+_place_lock = threading.Lock()
+
+# set when a job is added, so that this process's executor runs it without waiting for the next poll
+_wake = threading.Event()
+_executor = [None, None]
+_executor_lock = threading.Lock()
+
+
+def lane_for(form_names):
+    """
+    :param form_names: forms of the leads in a job
+    :return: the lane for queued leads: high_value if any of the forms is in high_value_forms, else bulk
+    """
+    if set(form_names).intersection(high_value_forms):
+        return 'high_value'
+    return 'bulk'
+
+
+class Lost_Claim(Exception):
+    """
+    raised by Job_Queue.save, done and retry for a job which ran past job_claim_timeout and was put back in its lane
+    (see Job_Queue._recover); someone else may be running it now, so it is left to them
+    """
+    pass
+
+
+class Job_Queue:
+    """
+    pending jobs are LANE/DUE-ID-KEY.job, where DUE is the time before which they must not run and KEY is a hash
+    of the job's key (empty if it has none); a claimed job is ID.TOKEN.claimed, where TOKEN (process and time)
+    tells this claim from any later one; given-up jobs are failed/ID.job.
+    keys/KEY/ has a PLACE-ID file for every job with that key which is pending or running, holding the name of the
+    job's pending file; only the job with the first place may run.
+    """
+
+    _directory = None
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = job_directory or state_path('jobs')
+        for d in (directory, os.path.join(directory, 'failed'), os.path.join(directory, 'keys')) + \
+                tuple(os.path.join(directory, lane) for lane in lane_names):
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d, 0o700)
+                except OSError:
+                    pass
+        self._directory = directory
+
+    def put(self, job, lane='live', key=None):
+        """
+        :param job: dictionary which json can write; an id, the lane, the key's hash and the number of attempts are
+                    added to it
+        :param lane: one of lane_names
+        :param key: string; jobs with the same key run one at a time, in the order they were put. None for a job
+                    which may run alongside any other.
+        :return: the job's id
+        """
+        if lane not in lane_names:
+            raise ValueError('Unknown lane ' + lane)
+        job_id = job.setdefault('id', os.urandom(8).encode('hex'))
+        job['lane'] = lane
+        job['key'] = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] if key else ''
+        job.setdefault('attempts', 0)
+        name = self._pending_name(time.time(), job)
+        if job['key']:
+            # in line before the job exists, so that no one can run it out of turn
+            self._take_place(job, name)
+        self._write(name, job)
+        _wake.set()
+        return job_id
+
+    def oldest(self, lane):
+        """
+        :return: (time the lane's longest-due job came due, its file name), or (None, None) if the lane is empty
+        """
+        names = sorted(name for name in os.listdir(os.path.join(self._directory, lane)) if name.endswith('.job'))
+        if not names:
+            return None, None
+        return float(names[0].split('-', 1)[0]), names[0]
+
+    def first_in_line(self, key, job_id):
+        """
+        :param key: hash of a job's key, from the job or its file name
+        :return: True if no job put earlier with the same key is still pending or running
+        """
+        head = self._head_of_line(key)
+        # None if everyone was let go of, this job's own place too, e.g. by hand; don't hold it up forever
+        return head is None or head == job_id
+
+    def _head_of_line(self, key):
+        """
+        :param key: hash of a job's key
+        :return: id of the job with the first place in line for the key which is still held, or None
+        """
+        directory = os.path.join(self._directory, 'keys', key)
+        try:
+            places = sorted(os.listdir(directory))
+        except OSError:
+            return None
+        for place in places:
+            holder = place.split('-', 1)[1]
+            if not self._abandoned(os.path.join(directory, place), holder):
+                return holder
+        return None
+
+    def claim(self, lanes=None):
+        """
+        :param lanes: names of the lanes to take from; default all of them
+        :return: (id, job) of the due job which ranks first, now belonging to the caller, or (None, None).
+                 Jobs rank by lane, counting every job_aging seconds a job has been due as one lane higher,
+                 then by how long they have been due.
+        """
+        self._recover()
+        while True:
+            now = time.time()
+            heads = []
+            # key -> the job at the head of its line, looked up once however many of its jobs are waiting
+            lines = dict()
+            for (rank, lane) in enumerate(lane_names):
+                if lanes is not None and lane not in lanes:
+                    continue
+                # the job due longest in a lane which is first in line for its key ranks first in the lane
+                for name in sorted(n for n in os.listdir(os.path.join(self._directory, lane)) if n.endswith('.job')):
+                    (due, job_id, key) = name[:-4].split('-')
+                    due = float(due)
+                    if now < due:
+                        break
+                    if key:
+                        if key not in lines:
+                            lines[key] = self._head_of_line(key)
+                        if lines[key] not in (None, job_id):
+                            continue
+                    if job_aging:
+                        rank = max(0, rank - int((now - due) // job_aging))
+                    heads.append((rank, due, lane, name))
+                    break
+            if not heads:
+                return None, None
+            (rank, due, lane, name) = min(heads)
+            job_id = name[:-4].split('-')[1]
+            token = '{pid}-{stamp}'.format(pid=os.getpid(), stamp=int(time.time() * 1000000))
+            claimed = self._claimed_path(job_id, token)
+            try:
+                os.rename(os.path.join(self._directory, lane, name), claimed)
+                # the time it was claimed, for _recover
+                os.utime(claimed, None)
+                with open(claimed, 'r') as f:
+                    job = json.load(f)
+            except (IOError, OSError):
+                # another process claimed it first; look again
+                continue
+            job['claim'] = token
+            self._touch_place(job)
+            histogram('job_wait.' + lane).add(now - due)
+            return job_id, job
+
+    def save(self, job_id, job):
+        """
+        record the progress of a claimed job, so that if it is run again it carries on from here
+        :raises Lost_Claim:
+        """
+        claimed = self._claimed_path(job_id, job['claim'])
+        try:
+            # also keeps _recover off it
+            os.utime(claimed, None)
+        except OSError:
+            raise Lost_Claim(job_id)
+        self._write(os.path.basename(claimed), job)
+
+    def done(self, job_id, job):
+        """
+        finish a claimed job, letting the next job with its key run
+        :raises Lost_Claim: leaving the job's place in line to whoever has the job now
+        """
+        try:
+            os.remove(self._claimed_path(job_id, job['claim']))
+        except OSError:
+            raise Lost_Claim(job_id)
+        self._give_up_place(job)
+
+    def retry(self, job_id, job, error):
+        """
+        put a claimed job which failed back in its lane, or move it to failed/ after job_max_attempts
+        :param error: what went wrong, kept in the job
+        :return: False if the job was given up on
+        :raises Lost_Claim:
+        """
+        job['attempts'] = job.get('attempts', 0) + 1
+        job['error'] = error
+        given_up = job_max_attempts <= job['attempts']
+        if given_up:
+            name = os.path.join('failed', job_id + '.job')
+        else:
+            # at least a second away, so that no one claims it before it is written out below
+            delay = max(1, min(_max_retry_delay, job_retry_delay * 2 ** (job['attempts'] - 1)))
+            name = self._pending_name(time.time() + delay, job)
+        try:
+            # moved in one step, which fails if the claim is no longer this one's
+            os.rename(self._claimed_path(job_id, job['claim']), os.path.join(self._directory, name))
+        except OSError:
+            raise Lost_Claim(job_id)
+        self._write(name, job)
+        if given_up:
+            self._give_up_place(job)
+        else:
+            # keeping its place in line, so that later jobs with its key wait for it
+            self._move_place(job, name)
+        return not given_up
+
+    def requeue_failed(self):
+        """
+        give every failed job another job_max_attempts tries, after the jobs already waiting with its key
+        :return: number of jobs put back
+        """
+        failed = os.path.join(self._directory, 'failed')
+        n = 0
+        for name in os.listdir(failed):
+            if name.endswith('.job'):
+                with open(os.path.join(failed, name), 'r') as f:
+                    job = json.load(f)
+                job['attempts'] = 0
+                pending = self._pending_name(time.time(), job)
+                if job.get('key'):
+                    self._take_place(job, pending)
+                self._write(pending, job)
+                os.remove(os.path.join(failed, name))
+                n += 1
+        return n
+
+    def counts(self):
+        """
+        :return: dictionary of pending, running and failed job counts
+        """
+        return {
+            'pending': sum(self.depths().values()),
+            'running': sum(1 for name in os.listdir(self._directory) if name.endswith('.claimed')),
+            'failed': sum(1 for name in os.listdir(os.path.join(self._directory, 'failed')) if name.endswith('.job')),
+        }
+
+    def depths(self):
+        """
+        :return: dictionary of lane -> jobs waiting in it, due or not
+        """
+        return dict((lane, sum(1 for name in os.listdir(os.path.join(self._directory, lane)) if name.endswith('.job')))
+                    for lane in lane_names)
+
+    def waits(self):
+        """
+        :return: dictionary of lane -> seconds its longest-due job has been due (0 if none is)
+        """
+        now = time.time()
+        waits = dict()
+        for lane in lane_names:
+            (due, name) = self.oldest(lane)
+            waits[lane] = max(0.0, now - due) if due is not None else 0.0
+        return waits
+
+    def _recover(self):
+        """
+        put claimed jobs which have been neither finished nor saved for job_claim_timeout back in their lanes
+        """
+        cutoff = time.time() - job_claim_timeout
+        for name in os.listdir(self._directory):
+            if name.endswith('.claimed'):
+                path = os.path.join(self._directory, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        with open(path, 'r') as f:
+                            job = json.load(f)
+                        pending = self._pending_name(time.time(), job)
+                        # in one step, which fails if the executor running it finished or retried it meanwhile
+                        os.rename(path, os.path.join(self._directory, pending))
+                        self._move_place(job, pending)
+                except (IOError, OSError, ValueError):
+                    pass
+
+    def _take_place(self, job, pending):
+        """
+        put the job at the end of the line for its key
+        :param pending: name of the job's pending file
+        """
+        with _place_lock:
+            place = _last_place[0] = max(time.time(), _last_place[0] + 0.000001)
+        directory = os.path.join(self._directory, 'keys', job['key'])
+        job['place'] = '{place:017.6f}-{id}'.format(place=place, id=job['id'])
+        while True:
+            try:
+                fd = os.open(os.path.join(directory, job['place']), os.O_CREAT | os.O_WRONLY, 0o600)
+                try:
+                    os.write(fd, pending)
+                finally:
+                    os.close(fd)
+                return
+            except OSError as e:
+                if errno.ENOENT != e.errno:
+                    raise
+            try:
+                os.mkdir(directory, 0o700)
+            except OSError as e:
+                # another process made it, or removed it again after the last job in line finished; try again
+                if errno.EEXIST != e.errno:
+                    raise
+
+    def _move_place(self, job, pending):
+        """
+        record where a job with a place in line is pending now, which also marks the place as in use
+        """
+        if not job.get('place'):
+            return
+        try:
+            # never creates it: if the place is gone, it was let go of
+            fd = os.open(os.path.join(self._directory, 'keys', job['key'], job['place']), os.O_WRONLY | os.O_TRUNC)
+        except OSError:
+            return
+        try:
+            os.write(fd, pending)
+        finally:
+            os.close(fd)
+
+    def _touch_place(self, job):
+        if job.get('place'):
+            try:
+                os.utime(os.path.join(self._directory, 'keys', job['key'], job['place']), None)
+            except OSError:
+                pass
+
+    def _give_up_place(self, job):
+        if not job.get('place'):
+            return
+        directory = os.path.join(self._directory, 'keys', job['key'])
+        try:
+            os.remove(os.path.join(directory, job['place']))
+            # the last in line leaves no directory behind; fails if another job is still in line
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    def _abandoned(self, path, job_id):
+        """
+        :return: True (having removed it) if a place in line has been held for job_claim_timeout by a job which is
+                 neither pending nor running, e.g. because the process putting it died before writing the job
+        """
+        try:
+            stamp = os.path.getmtime(path)
+            if time.time() - job_claim_timeout < stamp:
+                return False
+            with open(path, 'r') as f:
+                pending = f.read()
+        except (IOError, OSError):
+            # let go of while we looked
+            return True
+        # where the place says it is pending, or running; what nearly every job waiting in a backlog is
+        if pending and os.path.exists(os.path.join(self._directory, pending)) or self._claimed(job_id):
+            return False
+        try:
+            if os.path.getmtime(path) != stamp:
+                # moved while we looked
+                return False
+        except OSError:
+            return True
+        # it may have moved without the place catching up yet, or the place is from before places said where:
+        # look everywhere. Pending, running, or pending again, since a job moves from its lane to being claimed
+        # and back while we look.
+        if self._pending(job_id) or self._claimed(job_id) or self._pending(job_id):
+            return False
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return True
+
+    def _pending(self, job_id):
+        marker = '-{id}-'.format(id=job_id)
+        return any(any(marker in name for name in os.listdir(os.path.join(self._directory, lane)))
+                   for lane in lane_names)
+
+    @staticmethod
+    def _pending_name(due, job):
+        # fixed width, so that names sort in due order
+        return os.path.join(job.get('lane', 'live'), '{due:017.6f}-{id}-{key}.job'.format(due=due, id=job['id'],
+                                                                                         key=job.get('key', '')))
+
+    def _claimed_path(self, job_id, token):
+        return os.path.join(self._directory, '{id}.{token}.claimed'.format(id=job_id, token=token))
+
+    def _claimed(self, job_id):
+        prefix = job_id + '.'
+        return any(name.startswith(prefix) and name.endswith('.claimed') for name in os.listdir(self._directory))
+
+    def _write(self, name, job):
+        path = os.path.join(self._directory, name)
+        temp = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(job, f)
+        os.rename(temp, path)
+
+
+class Executor:
+    """
+    Runs jobs from a Job_Queue on several threads, taking them lane by lane as Job_Queue.claim ranks them, but
+    only from lanes below their limit on running jobs and with some of their share of job_rate left. The limits
+    and rates are for this process.
+    """
+
+    def __init__(self, handler, queue=None, threads=None):
+        """
+        :param handler: called with (job, save) for each job, where save(job) records its progress; an exception
+                        means the job failed
+        """
+        self._handler = handler
+        self._queue = queue or Job_Queue()
+        self._threads = threads or job_threads
+        self._lock = threading.Lock()
+        self._limits = dict((name, concurrency) for (name, concurrency, share) in job_lanes)
+        self._buckets = dict((name, Token_Bucket(job_rate * share if job_rate else None, burst=concurrency))
+                             for (name, concurrency, share) in job_lanes)
+        # lane -> jobs running in this process
+        self.running = dict((name, 0) for name in lane_names)
+
+    def run(self, stopping, once=False):
+        """
+        run jobs until stopping (a threading.Event) is set; each thread finishes the job it has in hand
+        :param once: return as soon as no job is due, instead of waiting for more
+        """
+        threads = [threading.Thread(target=self._work, args=(stopping, once), name='job-executor')
+                   for i in range(self._threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # wait in short steps so that signal handlers get to run
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1.0)
+
+    def _work(self, stopping, once):
+        while not stopping.is_set():
+            _wake.clear()
+            try:
+                (job_id, job, wait) = self._claim()
+            except Exception as e:
+                # e.g. the state directory filled up; keep going and try again later
+                sys.stderr.write('Job executor: {error!r}\n'.format(error=e))
+                (job_id, job, wait) = (None, None, job_poll_interval)
+            if job_id is None:
+                if once and wait is None:
+                    return
+                _wake.wait(min(job_poll_interval, wait or job_poll_interval))
+                continue
+            try:
+                self._run(job_id, job)
+            except Exception as e:
+                # the job could not even be put back; it is run again after job_claim_timeout
+                sys.stderr.write('Job executor: {error!r}\n'.format(error=e))
+            finally:
+                with self._lock:
+                    self.running[job['lane']] -= 1
+                # its lane may have been waiting for it to finish
+                _wake.set()
+
+    def _claim(self):
+        """
+        :return: (id, job, None) of a job to run, or (None, None, seconds until a lane which has a due job may take
+                 another, or None if no lane has one)
+        """
+        with self._lock:
+            lanes = []
+            wait = None
+            for lane in lane_names:
+                if lane in _quota_priority and not InsightlyQuota.allow(_quota_priority[lane]):
+                    continue
+                if self._limits[lane] <= self.running[lane]:
+                    lane_wait = job_poll_interval
+                else:
+                    lane_wait = self._buckets[lane].wait_time()
+                if 0 == lane_wait:
+                    lanes.append(lane)
+                    continue
+                (due, name) = self._queue.oldest(lane)
+                if due is not None and due <= time.time():
+                    wait = lane_wait if wait is None else min(wait, lane_wait)
+            (job_id, job) = self._queue.claim(lanes) if lanes else (None, None)
+            if job_id is None:
+                return None, None, wait
+            self.running[job['lane']] += 1
+        self._buckets[job['lane']].take()
+        return job_id, job, None
+
+    def _run(self, job_id, job):
+        lane = job['lane']
+        try:
+            try:
+                self._handler(job, lambda progress: self._queue.save(job_id, progress))
+            except Lost_Claim:
+                raise
+            except Exception as e:
+                if self._queue.retry(job_id, job, repr(e)):
+                    Metrics.inc('landing_page_jobs_total', (('lane', lane), ('result', 'retry')))
+                else:
+                    Metrics.inc('landing_page_jobs_total', (('lane', lane), ('result', 'failed')))
+                    sys.stderr.write('Gave up on job {id} after {n} attempts: {error}\n'.format(
+                        id=job_id, n=job['attempts'], error=job['error']))
+            else:
+                self._queue.done(job_id, job)
+                Metrics.inc('landing_page_jobs_total', (('lane', lane), ('result', 'ok')))
+        except Lost_Claim:
+            # whoever has it now finishes it, and lets the next job with its key go
+            Metrics.inc('landing_page_jobs_total', (('lane', lane), ('result', 'lost')))
+            sys.stderr.write('Job {id} ran longer than job_claim_timeout and was put back in its lane\n'.format(
+                id=job_id))
+
+
+def start_executor(handler):
+    """
+    run jobs on background threads of this process, as soon as they are added here or every job_poll_interval
+    seconds. Only the first call in a process starts them (forked workers get their own).
+    :param handler: as for Executor
+    """
+    with _executor_lock:
+        if os.getpid() == _executor[0]:
+            return
+        executor = Executor(handler)
+        _executor[:] = [os.getpid(), executor]
+    thread = threading.Thread(target=executor.run, args=(threading.Event(),), name='job-executor')
+    thread.daemon = True
+    thread.start()
+
+
+def running():
+    """
+    :return: dictionary of lane -> jobs this process's executor is running
+    """
+    if _executor[0] != os.getpid():
+        return dict((lane, 0) for lane in lane_names)
+    return dict(_executor[1].running)
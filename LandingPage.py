@@ -6,14 +6,40 @@
 # Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
 
 import datetime as dt
+import os
 import smtplib
+import threading
+import time
 from email.header import Header
 from email.mime.text import MIMEText
-from InsightlyPython import insightly as Insightly
 from FreeEmailProviders import FreeEmailProviders
+from BackgroundPolicy import Background_Policy
+from Instrumentation import Instrumented_Client, current_timer, histograms, observe_cache, stage, submission, \
+    timed_call
+from Profiling import profiled
 
+import config
 from config import insightly_apikey
 
+try:
+    # form data files compiled into the bundle by build_bundle.py; forms not in it are read from forms/
+    from BundledForms import forms as bundled_forms
+except ImportError:
+    bundled_forms = {}
+
+# mail server for the notification and thank-you emails
+smtp_host = getattr(config, 'smtp_host', 'localhost')
+smtp_port = getattr(config, 'smtp_port', 25)
+# seconds that a process reuses its Insightly client (with the list of users it reads when it is created) and the
+# account owner's details before asking Insightly again; 0 asks for every submission
+insightly_connection_ttl = getattr(config, 'insightly_connection_ttl', 3600)
+# seconds a submission may take before the steps still to do which can wait are put off until after the redirect
+# (see JobQueue.py); None does every step before redirecting. A form data file can set its own latency_budget.
+latency_budget = getattr(config, 'latency_budget', None)
+# the steps which can wait; the rest (looking up the organization and upserting the contact) always run before the
+# redirect. A form data file can set its own deferrable_steps.
+deferrable_steps = getattr(config, 'deferrable_steps', ('add_note', 'notify_users', 'send_thank_you_email'))
+
 
 class Landing_Page:
     """
@@ -28,60 +54,292 @@ class Landing_Page:
     """
 
     _insightly = None
+    # callable returning an Insightly client; None means the Insightly SDK. Benchmarks use a stand-in.
+    insightly_factory = None
     _account_owner = None
     _bcc = None
 
     _form_data_directory = 'forms'
-    _form_data = None # will be a dict with elements: url, subject, message
+    _form_data = None # will be a dict with elements: url, subject, message, latency_budget, deferrable_steps
+    _form_data_cache = None # form_name -> _form_data, so that batches read each file once
+
+    # search/read results fetched ahead of do_form(), keyed by (object type, email or domain)
+    _prefetched = None
+
+    # shared by every Landing_Page in the process: (client, account owner, time connected), and
+    # form_name -> (modification time of the form data file, _form_data)
+    _connection = None
+    _connection_lock = threading.Lock()
+    _shared_form_data = {}
 
     # debugging flags
     _no_notification_mail = False
+    _no_thank_you_mail = False
 
 
-    def __init__(self, nomail=False):
-        self._insightly = Insightly.Insightly(apikey=insightly_apikey, debug=False)
-        self._account_owner = self._insightly.ownerinfo()
+    def __init__(self, nomail=False, nothankyou=False):
+        (self._insightly, self._account_owner) = self.connect()
         self._bcc = self._account_owner['email_dropbox']
         self._no_notification_mail = nomail
+        self._no_thank_you_mail = nothankyou
+        self._prefetched = {}
+        self._form_data_cache = {}
+
+
+    @classmethod
+    def connect(cls):
+        """
+        :return: (Insightly client, account owner), from the last insightly_connection_ttl seconds if possible
+        """
+        with Landing_Page._connection_lock:
+            connection = Landing_Page._connection
+        hit = connection is not None and time.time() - connection[2] < insightly_connection_ttl
+        observe_cache('insightly_connection', hit)
+        if hit:
+            return connection[:2]
+
+        factory = cls.insightly_factory
+        if factory is None:
+            from InsightlyPython import insightly as Insightly
+            factory = lambda: Insightly.Insightly(apikey=insightly_apikey, debug=False)
+        with stage('connect'):
+            # the client reads the list of users when it is created, which counts against the API quota
+            client = Instrumented_Client(timed_call('insightly', 'users', 'users', factory))
+            account_owner = client.ownerinfo()
+        with Landing_Page._connection_lock:
+            Landing_Page._connection = (client, account_owner, time.time())
+        return client, account_owner
+
+
+    @classmethod
+    def warm(cls, form_data_directory=None):
+        """
+        do the slow parts of the first submission ahead of time: connect to Insightly and read every form data
+        file. server.py calls this before it forks its workers, so that they all start with the results.
+
+        :param form_data_directory: default forms/
+        :return: names of the forms read
+        """
+        lp = cls(nomail=True, nothankyou=True)
+        directory = form_data_directory or cls._form_data_directory
+        lp._form_data_directory = directory
+        form_names = sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.txt'))
+        for form_name in form_names:
+            lp._read_form_data(form_name)
+        return form_names
 
 
-    def do_form(self, form_fields):
+    def do_form(self, form_fields, started=None):
         """
         process the form from a landing page.
         If there is a form field named "form_name" then it appears in the Note title
 
         :param form_fields: dictionary. Required elements: email, first_name, last_name
+        :param started: time.time() when the submission came in, from which the form's latency budget is counted;
+                        default now
         :return: URL of the thank-you page
         """
 
         if 'email' not in form_fields or 'first_name' not in form_fields or 'last_name' not in form_fields:
             raise KeyError('Required fields: email, first_name, last_name')
 
-        # preserve original data (for logging) and pull out some key data
-        original_form_fields = form_fields.copy()
-        email = form_fields['email']
-        del form_fields['email']
-        form_name = form_fields['form_name']
-        del form_fields['form_name']
+        with profiled('do_form') as run, submission(form_fields.get('form_name')) as timer:
+            if timer is not None:
+                run.name = timer.id
+            email = form_fields['email']
+            with stage('read_form_data'):
+                self._read_form_data(form_fields['form_name'])
+            deadline = None
+            if self._form_data['latency_budget'] is not None:
+                deadline = (started or time.time()) + self._form_data['latency_budget']
+            organization = self.organization_for(email, form_fields)
+            return self.do_forms(email, [form_fields], organization, deadline)[0]
 
-        self._read_form_data(form_name)
 
-        # do not set up organizations for free email accounts
-        (username, domain) = email.split('@')
-        if FreeEmailProviders.is_free(domain):
-            organization = None
+    def do_forms(self, email, forms, organization, deadline=None):
+        """
+        process several forms submitted with the same email address, e.g. rows of a batch import:
+        one contact upsert with the fields of all the forms merged (later forms win), a note for each form,
+        and one notification and thank-you email for each distinct form name.
+
+        Once the deadline has passed, or the next step would usually take longer than the time left, the form's
+        deferrable steps which are still to do are saved in the job queue, in order, and run after the
+        thank-you page URL has been returned. Steps which are not deferrable always run here.
+
+        :param email: the contact's email address
+        :param forms: list of form field dictionaries, oldest first. Required elements: first_name, last_name,
+                      form_name. The dictionaries are not modified.
+        :param organization: from organization_for()
+        :param deadline: time.time() by which to return; None runs every step here
+        :return: list of thank-you page URLs, one for each form
+        """
+        values = dict()
+        for form_fields in forms:
+            if 'first_name' not in form_fields or 'last_name' not in form_fields:
+                raise KeyError('Required fields: email, first_name, last_name')
+            # fail on a bad form data file before changing anything in Insightly
+            with stage('read_form_data'):
+                self._read_form_data(form_fields['form_name'])
+            values.update(form_fields)
+        values.pop('email', None)
+        del values['form_name']
+
+        with stage('upsert_contact'):
+            contact = self._upsert_contact(email, values, organization)
+
+        urls = []
+        form_names = []
+        steps = []
+        for form_fields in forms:
+            form_name = form_fields['form_name']
+            steps.append({'step': 'add_note', 'form_name': form_name, 'form_fields': form_fields})
+            self._read_form_data(form_name)
+            urls.append(self._form_data['url'])
+            if form_name not in form_names:
+                form_names.append(form_name)
+        for form_name in form_names:
+            steps.append({'step': 'notify_users', 'form_name': form_name})
+            steps.append({'step': 'send_thank_you_email', 'form_name': form_name})
+
+        deferred = []
+        for step in steps:
+            self._read_form_data(step['form_name'])
+            if step['step'] in self._form_data['deferrable_steps'] and (deferred or self._out_of_time(step, deadline)):
+                deferred.append(step)
+                continue
+            with stage(step['step']):
+                self._run_step(step, contact, email)
+
+        if deferred:
+            self._defer(deferred, contact, email)
+        return urls
+
+
+    @staticmethod
+    def _out_of_time(step, deadline):
+        """
+        :return: True if the deadline has passed, or will have by the time the step usually finishes
+        """
+        if deadline is None:
+            return False
+        # looked up rather than created: an empty histogram would show up in reports
+        timings = histograms().get('stage.' + step['step'])
+        usual = (timings.percentile(50) if timings is not None else None) or 0.0
+        return deadline < time.time() + usual
+
+
+    def _run_step(self, step, contact, email):
+        """
+        :param step: dictionary with elements step, form_name and, for add_note, form_fields; the form's data must
+                     have been read
+        """
+        if 'add_note' == step['step']:
+            self._add_note(contact['CONTACT_ID'], step['form_name'], step['form_fields'])
+        elif 'notify_users' == step['step']:
+            self._notify_users(contact, step['form_name'])
+        elif 'send_thank_you_email' == step['step']:
+            self._send_thank_you_email(contact, email)
         else:
-            organization = self._get_organization(email, form_fields)
+            raise ValueError('Unknown step ' + step['step'])
 
-        contact = self._upsert_contact(email, form_fields, organization)
 
-        note = self._add_note(contact['CONTACT_ID'], form_name, original_form_fields)
+    def _defer(self, steps, contact, email):
+        """
+        save steps in the job queue to run after the response has been sent; if they can't be saved, run them now
+        """
+        import JobQueue
+        timer = current_timer()
+        job = {
+            'steps': steps,
+            'contact': contact,
+            'email': email,
+            'nomail': self._no_notification_mail,
+            'nothankyou': self._no_thank_you_mail,
+            'form_data_directory': self._form_data_directory,
+            'submission_id': timer.id if timer is not None else None,
+        }
+        try:
+            with stage('defer'):
+                # no key: the contact has already been upserted, and notes and mail can't conflict with anything
+                JobQueue.Job_Queue().put(job)
+        except (IOError, OSError):
+            for step in steps:
+                self._read_form_data(step['form_name'])
+                with stage(step['step']):
+                    self._run_step(step, contact, email)
+
+
+    @classmethod
+    def run_job(cls, job, save):
+        """
+        the JobQueue handler: run the steps of a submission put off by do_forms(), or leads queued by
+        import_leads.py (a job with rows)
+        :param job: saved by _defer(), or with rows: list of [row number, form fields] of one Batch_Planner group
+        :param save: called with the job after each step, or each email address of rows, so that a retry doesn't
+                     repeat the work already done
+        """
+        lp = cls(nomail=job['nomail'], nothankyou=job['nothankyou'])
+        lp._form_data_directory = job.get('form_data_directory', cls._form_data_directory)
+        if 'rows' in job:
+            from BatchPlanner import Batch_Planner
+            rows = job['rows']
+
+            def progress(results):
+                # saving also keeps the claim fresh, so that a long group is not taken for abandoned and run twice
+                job['rows'] = [row for row in rows if row[0] not in results or isinstance(results[row[0]], Exception)]
+                save(job)
+
+            results = Batch_Planner().run_group(lp, [tuple(row) for row in rows], progress)
+            failed = [row for row in rows if isinstance(results[row[0]], Exception)]
+            if failed:
+                # a retry only does the rows which failed
+                job['rows'] = failed
+                raise results[failed[0][0]]
+            return
+        with submission(job['steps'][0]['form_name']) as timer:
+            if timer is not None and job.get('submission_id'):
+                # logged under the same correlation ID as the submission the steps belong to
+                timer.id = job['submission_id']
+            while job['steps']:
+                step = job['steps'][0]
+                lp._read_form_data(step['form_name'])
+                with stage(step['step']):
+                    lp._run_step(step, job['contact'], job['email'])
+                del job['steps'][0]
+                if job['steps']:
+                    save(job)
+
+
+    def organization_for(self, email, form_fields):
+        """
+        :param email: contact's email address
+        :param form_fields: dictionary; the company element, if any, names a new organization
+        :return: the organization for the email's domain, created if need be, or None for free email accounts
+        """
+        # do not set up organizations for free email accounts
+        (username, domain) = email.split('@')
+        if FreeEmailProviders.is_free(domain):
+            return None
+        with stage('get_organization'):
+            return self._get_organization(email, form_fields)
 
-        self._notify_users(contact, form_name)
 
-        self._send_thank_you_email(contact, email)
+    def prefetch(self, form_fields):
+        """
+        Speculatively look up the organization and contact for a submission which has not been accepted yet,
+        e.g. while its reCAPTCHA token is still being verified. Only searches and reads are done, so if the
+        submission is rejected the results are simply thrown away along with this object.
+        do_form() uses the results instead of repeating the lookups.
 
-        return self._form_data['url']
+        :param form_fields: dictionary. Required element: email
+        :return: None
+        """
+        email = form_fields['email']
+        (username, domain) = email.split('@')
+        with stage('prefetch'):
+            if not FreeEmailProviders.is_free(domain):
+                self._prefetched[('Organisations', domain)] = self._search_organizations(domain)
+            self._prefetched[('contacts', email)] = self._read_contacts(email)
 
 
     def _add_note(self, contact_id, form_name, original_form_fields):
@@ -111,7 +369,7 @@ class Landing_Page:
         :return: organization
         """
         (username, domain) = email.split('@')
-        organization = self._insightly.search('Organisations', 'email_domain={domain}'.format(domain=domain))
+        organization = self._search_organizations(domain)
 
         if 0 == len(organization):
             # organisation does not exist; create it
@@ -135,6 +393,52 @@ class Landing_Page:
             organization = organization[0]
         return organization
 
+    @staticmethod
+    def _contact_changes(contact, wanted):
+        """
+        compare the wanted state of a contact with the contact as it is in Insightly.
+        Contact infos, tags and links which already exist are merged locally rather than sent as duplicates.
+        A PUT to Insightly v2.1 replaces the whole contact, so anything left out of it, child collections
+        included, would be cleared: when something changed, the update is the contact as read with the
+        changes applied.
+        :param contact: existing contact, as read from Insightly
+        :param wanted: object graph built from the form
+        :return: object graph for update(), or None if nothing changed
+        """
+        changes = {}
+        for field in ('FIRST_NAME', 'LAST_NAME', 'BACKGROUND'):
+            if field in wanted and wanted[field] != contact.get(field):
+                changes[field] = wanted[field]
+
+        for (collection, key_fields) in (('CONTACTINFOS', ('TYPE', 'DETAIL')),
+                                         ('TAGS', ('TAG_NAME',)),
+                                         ('LINKS', ('ORGANISATION_ID',))):
+            existing = contact.get(collection) or []
+            keys = set(Landing_Page._child_key(child, key_fields) for child in existing)
+            added = [child for child in wanted.get(collection, [])
+                     if Landing_Page._child_key(child, key_fields) not in keys]
+            if added:
+                changes[collection] = existing + added
+
+        if 0 == len(changes):
+            return None
+        update = dict(contact)
+        update.update(changes)
+        return update
+
+    @staticmethod
+    def _child_key(child, key_fields):
+        """
+        identity of a contact info, tag or link, ignoring case
+        """
+        key = []
+        for field in key_fields:
+            value = child.get(field)
+            if isinstance(value, basestring):
+                value = value.strip().lower()
+            key.append(value)
+        return tuple(key)
+
     def _notify_error(self, message):
         """
         notify all Insightly users about an error
@@ -149,10 +453,8 @@ class Landing_Page:
         msg['From'] = self._account_owner['email']
         msg['To'] = ', '.join(to_list)
         msg['Subject'] = 'Landing page error'
-        s = smtplib.SMTP('localhost')
         if not self._no_notification_mail:
-            s.sendmail(msg['From'], to_list, msg.as_string())
-        s.quit()
+            self._send_mail(msg, to_list)
 
     def _notify_users(self, contact, form_name):
         """
@@ -180,14 +482,31 @@ class Landing_Page:
                                                                                     last_name=contact['LAST_NAME']),
                    'utf-8')
         msg['Subject'] = subject
-        s = smtplib.SMTP('localhost')
         if not self._no_notification_mail:
-            s.sendmail(msg['From'], to_list, msg.as_string())
-        s.quit()
+            self._send_mail(msg, to_list)
 
     def _read_form_data(self, form_name):
         # get data about the form
+        hit = form_name in self._form_data_cache
+        observe_cache('form_data', hit)
+        if hit:
+            self._form_data = self._form_data_cache[form_name]
+            return
+        if form_name in bundled_forms:
+            self._form_data = self._make_form_data(**bundled_forms[form_name])
+            self._form_data_cache[form_name] = self._form_data
+            return
         filename = '{directory}/{basename}.txt'.format(directory=self._form_data_directory, basename=form_name)
+        # read by another Landing_Page in this process, and not changed since
+        try:
+            modified = os.path.getmtime(filename)
+        except OSError:
+            # open() says what is wrong
+            modified = None
+        shared = Landing_Page._shared_form_data.get(filename)
+        if shared is not None and modified is not None and shared[0] == modified:
+            self._form_data = self._form_data_cache[form_name] = shared[1]
+            return
         with open(filename, 'r') as f:
             raw_form_data = f.read()
         try:
@@ -195,11 +514,12 @@ class Landing_Page:
             # url contains the thank-you page URL
             # subject contains the email subject template
             # message contains the email message template
-            self._form_data = {
-                'url': unicode(url.strip()),
-                'subject': self.unicode_or_none(subject),
-                'message': self.unicode_or_none(message),
-            }
+            # latency_budget and deferrable_steps, if set, override config.py's for this form
+            self._form_data = self._make_form_data(url, subject, message,
+                                                   locals().get('latency_budget', latency_budget),
+                                                   locals().get('deferrable_steps', deferrable_steps))
+            self._form_data_cache[form_name] = self._form_data
+            Landing_Page._shared_form_data[filename] = (modified, self._form_data)
         except SyntaxError as se:
             message = 'Syntax error in file {file}, line {line}, offset {offset}\n{msg}'.format(file=filename,
                                                                                                 line=se.lineno,
@@ -214,6 +534,30 @@ class Landing_Page:
         return
 
 
+    def _read_contacts(self, email):
+        """
+        :param email:
+        :return: list of (at most 2) contacts with this email address
+        """
+        hit = ('contacts', email) in self._prefetched
+        observe_cache('prefetch', hit)
+        if hit:
+            return self._prefetched.pop(('contacts', email))
+        return self._insightly.read('contacts', top=2, filters={'email': email})
+
+
+    def _search_organizations(self, domain):
+        """
+        :param domain: email domain
+        :return: list of organizations with this email domain
+        """
+        hit = ('Organisations', domain) in self._prefetched
+        observe_cache('prefetch', hit)
+        if hit:
+            return self._prefetched.pop(('Organisations', domain))
+        return self._insightly.search('Organisations', 'email_domain={domain}'.format(domain=domain))
+
+
     def _send_thank_you_email(self, contact, contact_email):
         """
         Send a thank-you email to the contact
@@ -221,7 +565,7 @@ class Landing_Page:
         :param contact:
         """
 
-        if self._form_data['message'] is None or self._form_data['subject'] is None:
+        if self._form_data['message'] is None or self._form_data['subject'] is None or self._no_thank_you_mail:
             return
 
         message = self._form_data['message'].strip().format(first_name=contact['FIRST_NAME'],
@@ -242,11 +586,36 @@ class Landing_Page:
         msg['To'] = '{name} <{address}>'.format(name=to_name, address=contact_email)
 
         msg['Subject'] = self._form_data['subject'].strip().format(first_name=contact['FIRST_NAME'])
-        s = smtplib.SMTP('localhost')
-        s.sendmail(msg['From'], to_list, msg.as_string())
+        self._send_mail(msg, to_list)
         return
 
 
+    @staticmethod
+    def _send_mail(msg, to_list):
+        """
+        send a message through the local mail server
+        :param msg: MIMEText with its From header set
+        :param to_list: envelope recipients
+        :return: None
+        """
+        def send():
+            s = smtplib.SMTP(smtp_host, smtp_port)
+            s.sendmail(msg['From'], to_list, msg.as_string())
+            s.quit()
+        timed_call('smtp', 'sendmail', smtp_host, send)
+
+
+    @staticmethod
+    def _make_form_data(url, subject, message, latency_budget=latency_budget, deferrable_steps=deferrable_steps):
+        return {
+            'url': unicode(url.strip()),
+            'subject': Landing_Page.unicode_or_none(subject),
+            'message': Landing_Page.unicode_or_none(message),
+            'latency_budget': latency_budget,
+            'deferrable_steps': frozenset(deferrable_steps),
+        }
+
+
     @staticmethod
     def unicode_or_none(string):
         if string is not None:
@@ -261,7 +630,7 @@ class Landing_Page:
         :param values: other values for the contact
         :return: contact
         """
-        contacts = self._insightly.read('contacts', top=2, filters={'email': email})
+        contacts = self._read_contacts(email)
         contactinfos = [
             {
                 'TYPE': 'EMAIL',
@@ -304,30 +673,24 @@ class Landing_Page:
                 }
             ]
 
-        # construct a "background" string of any remaining values
+        # any remaining values go into the contact's "background"
         del values['first_name']
         del values['last_name']
-        kv_pairs = []
-        for key in values.keys():
-            kv_pairs.append('%s: %s' % (key, values[key]))
-        if 0 < len(kv_pairs):
-            background = '\n'.join(kv_pairs)
-        else:
-            background = None
 
         if 1 == len(contacts):
-            # the contacts already exists; update it
+            # the contacts already exists; update it, sending only what has changed
             contact = contacts[0]
-            object_graph['CONTACT_ID'] = contact['CONTACT_ID']
+            background = Background_Policy().merge(contact['BACKGROUND'], values)
             if background is not None:
-                if contact['BACKGROUND'] is not None:
-                    object_graph['BACKGROUND'] = contact['BACKGROUND'] + '\n' + background
-                else:
-                    object_graph['BACKGROUND'] = background
-            return self._insightly.update('contacts', object_graph, id=contact['CONTACT_ID'])
+                object_graph['BACKGROUND'] = background
+            changes = self._contact_changes(contact, object_graph)
+            if changes is None:
+                # nothing new was submitted; skip the update
+                return contact
+            return self._insightly.update('contacts', changes, id=contact['CONTACT_ID'])
         else:
             # either the contact does not exist or there is more than one (ambiguous match) so create a new contact
-            object_graph['BACKGROUND'] = background
+            object_graph['BACKGROUND'] = Background_Policy().merge(None, values)
             return self._insightly.create('contacts', object_graph)
 
 
@@ -0,0 +1,194 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import collections
+import threading
+import time
+
+import config
+import Instrumentation
+
+# seconds of history behind the health check and the submissions-per-second gauge
+health_window = getattr(config, 'health_window', 300)
+# a service with less than this fraction of successful calls in the window is reported as down
+health_min_availability = getattr(config, 'health_min_availability', 0.9)
+
+_lock = threading.Lock()
+_counters = dict()
+_submissions = collections.deque()
+_calls = dict()
+
+# name -> callable returning a number, or a dictionary of label tuple -> number. Add to this to expose more gauges,
+# e.g. gauges['landing_page_queue_depth'] = queue.qsize
+gauges = dict()
+
+_help = {
+    'landing_page_submissions_total': 'Submissions processed, by outcome',
+    'landing_page_submissions_per_second': 'Submissions per second over the health window',
+    'landing_page_upstream_calls_total': 'Calls to Insightly, SMTP and reCAPTCHA, by service and result',
+    'landing_page_upstream_in_flight': 'Calls to Insightly, SMTP and reCAPTCHA in progress',
+    'landing_page_cache_lookups_total': 'Cache lookups, by cache and result',
+    'landing_page_submission_seconds': 'Time spent on each submission',
+    'landing_page_stage_seconds': 'Time spent in each stage of a submission',
+    'landing_page_job_wait_seconds': 'Time background jobs waited to start once due, by lane',
+    'landing_page_limit_wait_seconds': 'Time calls waited for a turn under the adaptive concurrency limits',
+}
+
+# Instrumentation histogram name, or prefix of names -> (metric, label taking the rest of the name)
+_histogram_metrics = (
+    ('submission', 'landing_page_submission_seconds', None),
+    ('stage.', 'landing_page_stage_seconds', 'stage'),
+    ('job_wait.', 'landing_page_job_wait_seconds', 'lane'),
+    ('limit_wait.', 'landing_page_limit_wait_seconds', 'service'),
+)
+
+
+def inc(name, labels=(), amount=1):
+    """
+    add to a counter
+    :param name: metric name
+    :param labels: tuple of (label, value) pairs
+    """
+    with _lock:
+        _counters[(name, labels)] = _counters.get((name, labels), 0) + amount
+
+
+def _on_call(service, method, endpoint, duration, status, nbytes):
+    ok = status in ('ok', '200')
+    inc('landing_page_upstream_calls_total', (('service', service), ('result', 'ok' if ok else 'error')))
+    now = time.time()
+    with _lock:
+        calls = _calls.setdefault(service, collections.deque())
+        calls.append((now, duration, ok))
+        _expire(calls, now)
+
+
+def _on_cache(cache, hit):
+    inc('landing_page_cache_lookups_total', (('cache', cache), ('result', 'hit' if hit else 'miss')))
+
+
+def _on_submission(record):
+    inc('landing_page_submissions_total', (('outcome', record['outcome']),))
+    now = time.time()
+    with _lock:
+        _submissions.append(now)
+        while _submissions and _submissions[0] < now - health_window:
+            _submissions.popleft()
+
+
+def _expire(calls, now):
+    while calls and calls[0][0] < now - health_window:
+        calls.popleft()
+
+
+def install():
+    """
+    start collecting metrics in this process
+    """
+    if _on_call not in Instrumentation.observers:
+        Instrumentation.observers.append(_on_call)
+        Instrumentation.cache_observers.append(_on_cache)
+        Instrumentation.submission_observers.append(_on_submission)
+
+
+def health():
+    """
+    recent latency and availability of Insightly, SMTP and reCAPTCHA
+    :return: (True if nothing is down, dictionary suitable for JSON)
+    """
+    now = time.time()
+    services = dict()
+    healthy = True
+    with _lock:
+        for service in ('insightly', 'smtp', 'recaptcha'):
+            calls = _calls.get(service, collections.deque())
+            _expire(calls, now)
+            if 0 == len(calls):
+                services[service] = {'status': 'unknown', 'calls': 0}
+                continue
+            durations = sorted(duration for (stamp, duration, ok) in calls)
+            availability = float(sum(1 for (stamp, duration, ok) in calls if ok)) / len(calls)
+            status = 'ok' if health_min_availability <= availability else 'down'
+            healthy = healthy and 'ok' == status
+            services[service] = {
+                'status': status,
+                'calls': len(calls),
+                'availability': availability,
+                'p50': durations[len(durations) // 2],
+                'p99': durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+            }
+    return healthy, {'status': 'ok' if healthy else 'degraded', 'window': health_window, 'services': services}
+
+
+def prometheus():
+    """
+    :return: every metric, in the Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        rate = len(_submissions) / float(health_window)
+
+    for name in sorted(set(name for (name, labels) in counters)):
+        _header(lines, name, 'counter')
+        for ((metric, labels), value) in sorted(counters.items()):
+            if metric == name:
+                lines.append(_sample(name, labels, value))
+
+    _header(lines, 'landing_page_submissions_per_second', 'gauge')
+    lines.append(_sample('landing_page_submissions_per_second', (), rate))
+
+    _header(lines, 'landing_page_upstream_in_flight', 'gauge')
+    for (service, value) in sorted(Instrumentation.in_flight.items()):
+        lines.append(_sample('landing_page_upstream_in_flight', (('service', service),), value))
+
+    for (name, gauge) in sorted(gauges.items()):
+        _header(lines, name, 'gauge')
+        value = gauge()
+        if isinstance(value, dict):
+            for (labels, v) in sorted(value.items()):
+                lines.append(_sample(name, labels, v))
+        else:
+            lines.append(_sample(name, (), value))
+
+    histograms = sorted(Instrumentation.histograms().items())
+    for (prefix, metric, label) in _histogram_metrics:
+        _header(lines, metric, 'histogram')
+        for (name, h) in histograms:
+            if label is None and name == prefix:
+                _histogram(lines, metric, (), h)
+            elif label is not None and name.startswith(prefix):
+                _histogram(lines, metric, ((label, name[len(prefix):]),), h)
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram(lines, name, labels, h):
+    # every third bucket boundary is plenty for dashboards
+    bounds = Instrumentation.Histogram.bounds[::3]
+    counts = list(h.counts)
+    cumulative = 0
+    next_bucket = 0
+    for bound in bounds:
+        while next_bucket < len(Instrumentation.Histogram.bounds) and \
+                Instrumentation.Histogram.bounds[next_bucket] <= bound:
+            cumulative += counts[next_bucket]
+            next_bucket += 1
+        lines.append(_sample(name + '_bucket', labels + (('le', '%g' % bound),), cumulative))
+    lines.append(_sample(name + '_bucket', labels + (('le', '+Inf'),), h.count))
+    lines.append(_sample(name + '_sum', labels, h.sum))
+    lines.append(_sample(name + '_count', labels, h.count))
+
+
+def _header(lines, name, kind):
+    if name in _help:
+        lines.append('# HELP {name} {help}'.format(name=name, help=_help[name]))
+    lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(label, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                               for (label, v) in labels) + '}'
+    return '{name} {value}'.format(name=name, value=repr(float(value)) if isinstance(value, float) else value)
@@ -0,0 +1,279 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Pre-fork worker pool for server.py.
+
+The parent process warms up once (imports, Insightly connection, form data) and then forks workers, which share
+what it loaded copy-on-write and take connections from the same listening socket, each with prefork_threads
+threads. A worker is replaced once it has served prefork_max_requests requests or grown past prefork_max_memory.
+The number of workers stays between the minimum and maximum and follows the queue of connections waiting to be
+accepted: a queue adds workers, and a worker's worth of idle threads for prefork_idle_time seconds removes one.
+"""
+
+import atexit
+import errno
+import gc
+import mmap
+import os
+import random
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+import config
+
+# workers to start with and never go below; 0 runs server.py as one multi-threaded process instead
+prefork_workers = getattr(config, 'prefork_workers', 0)
+# most workers to grow to when connections queue up; None for twice prefork_workers
+prefork_max_workers = getattr(config, 'prefork_max_workers', None)
+# requests each worker handles at once
+prefork_threads = getattr(config, 'prefork_threads', 4)
+# replace a worker after this many requests (give or take 10%, so they don't all go at once), or when it uses more
+# than this many MB; None for no limit
+prefork_max_requests = getattr(config, 'prefork_max_requests', 1000)
+prefork_max_memory = getattr(config, 'prefork_max_memory', 256)
+# seconds a worker's worth of threads must be idle before a worker above the minimum is stopped
+prefork_idle_time = getattr(config, 'prefork_idle_time', 30)
+
+# seconds between the parent's looks at the queue and the workers, and between workers' checks for a stop signal
+_check_interval = 1.0
+# seconds stopping workers get to finish their requests before they are killed
+_stop_timeout = 30
+
+
+def accept_queue(listener):
+    """
+    :param listener: listening TCP socket
+    :return: connections waiting to be accepted, or None if the operating system doesn't say (Linux does)
+    """
+    if not sys.platform.startswith('linux') or not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = listener.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except socket.error:
+        return None
+    # struct tcp_info: eight one-byte fields, then tcpi_rto, tcpi_ato, tcpi_snd_mss, tcpi_rcv_mss and tcpi_unacked,
+    # which for a listening socket is the length of the accept queue
+    return struct.unpack_from('=8B5I', info)[-1]
+
+
+def resident_memory():
+    """
+    :return: bytes of memory this process is using, or None if it can't be told
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Pool:
+    """
+    Runs a SocketServer server in forked worker processes. The server must be bound and listening, and must not
+    use ThreadingMixIn or ForkingMixIn: the pool does the threading and forking.
+    """
+
+    def __init__(self, server, workers=None, max_workers=None, threads=None, max_requests=None, max_memory=None,
+                 worker_init=None):
+        """
+        :param worker_init: called in each worker once it has been forked, e.g. to start background threads, which
+                            do not survive fork()
+        """
+        self.server = server
+        self.worker_init = worker_init
+        self.workers = workers or prefork_workers or 1
+        self.max_workers = max(self.workers, max_workers or prefork_max_workers or 2 * self.workers)
+        self.threads = threads or prefork_threads
+        self.max_requests = prefork_max_requests if max_requests is None else max_requests
+        self.max_memory = prefork_max_memory if max_memory is None else max_memory
+        # replacements for workers which reached max_requests or max_memory
+        self.recycled = 0
+        # shared with the workers: byte 0 is the number of workers, byte 1 + slot the busy threads in a worker
+        self._board = mmap.mmap(-1, 1 + self.max_workers)
+        self._slots = dict()
+        self._stopping = set()
+        self._target = self.workers
+        self._idle_since = None
+        self._shutdown = False
+
+    def worker_count(self):
+        return ord(self._board[0])
+
+    def busy_threads(self):
+        return sum(ord(b) for b in self._board[1:])
+
+    def serve_forever(self, warm=None):
+        """
+        :param warm: called once, before the first worker is forked
+        """
+        if warm is not None:
+            warm()
+        gc.collect()
+        # workers wait for connections with select() and must not block in accept() when another one wins
+        self.server.socket.setblocking(False)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        while not self._shutdown:
+            self._reap()
+            self._scale()
+            time.sleep(_check_interval)
+        self._stop_all()
+
+    def _on_stop(self, signum, frame):
+        self._shutdown = True
+
+    def _reap(self):
+        while self._slots:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if errno.ECHILD == e.errno:
+                    break
+                raise
+            if 0 == pid:
+                break
+            for (slot, worker) in self._slots.items():
+                if worker == pid:
+                    del self._slots[slot]
+                    self._board[1 + slot] = '\0'
+            if pid in self._stopping:
+                self._stopping.discard(pid)
+            elif os.WIFEXITED(status) and 0 == os.WEXITSTATUS(status):
+                self.recycled += 1
+            else:
+                sys.stderr.write('Worker {pid} died with status {status}\n'.format(pid=pid, status=status))
+
+    def _scale(self):
+        running = len(self._slots) - len(self._stopping)
+        capacity = running * self.threads
+        busy = self.busy_threads()
+        queue = accept_queue(self.server.socket)
+        if queue is None:
+            # no queue to look at; when every thread is busy there soon will be one
+            queue = 1 if capacity <= busy else 0
+        now = time.time()
+        if 0 < queue:
+            wanted = running + (queue + self.threads - 1) // self.threads
+            self._target = min(self.max_workers, max(self._target, wanted))
+            self._idle_since = None
+        elif busy <= capacity - self.threads and self.workers < self._target:
+            if self._idle_since is None:
+                self._idle_since = now
+            elif prefork_idle_time <= now - self._idle_since:
+                self._target -= 1
+                self._idle_since = now
+        else:
+            self._idle_since = None
+
+        while running < self._target:
+            self._spawn()
+            running += 1
+        if self._target < running:
+            # the newest worker, so that long-lived ones (and their warm caches) stay
+            slot = max(slot for (slot, pid) in self._slots.items() if pid not in self._stopping)
+            self._stop(self._slots[slot])
+        self._board[0] = chr(min(255, running))
+
+    def _spawn(self):
+        slot = min(set(range(self.max_workers)) - set(self._slots))
+        self._board[1 + slot] = '\0'
+        pid = os.fork()
+        if 0 == pid:
+            status = 1
+            try:
+                status = self._work(slot)
+                # what sys.exit() would do; a worker must never return into the parent's loop
+                atexit._run_exitfuncs()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        self._slots[slot] = pid
+
+    def _stop(self, pid):
+        self._stopping.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _stop_all(self):
+        for pid in self._slots.values():
+            self._stop(pid)
+        deadline = time.time() + _stop_timeout
+        while self._slots and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self._slots.values():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _work(self, slot):
+        """
+        run in a worker process until told to stop or due for replacement
+        :return: exit status
+        """
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        # Ctrl-C reaches every process in the group; the parent stops the workers itself
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # forked workers would otherwise all pick the same "random" numbers
+        random.seed()
+        if self.worker_init is not None:
+            self.worker_init()
+        lock = threading.Lock()
+        served = [0]
+        limit = None
+        if self.max_requests:
+            limit = int(self.max_requests * random.uniform(0.9, 1.1))
+
+        def serve():
+            server = self.server
+            while not stopping.is_set():
+                try:
+                    (readable, writable, errors) = select.select([server.socket], [], [], _check_interval)
+                except select.error:
+                    continue
+                if not readable:
+                    continue
+                try:
+                    (request, client_address) = server.get_request()
+                except socket.error:
+                    # another thread or worker accepted it first
+                    continue
+                with lock:
+                    self._board[1 + slot] = chr(ord(self._board[1 + slot]) + 1)
+                try:
+                    server.process_request(request, client_address)
+                except Exception:
+                    server.handle_error(request, client_address)
+                    server.shutdown_request(request)
+                finally:
+                    with lock:
+                        self._board[1 + slot] = chr(ord(self._board[1 + slot]) - 1)
+                        served[0] += 1
+                        due = limit is not None and limit <= served[0]
+                memory = resident_memory() if self.max_memory else None
+                if due or (memory is not None and self.max_memory * 2 ** 20 < memory):
+                    stopping.set()
+
+        threads = [threading.Thread(target=serve) for i in range(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # wait in short steps so that the SIGTERM handler gets to run
+        while not stopping.is_set():
+            stopping.wait(_check_interval)
+        for thread in threads:
+            thread.join()
+        return 0
@@ -0,0 +1,274 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Profile individual submissions, on demand.
+
+A request is profiled when profile_enabled is set, when it is picked by profile_sample_rate, or when it carries
+an X-Profile header signed with profile_secret. Each profile goes into its own file in profile_directory; only
+the newest profile_keep files are kept. Summarize them with
+
+    python Profiling.py [--top 30] [--sort cumulative] /var/tmp/landing-page/profiles
+
+and make a header for profiling one request with
+
+    python Profiling.py --sign
+"""
+
+import cProfile
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+from SharedTable import state_path
+
+# profile every request; only for debugging, it slows everything down
+profile_enabled = getattr(config, 'profile_enabled', False)
+# fraction of requests to profile, e.g. 0.01
+profile_sample_rate = getattr(config, 'profile_sample_rate', 0.0)
+# key for signing X-Profile headers; None turns the header off
+profile_secret = getattr(config, 'profile_secret', None)
+# 'deterministic' (cProfile: every call, exact counts, more overhead) or
+# 'sampling' (the stack every profile_interval seconds: cheap, statistical)
+profile_mode = getattr(config, 'profile_mode', 'deterministic')
+profile_interval = getattr(config, 'profile_interval', 0.005)
+# where profiles go, and how many to keep
+profile_directory = getattr(config, 'profile_directory', None)
+profile_keep = getattr(config, 'profile_keep', 200)
+
+# how old a signed header may be, in seconds
+_header_max_age = 300
+
+_local = threading.local()
+
+
+def sign(timestamp=None, secret=None):
+    """
+    :return: value for an X-Profile header, good for a few minutes
+    """
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    secret = profile_secret if secret is None else secret
+    return timestamp + ':' + hmac.new(str(secret), timestamp, hashlib.sha256).hexdigest()
+
+
+def _signed(header):
+    if profile_secret is None or not header or ':' not in header:
+        return False
+    (timestamp, signature) = header.split(':', 1)
+    try:
+        if _header_max_age < abs(time.time() - int(timestamp)):
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(sign(timestamp).split(':', 1)[1], str(signature))
+
+
+def wanted(header=None):
+    """
+    :param header: the request's X-Profile header, if any
+    :return: True if this request should be profiled
+    """
+    return profile_enabled or random.random() < profile_sample_rate or _signed(header)
+
+
+class _Sampler:
+    """
+    Records the stack of one thread every interval seconds, from a background thread
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._ident = threading.current_thread().ident
+        self._stop = threading.Event()
+        self.stacks = dict()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{file}:{line}({name})'.format(file=os.path.basename(code.co_filename),
+                                                           line=code.co_firstlineno, name=code.co_name))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            for (stack, count) in sorted(self.stacks.items()):
+                f.write('{stack} {count}\n'.format(stack=stack, count=count))
+
+
+class Profile_Run:
+    """
+    what profiled() yields; set name to something that identifies the request, e.g. its correlation ID
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.name = None
+        self.filename = None
+
+
+@contextmanager
+def profiled(label, header=None):
+    """
+    profile the block if this request is wanted(); nested blocks in the same thread go with the outer block,
+    whether that is profiled or not, so that they are not sampled again
+    :param label: goes into the file name, e.g. 'lp' or 'do_form'
+    :param header: the request's X-Profile header, if any
+    """
+    run = Profile_Run(label)
+    if getattr(_local, 'active', None) is not None:
+        yield run
+        return
+
+    profiler = None
+    if wanted(header):
+        profiler = _Sampler(profile_interval) if 'sampling' == profile_mode else cProfile.Profile()
+    # True while a profiled block runs in this thread, False while one which was not picked runs
+    _local.active = profiler is not None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield run
+    finally:
+        _local.active = None
+        if profiler is not None:
+            profiler.disable()
+            try:
+                run.filename = _save(profiler, run)
+            except (IOError, OSError):
+                # profiling must never take the landing page down
+                pass
+
+
+def _directory():
+    directory = profile_directory if profile_directory is not None else state_path('profiles')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            pass
+    return directory
+
+
+def _save(profiler, run):
+    directory = _directory()
+    filename = os.path.join(directory, '{stamp}-{pid}-{label}{name}.{extension}'.format(
+        stamp=time.strftime('%Y%m%d-%H%M%S'), pid=os.getpid(), label=run.label,
+        name='' if run.name is None else '-' + run.name,
+        extension='stacks' if isinstance(profiler, _Sampler) else 'prof'))
+    profiler.dump(filename) if isinstance(profiler, _Sampler) else profiler.dump_stats(filename)
+    _expire(directory)
+    return filename
+
+
+def _expire(directory):
+    """
+    delete all but the newest profile_keep profiles
+    """
+    profiles = []
+    for name in os.listdir(directory):
+        if name.endswith('.prof') or name.endswith('.stacks'):
+            path = os.path.join(directory, name)
+            try:
+                profiles.append((os.path.getmtime(path), path))
+            except OSError:
+                # another process removed it
+                pass
+    profiles.sort()
+    for (mtime, path) in profiles[:max(0, len(profiles) - profile_keep)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _profile_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+    return [f for f in files if f.endswith('.prof') or f.endswith('.stacks')]
+
+
+def report(paths, top=30, sort='cumulative'):
+    """
+    :param paths: profile files, or directories of them
+    :return: the hottest functions across all of them, as text
+    """
+    import pstats
+    from StringIO import StringIO
+    files = _profile_files(paths)
+    out = StringIO()
+
+    deterministic = [f for f in files if f.endswith('.prof')]
+    if deterministic:
+        out.write('{n} deterministic profiles\n'.format(n=len(deterministic)))
+        stats = pstats.Stats(deterministic[0], stream=out)
+        for filename in deterministic[1:]:
+            stats.add(filename)
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+    sampled = [f for f in files if f.endswith('.stacks')]
+    if sampled:
+        own = dict()
+        total = dict()
+        samples = 0
+        for filename in sampled:
+            with open(filename) as f:
+                for line in f:
+                    (stack, count) = line.rsplit(' ', 1)
+                    count = int(count)
+                    samples += count
+                    functions = stack.split(';')
+                    own[functions[-1]] = own.get(functions[-1], 0) + count
+                    for function in set(functions):
+                        total[function] = total.get(function, 0) + count
+        out.write('{n} sampled profiles, {s} samples\n'.format(n=len(sampled), s=samples))
+        out.write('{own:>8} {total:>8}  function\n'.format(own='own %', total='total %'))
+        key = total if 'cumulative' == sort else own
+        for function in sorted(key, key=lambda f: -key[f])[:top]:
+            out.write('{own:8.1f} {total:8.1f}  {function}\n'.format(own=100.0 * own.get(function, 0) / samples,
+                                                                    total=100.0 * total[function] / samples,
+                                                                    function=function))
+    if not files:
+        out.write('No profiles found\n')
+    return out.getvalue()
+
+
+if '__main__' == __name__:
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarize landing page profiles, or sign an X-Profile header.')
+    parser.add_argument('paths', nargs='*', help='profile files or directories (default: profile_directory)')
+    parser.add_argument('--top', type=int, default=30)
+    parser.add_argument('--sort', choices=('cumulative', 'tottime'), default='cumulative')
+    parser.add_argument('--sign', action='store_true', help='print an X-Profile header value and exit')
+    args = parser.parse_args()
+    if args.sign:
+        if profile_secret is None:
+            sys.exit('Set profile_secret in config.py first')
+        print 'X-Profile: ' + sign()
+    else:
+        print report(args.paths or [_directory()], top=args.top, sort=args.sort)
@@ -0,0 +1,137 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import threading
+import time
+
+import config
+from SharedTable import Shared_Table, state_path
+
+# set a limit to None to turn that check off
+rate_limit_window = getattr(config, 'rate_limit_window', 3600)
+rate_limit_per_ip = getattr(config, 'rate_limit_per_ip', 20)
+rate_limit_per_email = getattr(config, 'rate_limit_per_email', 5)
+rate_limit_slots = getattr(config, 'rate_limit_slots', 16384)
+
+# hidden form fields which humans leave empty and form-filling bots do not
+honeypot_fields = getattr(config, 'honeypot_fields', ())
+
+
+def honeypot_tripped(form_fields):
+    """
+    check the honeypot fields, and remove them so that they do not end up in Insightly
+    :param form_fields: dictionary of submitted fields; modified in place
+    :return: True if any honeypot field was filled in
+    """
+    tripped = False
+    for name in honeypot_fields:
+        if form_fields.pop(name, None):
+            tripped = True
+    return tripped
+
+
+class Rate_Limiter:
+    """
+    Sliding-window rate limits per IP address and per email address, shared by all processes on the machine.
+
+    Each key keeps a count for the current window and for the previous one. The number of hits in the
+    sliding window is estimated as the current count plus the part of the previous count which still
+    overlaps the window.
+    """
+
+    _table = None
+
+    def __init__(self, filename=None, window=rate_limit_window, nslots=rate_limit_slots):
+        if filename is None:
+            filename = state_path('ratelimit.dat')
+        self._window = float(window)
+        # (window start, hits in this window, hits in the previous window)
+        self._table = Shared_Table(filename, 'dII', nslots)
+
+    def allow(self, ip_address, email):
+        """
+        record a submission and decide whether it may go on
+        :param ip_address:
+        :param email:
+        :return: True if both the IP address and the email address are under their limits
+        """
+        now = time.time()
+        allowed = True
+        with self._table.locked():
+            if rate_limit_per_ip is not None and ip_address:
+                allowed = self._hit('ip:' + ip_address, rate_limit_per_ip, now) and allowed
+            if rate_limit_per_email is not None and email:
+                allowed = self._hit('email:' + email.lower(), rate_limit_per_email, now) and allowed
+        return allowed
+
+    def _hit(self, key, limit, now):
+        """
+        count one hit against key; must be called with the table locked
+        :return: True if key is still within its limit
+        """
+        start = now - now % self._window
+        values = self._table.get(key)
+        if values is None:
+            (current, previous) = (0, 0)
+        elif values[0] == start:
+            (current, previous) = (values[1], values[2])
+        elif values[0] == start - self._window:
+            (current, previous) = (0, values[1])
+        else:
+            (current, previous) = (0, 0)
+
+        current += 1
+        self._table.put(key, (start, current, previous))
+
+        overlap = 1.0 - (now - start) / self._window
+        return current + previous * overlap <= limit
+
+    def close(self):
+        self._table.close()
+
+
+class Token_Bucket:
+    """
+    Rate limit for work done by several threads of one process, e.g. a batch import.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens per second, or None for no limit
+        :param burst: most tokens that can pile up while nobody is taking them
+        """
+        self._rate = rate
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        wait until a token is available, and take it
+        :return: None
+        """
+        if self._rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+                self._stamp = now
+                if 1 <= self._tokens:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def wait_time(self):
+        """
+        :return: seconds until take() would not have to wait; 0 if it would not now
+        """
+        if self._rate is None:
+            return 0.0
+        with self._lock:
+            tokens = min(self._burst, self._tokens + (time.time() - self._stamp) * self._rate)
+        return max(0.0, (1 - tokens) / self._rate)
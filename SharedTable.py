@@ -0,0 +1,118 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+import config
+
+# where rate limit counters and other small bits of state shared between processes live
+state_directory = getattr(config, 'state_directory', '/var/tmp/landing-page')
+
+
+def state_path(name):
+    """
+    full path of a file in the state directory, creating the directory if needed
+    :param name: file name
+    :return: path
+    """
+    if not os.path.isdir(state_directory):
+        try:
+            os.makedirs(state_directory, 0o700)
+        except OSError:
+            # another process got there first
+            pass
+    return os.path.join(state_directory, name)
+
+
+class Shared_Table:
+    """
+    A fixed-size hash table of fixed-size records in a memory-mapped file, so that every CGI process and
+    server worker on the machine sees the same data without an external service.
+
+    Keys are strings, stored as 64-bit hashes. Values are tuples packed with a struct format whose first
+    field must be a float timestamp; when a key's probe window is full, the record with the oldest timestamp
+    is evicted. All reads and writes must happen inside "with table.locked():".
+    """
+
+    _max_probes = 8
+
+    def __init__(self, filename, value_format, nslots=4096):
+        self._record = struct.Struct('<Q' + value_format.lstrip('<'))
+        self._nslots = nslots
+        size = self._record.size * nslots
+
+        self._fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != size:
+                # new file, or the slot count changed; start over
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    @contextmanager
+    def locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield self
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """
+        :param key: string
+        :return: tuple of values, or None if the key is not in the table
+        """
+        (slot, found) = self._find(self._hash(key))
+        if not found:
+            return None
+        return self._record.unpack_from(self._map, slot * self._record.size)[1:]
+
+    def put(self, key, values):
+        """
+        :param key: string
+        :param values: tuple matching value_format
+        :return: None
+        """
+        hashed = self._hash(key)
+        (slot, found) = self._find(hashed)
+        self._record.pack_into(self._map, slot * self._record.size, hashed, *values)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        hashed = struct.unpack('<Q', hashlib.sha1(key).digest()[:8])[0]
+        # zero marks an empty slot
+        return hashed or 1
+
+    def _find(self, hashed):
+        """
+        :return: (slot, found) where slot holds the key if found, else is the slot to write it into
+        """
+        oldest_slot = None
+        oldest_stamp = None
+        for probe in range(self._max_probes):
+            slot = (hashed + probe) % self._nslots
+            record = self._record.unpack_from(self._map, slot * self._record.size)
+            if record[0] == hashed:
+                return slot, True
+            if record[0] == 0:
+                return slot, False
+            if oldest_stamp is None or record[1] < oldest_stamp:
+                oldest_slot = slot
+                oldest_stamp = record[1]
+        return oldest_slot, False
@@ -0,0 +1,138 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import atexit
+import fcntl
+import json
+import os
+import threading
+import Queue
+
+import config
+import Instrumentation
+
+# file to write one JSON trace record per submission to, or None for no tracing
+trace_log = getattr(config, 'trace_log', None)
+# rotate the trace log when it grows past this many bytes, keeping this many old files
+trace_max_bytes = getattr(config, 'trace_max_bytes', 10 * 1024 * 1024)
+trace_backups = getattr(config, 'trace_backups', 5)
+# records waiting to be written; beyond this, records are dropped rather than slowing submissions down
+trace_queue_size = getattr(config, 'trace_queue_size', 10000)
+
+
+class Trace_Writer:
+    """
+    Appends JSON lines to a log file from a background thread, so that submissions never wait for the disk.
+    Several processes may share one log file: each batch of lines is a single append, and rotation happens
+    under an exclusive lock. A process forked from this one (server.py --workers) gets its own thread the first
+    time it writes, since a fork copies the queue but not the thread.
+    """
+
+    _batch_size = 100
+
+    def __init__(self, filename, max_bytes=trace_max_bytes, backups=trace_backups, queue_size=trace_queue_size):
+        self._filename = filename
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._queue_size = queue_size
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = Queue.Queue(maxsize=self._queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        """
+        queue a record for writing; never blocks
+        :param record: dictionary
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        write out everything queued, and stop the background thread
+        """
+        if self._pid != os.getpid():
+            # forked, and never written to since: there is no thread here to stop
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < self._batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in records
+            lines = ''.join(json.dumps(record, default=repr) + '\n' for record in records if record is not None)
+            if lines:
+                try:
+                    self._append(lines)
+                except (IOError, OSError):
+                    # tracing must never take the landing page down
+                    self.dropped += len(records)
+            if stop:
+                return
+
+    def _append(self, lines):
+        fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if self._max_bytes < os.fstat(fd).st_size + len(lines):
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    # another process may have rotated it while we waited for the lock
+                    if os.path.exists(self._filename) and self._max_bytes < os.path.getsize(self._filename):
+                        self._rotate()
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                # fd may be the file just rotated away; closed here and only here, then write to a fresh one
+                os.close(fd)
+                fd = None
+                fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(fd, lines)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _rotate(self):
+        for i in range(self._backups - 1, 0, -1):
+            older = '{name}.{i}'.format(name=self._filename, i=i)
+            if os.path.exists(older):
+                os.rename(older, '{name}.{i}'.format(name=self._filename, i=i + 1))
+        if 0 < self._backups:
+            os.rename(self._filename, self._filename + '.1')
+        else:
+            os.remove(self._filename)
+
+
+_writer = None
+
+
+def install():
+    """
+    start tracing submissions in this process, if trace_log is configured
+    """
+    global _writer
+    if trace_log is None or _writer is not None:
+        return
+    _writer = Trace_Writer(trace_log)
+    Instrumentation.measure_bytes = True
+    Instrumentation.submission_observers.append(_writer.write)
+    atexit.register(_writer.close)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Run the landing page with cooperative I/O instead of a thread per request.
+
+    python async_server.py --port 8080 [--max-submissions 1000]
+
+Nearly all of a submission's time goes to waiting for Insightly, reCAPTCHA and SMTP. server.py ties up a thread
+for all of that; here each request is a greenlet, and gevent makes the sockets, SSL, DNS lookups, locks and
+sleeps underneath urllib2, Requests, smtplib and the Insightly SDK cooperative, so one process can have thousands
+of submissions waiting on the network at once. Submissions go through the same FormHandler.handle and
+Landing_Page.do_form as in lp.py and server.py, so organizations, contacts, notes and mail come out the same.
+/metrics and /health are served, and the background job queue run, as in server.py.
+
+Needs gevent (pip install gevent).
+"""
+
+try:
+    from gevent import monkey
+except ImportError:
+    import sys
+    sys.exit('async_server.py needs gevent: pip install gevent')
+# before anything else imports socket, ssl, threading or time
+monkey.patch_all()
+
+import argparse
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import config
+import server
+
+# requests handled at once; connections beyond that wait to be accepted
+async_max_submissions = getattr(config, 'async_max_submissions', 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve landing page forms, /metrics and /health with gevent.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-submissions', type=int, default=async_max_submissions,
+                        help='requests handled at once')
+    args = parser.parse_args(argv)
+    server.warm()
+    server.start_jobs()
+    httpd = WSGIServer((args.host, args.port), server.application, spawn=Pool(args.max_submissions), log=None)
+    httpd.serve_forever()
+
+
+if '__main__' == __name__:
+    main()
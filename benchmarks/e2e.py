@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+End-to-end benchmark of a form submission against local stand-ins for Insightly and the mail server.
+
+    python benchmarks/e2e.py --submissions 500 --concurrency 8 --insightly-latency 0.08 --repeat 0.3 --free 0.4
+
+Modes:
+    do_form  Landing_Page.do_form, i.e. just the Insightly and mail work
+    handler  FormHandler.handle: validation, rate limiting, idempotency and do_form, as lp.py and server.py run it
+    cgi      lp.py as a CGI process per submission, including interpreter start-up and imports
+
+Prints throughput, latency percentiles and upstream calls per submission, and saves the results as JSON in
+benchmarks/results/. Each run is compared with the previous run of the same mode (or --compare FILE).
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib
+
+from environment import Bench_Environment, Submission_Mix, repo_directory
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def submitter(mode, env):
+    """
+    :return: function taking form fields and submitting them one way or another; raises on failure
+    """
+    if 'do_form' == mode:
+        from LandingPage import Landing_Page
+
+        def submit(form_fields):
+            form_fields = dict(form_fields)
+            del form_fields['ip_address']
+            Landing_Page().do_form(form_fields)
+        return submit
+
+    if 'handler' == mode:
+        import FormHandler
+
+        def submit(form_fields):
+            response = FormHandler.handle(dict(form_fields))
+            if not response.status.startswith('302'):
+                raise RuntimeError(response.status)
+        return submit
+
+    environ = env.subprocess_environ()
+
+    def submit(form_fields):
+        body = urllib.urlencode(dict((k, v.encode('utf-8')) for (k, v) in form_fields.items() if 'ip_address' != k))
+        request_environ = dict(environ, REQUEST_METHOD='POST', CONTENT_TYPE='application/x-www-form-urlencoded',
+                               CONTENT_LENGTH=str(len(body)), REMOTE_ADDR=form_fields['ip_address'])
+        process = subprocess.Popen([sys.executable, os.path.join(repo_directory, 'lp.py')], cwd=env.directory,
+                                   env=request_environ, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        (output, _) = process.communicate(body)
+        if 0 != process.returncode or not output.startswith('Status: 302'):
+            raise RuntimeError(output.split('\n', 1)[0] or 'exit status {s}'.format(s=process.returncode))
+    return submit
+
+
+def run(submit, submissions, concurrency):
+    """
+    :param submissions: list of form field dictionaries
+    :return: (elapsed seconds, sorted list of latencies of successful submissions, dictionary of error -> count)
+    """
+    latencies = []
+    errors = dict()
+    lock = threading.Lock()
+    pending = list(reversed(submissions))
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                form_fields = pending.pop()
+            start = time.time()
+            try:
+                submit(form_fields)
+            except Exception as e:
+                with lock:
+                    key = '{type}: {e}'.format(type=type(e).__name__, e=e)[:100]
+                    errors[key] = errors.get(key, 0) + 1
+                continue
+            duration = time.time() - start
+            with lock:
+                latencies.append(duration)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, sorted(latencies), errors
+
+
+def previous_results(mode, compare):
+    if compare is not None:
+        filename = compare
+    else:
+        candidates = sorted(glob.glob(os.path.join(results_directory, 'e2e-{mode}-*.json'.format(mode=mode))))
+        if not candidates:
+            return None
+        filename = candidates[-1]
+    with open(filename) as f:
+        return json.load(f)
+
+
+def report(results, previous):
+    lines = [
+        '{mode}: {n} submissions, {c} at a time'.format(mode=results['mode'], n=results['submissions'],
+                                                         c=results['parameters']['concurrency']),
+        '  throughput     {v:10.1f} /s'.format(v=results['throughput']),
+        '  p50            {v:10.1f} ms'.format(v=1000 * (results['p50'] or 0)),
+        '  p99            {v:10.1f} ms'.format(v=1000 * (results['p99'] or 0)),
+        '  max            {v:10.1f} ms'.format(v=1000 * (results['max'] or 0)),
+        '  errors         {v:10d}'.format(v=sum(results['errors'].values())),
+        '  insightly/sub  {v:10.2f}'.format(v=results['insightly_calls_per_submission']),
+        '  mail/sub       {v:10.2f}'.format(v=results['mail_per_submission']),
+    ]
+    for (endpoint, count) in sorted(results['insightly_calls'].items()):
+        lines.append('    {endpoint:30} {v:6.2f}'.format(endpoint=endpoint, v=float(count) / results['submissions']))
+    for (error, count) in sorted(results['errors'].items()):
+        lines.append('  error x{count}: {error}'.format(count=count, error=error))
+
+    if previous is not None:
+        lines.append('compared with {when}:'.format(when=previous['started']))
+        for key in ('throughput', 'p50', 'p99', 'insightly_calls_per_submission'):
+            (old, new) = (previous.get(key), results.get(key))
+            if old and new is not None:
+                lines.append('  {key:30} {change:+7.1f}%'.format(key=key, change=100.0 * (new - old) / old))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end landing page benchmark against local stand-ins.')
+    parser.add_argument('--mode', choices=('do_form', 'handler', 'cgi'), default='handler')
+    parser.add_argument('--submissions', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--forms', type=int, default=3, help='number of different forms submitted')
+    parser.add_argument('--repeat', type=float, default=0.2, help='share of submissions from repeat contacts')
+    parser.add_argument('--free', type=float, default=0.3, help='share of new contacts with free email addresses')
+    parser.add_argument('--insightly-latency', type=float, default=0.0, help='seconds added to each Insightly call')
+    parser.add_argument('--insightly-jitter', type=float, default=0.0)
+    parser.add_argument('--insightly-error-rate', type=float, default=0.0)
+    parser.add_argument('--smtp-latency', type=float, default=0.0)
+    parser.add_argument('--smtp-error-rate', type=float, default=0.0)
+    parser.add_argument('--preload', type=int, default=0, help='contacts already in Insightly')
+    parser.add_argument('--padding', type=int, default=0, help='bytes of BACKGROUND on preloaded contacts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--label', default='', help='note saved with the results')
+    parser.add_argument('--compare', help='results file to compare with, instead of the previous run')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(argv)
+
+    env = Bench_Environment(insightly_latency=args.insightly_latency, insightly_jitter=args.insightly_jitter,
+                            insightly_error_rate=args.insightly_error_rate, smtp_latency=args.smtp_latency,
+                            smtp_error_rate=args.smtp_error_rate, preload_contacts=args.preload,
+                            padding=args.padding, forms=args.forms).start()
+    try:
+        if 'cgi' != args.mode:
+            env.install()
+        mix = Submission_Mix(env.form_names, repeat=args.repeat, free=args.free, seed=args.seed)
+        submissions = [mix.next() for _ in range(args.submissions)]
+        submit = submitter(args.mode, env)
+
+        calls_before = dict(env.insightly.requests)
+        mail_before = env.smtp.messages
+        started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        (elapsed, latencies, errors) = run(submit, submissions, args.concurrency)
+        calls = dict((endpoint, count - calls_before.get(endpoint, 0))
+                     for (endpoint, count) in env.insightly.requests.items()
+                     if count != calls_before.get(endpoint, 0))
+    finally:
+        env.stop()
+
+    n = len(submissions)
+    results = {
+        'started': started,
+        'label': args.label,
+        'mode': args.mode,
+        'parameters': dict((k, v) for (k, v) in vars(args).items() if k not in ('compare', 'no_save', 'label')),
+        'submissions': n,
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+        'errors': errors,
+        'insightly_calls': calls,
+        'insightly_calls_per_submission': float(sum(calls.values())) / n,
+        'mail_per_submission': float(env.smtp.messages - mail_before) / n,
+    }
+    print report(results, previous_results(args.mode, args.compare))
+
+    if not args.no_save:
+        if not os.path.isdir(results_directory):
+            os.makedirs(results_directory)
+        filename = os.path.join(results_directory, 'e2e-{mode}-{stamp}.json'.format(
+            mode=args.mode, stamp=time.strftime('%Y%m%d-%H%M%S')))
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'saved', filename
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,178 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+A throwaway landing page installation for benchmarks: a temporary directory with its own config.py, forms/ and
+state directory, wired to the stand-ins in fakes.py instead of Insightly, reCAPTCHA and the real mail server.
+
+    env = Bench_Environment(insightly_latency=0.05).start()
+    env.install()              # this process: must happen before any landing page module is imported
+    env.subprocess_environ()   # other processes (lp.py, server.py): environment variables to run them with
+
+Submission_Mix makes up form submissions with a chosen share of repeat and free-email contacts.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from fakes import Fake_Insightly_Server, Fake_Recaptcha_Server, Smtp_Sink
+
+repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_config_template = '''
+insightly_apikey = 'bench'
+recaptcha_secretkey = {recaptcha_secretkey!r}
+recaptcha_url = {recaptcha_url!r}
+state_directory = {state_directory!r}
+smtp_host = {smtp_host!r}
+smtp_port = {smtp_port!r}
+rate_limit_per_ip = None
+rate_limit_per_email = None
+'''
+
+# loaded by subprocesses, which find it first on PYTHONPATH; points Landing_Page at the fake Insightly when
+# LandingPage is first imported, so that processes which never import it (rejected submissions) start as they
+# would in production
+_sitecustomize_template = '''
+import sys
+
+
+class _Bench_LandingPage_Hook:
+    def find_module(self, name, path=None):
+        return self if 'LandingPage' == name else None
+
+    def load_module(self, name):
+        # out of the way, so that the usual import (from the repo or from a bundle) happens
+        sys.meta_path.remove(self)
+        __import__(name)
+        module = sys.modules[name]
+        sys.path.insert(0, {benchmarks_directory!r})
+        from fakes import Fake_Insightly_Client
+        module.Landing_Page.insightly_factory = staticmethod(lambda: Fake_Insightly_Client({insightly_url!r}))
+        return module
+
+
+sys.meta_path.append(_Bench_LandingPage_Hook())
+'''
+
+# providers for the free-email share of a Submission_Mix
+free_domains = ('gmail.com', 'yahoo.com', 'hotmail.com')
+
+
+class Bench_Environment:
+    def __init__(self, insightly_latency=0.0, insightly_jitter=0.0, insightly_error_rate=0.0, smtp_latency=0.0,
+                 smtp_error_rate=0.0, preload_contacts=0, padding=0, forms=3, recaptcha=False, recaptcha_latency=0.0,
+                 extra_config=None):
+        """
+        :param recaptcha: True to require reCAPTCHA tokens, verified by a Fake_Recaptcha_Server
+        :param forms: number of forms, BenchForm1 ... BenchFormN, to create
+        :param extra_config: dictionary of more config.py settings
+        """
+        self.insightly = Fake_Insightly_Server(latency=insightly_latency, jitter=insightly_jitter,
+                                               error_rate=insightly_error_rate, preload_contacts=preload_contacts,
+                                               padding=padding)
+        self.smtp = Smtp_Sink(latency=smtp_latency, error_rate=smtp_error_rate)
+        self.recaptcha = Fake_Recaptcha_Server(latency=recaptcha_latency) if recaptcha else None
+        self.directory = tempfile.mkdtemp(prefix='landing-page-bench-')
+        self.form_names = ['BenchForm{n}'.format(n=n + 1) for n in range(forms)]
+
+        os.mkdir(os.path.join(self.directory, 'forms'))
+        with open(os.path.join(repo_directory, 'forms', 'TestForm1.txt')) as f:
+            form_data = f.read()
+        for form_name in self.form_names:
+            with open(os.path.join(self.directory, 'forms', form_name + '.txt'), 'w') as f:
+                f.write(form_data)
+
+        settings = _config_template.format(recaptcha_secretkey='bench' if recaptcha else None,
+                                           recaptcha_url=self.recaptcha.url if recaptcha else None,
+                                           state_directory=os.path.join(self.directory, 'state'),
+                                           smtp_host=self.smtp.host, smtp_port=self.smtp.port)
+        for (name, value) in sorted((extra_config or {}).items()):
+            settings += '{name} = {value!r}\n'.format(name=name, value=value)
+        with open(os.path.join(self.directory, 'config.py'), 'w') as f:
+            f.write(settings)
+        with open(os.path.join(self.directory, 'sitecustomize.py'), 'w') as f:
+            f.write(_sitecustomize_template.format(benchmarks_directory=os.path.dirname(os.path.abspath(__file__)),
+                                                   insightly_url=self.insightly.url))
+
+    def start(self):
+        self.insightly.start()
+        self.smtp.start()
+        if self.recaptcha is not None:
+            self.recaptcha.start()
+        return self
+
+    def stop(self):
+        self.insightly.stop()
+        self.smtp.stop()
+        if self.recaptcha is not None:
+            self.recaptcha.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def install(self):
+        """
+        point this process at the bench config, forms and stand-ins
+        """
+        if 'config' in sys.modules:
+            raise RuntimeError('install() must run before config is imported')
+        sys.path.insert(0, repo_directory)
+        sys.path.insert(0, self.directory)
+        os.chdir(self.directory)
+        import LandingPage
+        from fakes import Fake_Insightly_Client
+        LandingPage.Landing_Page.insightly_factory = staticmethod(lambda: Fake_Insightly_Client(self.insightly.url))
+
+    def subprocess_environ(self):
+        """
+        :return: environment for running lp.py or server.py (with cwd=self.directory) against the stand-ins
+        """
+        environ = dict(os.environ)
+        environ['PYTHONPATH'] = os.pathsep.join([self.directory, repo_directory])
+        return environ
+
+
+class Submission_Mix:
+    def __init__(self, form_names, repeat=0.2, free=0.3, company_domains=50, seed=None):
+        """
+        :param form_names: forms to spread the submissions across
+        :param repeat: share of submissions from a contact who has submitted before
+        :param free: share of new contacts with a free email address
+        :param company_domains: new company contacts are spread across this many domains
+        """
+        self._form_names = form_names
+        self._repeat = repeat
+        self._free = free
+        self._company_domains = company_domains
+        self._random = random.Random(seed)
+        self._seen = []
+        self._count = 0
+
+    def next(self):
+        """
+        :return: form fields for one more submission
+        """
+        self._count += 1
+        r = self._random
+        if self._seen and r.random() < self._repeat:
+            (email, last_name) = r.choice(self._seen)
+        else:
+            if r.random() < self._free:
+                domain = r.choice(free_domains)
+            else:
+                domain = 'company{n}.example'.format(n=r.randrange(self._company_domains))
+            email = 'bench{n}.{salt}@{domain}'.format(n=self._count, salt=r.randrange(10 ** 6), domain=domain)
+            last_name = 'User{n}'.format(n=self._count)
+            self._seen.append((email, last_name))
+        return {
+            'email': unicode(email),
+            'first_name': u'Bench',
+            'last_name': unicode(last_name),
+            'form_name': unicode(r.choice(self._form_names)),
+            'comments': u'Submission {n}'.format(n=self._count),
+            'ip_address': u'10.{a}.{b}.{c}'.format(a=r.randrange(256), b=r.randrange(256), c=r.randrange(1, 255)),
+        }
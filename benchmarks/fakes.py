@@ -0,0 +1,319 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Local stand-ins for Insightly, reCAPTCHA and the mail server, for benchmarks and load tests:
+
+    Fake_Insightly_Server  an HTTP server with the parts of the Insightly v2.1 API that the landing page uses
+    Fake_Insightly_Client  the Insightly SDK methods that Landing_Page calls, talking HTTP to the fake server
+    Smtp_Sink              an SMTP server that accepts and counts messages
+    Fake_Recaptcha_Server  reCAPTCHA's siteverify; tokens starting with "bench-" pass
+
+All of them take a latency (seconds), jitter (seconds, uniformly added) and error rate (0 to 1).
+"""
+
+import BaseHTTPServer
+import itertools
+import json
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+
+class Fake_Insightly_Server:
+    """
+    In-memory Insightly. preload_contacts contacts (bench-N@preload-M.example) and their organizations exist from
+    the start; padding adds that many bytes of BACKGROUND to every preloaded contact, to model data volume.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, preload_contacts=0, padding=0, host='127.0.0.1',
+                 port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.contacts = dict()
+        self.organisations = dict()
+        self.notes = 0
+        self.requests = dict()
+        self._ids = itertools.count(1000)
+        for i in range(preload_contacts):
+            domain = 'preload-{m}.example'.format(m=i % 100)
+            org = self._add_organisation({'ORGANISATION_NAME': domain,
+                                          'CONTACTINFOS': [{'TYPE': 'EMAILDOMAIN', 'LABEL': 'Work', 'DETAIL': domain}]})
+            self._add_contact({
+                'FIRST_NAME': u'Bench', 'LAST_NAME': u'Preload',
+                'CONTACTINFOS': [{'TYPE': 'EMAIL', 'LABEL': 'Work', 'DETAIL': 'bench-{i}@{d}'.format(i=i, d=domain)}],
+                'TAGS': [{'TAG_NAME': 'Web_Contact'}],
+                'LINKS': [{'ORGANISATION_ID': org['ORGANISATION_ID']}],
+                'BACKGROUND': u'x' * padding or None,
+            })
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self, 'GET')
+
+            def do_POST(self):
+                server._handle(self, 'POST')
+
+            def do_PUT(self):
+                server._handle(self, 'PUT')
+
+            def log_message(self, format, *args):
+                pass
+
+        class Threading_HTTP_Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self._httpd = Threading_HTTP_Server((host, port), Handler)
+        self.url = 'http://{host}:{port}/v2.1'.format(host=host, port=self._httpd.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+
+    def calls(self):
+        """
+        :return: total number of requests served
+        """
+        with self.lock:
+            return sum(self.requests.values())
+
+    def _add_organisation(self, graph):
+        graph = dict(graph, ORGANISATION_ID=next(self._ids))
+        self.organisations[graph['ORGANISATION_ID']] = graph
+        return graph
+
+    def _add_contact(self, graph):
+        graph = dict(graph, CONTACT_ID=next(self._ids))
+        graph.setdefault('BACKGROUND', None)
+        self.contacts[graph['CONTACT_ID']] = graph
+        return graph
+
+    def _handle(self, request, method):
+        parsed = urlparse.urlparse(request.path)
+        path = parsed.path[len('/v2.1'):].strip('/').split('/')
+        query = dict(urlparse.parse_qsl(parsed.query))
+        body = None
+        if 'Content-Length' in request.headers:
+            body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
+        with self.lock:
+            key = method + ' ' + '/'.join(p if not p.isdigit() else '{id}' for p in path)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.error_rate:
+            self._send(request, 503, {'Message': 'Fake outage'})
+            return
+
+        with self.lock:
+            (status, document) = self._route(method, path, query, body)
+        self._send(request, status, document)
+
+    def _route(self, method, path, query, body):
+        if ['Users', 'Me'] == path:
+            return 200, {'email': 'owner@bench.example', 'name': u'Bench Owner',
+                         'email_dropbox': 'dropbox@bench.example'}
+        if ['Users'] == path:
+            return 200, [{'EMAIL_ADDRESS': 'user1@bench.example'}, {'EMAIL_ADDRESS': 'user2@bench.example'}]
+        if ['Organisations'] == path and 'GET' == method:
+            domain = query.get('email_domain', '').lower()
+            return 200, [o for o in self.organisations.values()
+                         if any(ci['DETAIL'].lower() == domain for ci in o.get('CONTACTINFOS', []))]
+        if ['Organisations'] == path and 'POST' == method:
+            return 201, self._add_organisation(body)
+        if ['Contacts'] == path and 'GET' == method:
+            email = query.get('email', '').lower()
+            found = [c for c in self.contacts.values() if any('EMAIL' == ci['TYPE'] and ci['DETAIL'].lower() == email
+                                                              for ci in c.get('CONTACTINFOS') or [])]
+            return 200, found[:int(query.get('top', 100))]
+        if ['Contacts'] == path and 'POST' == method:
+            return 201, self._add_contact(body)
+        if ['Contacts'] == path and 'PUT' == method:
+            if body.get('CONTACT_ID') not in self.contacts:
+                return 404, {'Message': 'No such contact'}
+            # as Insightly does, replace the whole record: whatever the update leaves out is gone
+            contact = dict(body)
+            contact.setdefault('BACKGROUND', None)
+            self.contacts[contact['CONTACT_ID']] = contact
+            return 200, contact
+        if 3 == len(path) and 'Contacts' == path[0] and 'Notes' == path[2] and 'POST' == method:
+            self.notes += 1
+            return 201, dict(body, NOTE_ID=next(self._ids))
+        return 404, {'Message': 'Not implemented by the fake'}
+
+    @staticmethod
+    def _send(request, status, document):
+        payload = json.dumps(document)
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+
+class Fake_Recaptcha_Server:
+    """
+    Verifies reCAPTCHA tokens: those starting with "bench-" are good, anything else is bad
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.verified = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                form = dict(urlparse.parse_qsl(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+                with server.lock:
+                    server.verified += 1
+                if random.random() < server.error_rate:
+                    Fake_Insightly_Server._send(self, 503, {'success': False})
+                else:
+                    Fake_Insightly_Server._send(self, 200, {
+                        'success': form.get('response', '').startswith('bench-'),
+                    })
+
+            def log_message(self, format, *args):
+                pass
+
+        class Threading_HTTP_Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self._httpd = Threading_HTTP_Server((host, port), Handler)
+        self.url = 'http://{host}:{port}/recaptcha/api/siteverify'.format(host=host,
+                                                                         port=self._httpd.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+
+
+class Fake_Insightly_Client:
+    """
+    The subset of the Insightly SDK which Landing_Page uses, backed by a Fake_Insightly_Server
+    """
+
+    def __init__(self, url):
+        self._url = url
+        self.users = self._request('GET', '/Users')
+
+    def ownerinfo(self):
+        return self._request('GET', '/Users/Me')
+
+    def search(self, object_type, expression, top=None):
+        (field, value) = expression.split('=', 1)
+        return self._request('GET', '/' + object_type, query={field: value})
+
+    def read(self, object_type, id=None, top=None, filters=None):
+        query = dict(filters or {})
+        if top is not None:
+            query['top'] = top
+        return self._request('GET', '/' + object_type.capitalize(), query=query)
+
+    def create(self, object_type, object_graph, id=None, sub_type=None):
+        path = '/' + object_type.capitalize()
+        if sub_type is not None:
+            path += '/{id}/{sub_type}'.format(id=id, sub_type=sub_type.capitalize())
+        elif 'organisations' == object_type.lower():
+            path = '/Organisations'
+        return self._request('POST', path, object_graph)
+
+    def update(self, object_type, object_graph, id=None):
+        if id is not None:
+            object_graph = dict(object_graph, CONTACT_ID=id)
+        return self._request('PUT', '/' + object_type.capitalize(), object_graph)
+
+    def _request(self, method, path, body=None, query=None):
+        url = self._url + path
+        if query:
+            url += '?' + urllib.urlencode(dict((k, unicode(v).encode('utf-8')) for (k, v) in query.items()))
+        request = urllib2.Request(url, data=None if body is None else json.dumps(body),
+                                  headers={'Content-Type': 'application/json'})
+        request.get_method = lambda: method
+        return json.loads(urllib2.urlopen(request).read())
+
+
+class Smtp_Sink:
+    """
+    Accepts mail over SMTP and throws it away, counting messages
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.messages = 0
+        self.lock = threading.Lock()
+        sink = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                self.reply('220 sink ESMTP')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line[:4].upper()
+                    if command in ('HELO', 'EHLO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                        self.reply('250 OK')
+                    elif 'DATA' == command:
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        while self.rfile.readline().rstrip('\r\n') != '.':
+                            pass
+                        time.sleep(sink.latency + random.uniform(0, sink.jitter))
+                        if random.random() < sink.error_rate:
+                            self.reply('451 Fake outage')
+                        else:
+                            with sink.lock:
+                                sink.messages += 1
+                            self.reply('250 OK queued')
+                    elif 'QUIT' == command:
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('502 Not implemented')
+
+            def reply(self, text):
+                self.wfile.write(text + '\r\n')
+
+        class Threading_TCP_Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+            request_queue_size = 128
+
+        self._server = Threading_TCP_Server((host, port), Handler)
+        (self.host, self.port) = self._server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Load generator for the landing page's HTTP entry point.
+
+Against a local instance, with stand-ins for Insightly, reCAPTCHA and the mail server:
+
+    python benchmarks/loadgen.py --local server --rate 20 --steps 5 --step 20 --duration 30
+    python benchmarks/loadgen.py --local cgi --concurrency 2 --steps 4 --step 2 --recaptcha
+
+Against a running installation (which must have the forms named by --forms, and should not be talking to the
+real Insightly):
+
+    python benchmarks/loadgen.py --url http://staging.example/cgi-bin/landing-page/lp.py --forms TestForm1 --rate 5
+
+--rate sends submissions at a fixed rate whatever the response times (open loop); --concurrency keeps that many
+submissions in progress (closed loop). With --steps, the rate or concurrency is raised by --step after each
+--duration. Every step reports throughput, latency percentiles and errors; a step is held when it achieves 95% of
+its target rate, stays under --max-error-rate and, if given, under --slo-p99. The highest throughput held is
+reported at the end, and everything is saved in benchmarks/results/.
+"""
+
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import os
+import Queue
+import random
+import re
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+from environment import Bench_Environment, Submission_Mix, repo_directory
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+_error_line_re = re.compile(r'<p>(.*?)</p>')
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Target:
+    """
+    Posts form submissions to a URL and classifies the responses
+    """
+
+    def __init__(self, url, timeout=30):
+        parsed = urlparse.urlparse(url)
+        self._host = parsed.hostname
+        self._port = parsed.port or 80
+        self._path = parsed.path or '/'
+        self._timeout = timeout
+
+    def submit(self, form_fields):
+        """
+        :return: None on success (a redirect to the thank-you page), otherwise a short description of the error
+        """
+        body = urllib.urlencode(dict((k, v.encode('utf-8')) for (k, v) in form_fields.items()))
+        connection = httplib.HTTPConnection(self._host, self._port, timeout=self._timeout)
+        try:
+            connection.request('POST', self._path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = connection.getresponse()
+            content = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            return '{type}'.format(type=type(e).__name__)
+        finally:
+            connection.close()
+        if 302 == response.status:
+            return None
+        if 200 == response.status:
+            # the landing page turns submissions away with an error page
+            lines = _error_line_re.findall(content)
+            return 'rejected: ' + (lines[0] if lines else content[:60].strip())
+        return 'HTTP {status}'.format(status=response.status)
+
+
+class Load_Step:
+    def __init__(self):
+        self.latencies = []
+        self.errors = dict()
+        self.sent = 0
+        self.late = 0
+        # submissions with bad reCAPTCHA tokens which were turned away, as they should be
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency, error, bad_token=False):
+        with self.lock:
+            if bad_token:
+                if error is None:
+                    error = 'accepted a bad reCAPTCHA token'
+                elif error.startswith('rejected: '):
+                    self.rejected += 1
+                    return
+            if error is None:
+                self.latencies.append(latency)
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def summary(self, target, elapsed, rate_mode, max_error_rate, slo_p99):
+        latencies = sorted(self.latencies)
+        completed = len(latencies) + self.rejected + sum(self.errors.values())
+        throughput = (len(latencies) + self.rejected) / elapsed
+        error_rate = float(sum(self.errors.values())) / completed if completed else 0.0
+        p99 = percentile(latencies, 0.99)
+        held = error_rate <= max_error_rate and (slo_p99 is None or (p99 is not None and p99 <= slo_p99))
+        if rate_mode:
+            held = held and 0 == self.late and 0.95 * target <= throughput
+        return {
+            'target': target,
+            'sent': self.sent,
+            'completed': completed,
+            'throughput': throughput,
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': p99,
+            'max': latencies[-1] if latencies else None,
+            'error_rate': error_rate,
+            'errors': dict(self.errors),
+            'late': self.late,
+            'rejected_bad_tokens': self.rejected,
+            'held': held,
+        }
+
+
+def run_rate(target, next_submission, rate, duration, max_in_flight):
+    """
+    open loop: start a submission every 1/rate seconds. Latency is measured from when the submission was due,
+    so a server that falls behind is not flattered by the generator waiting for it.
+    """
+    step = Load_Step()
+    due = Queue.Queue(maxsize=max_in_flight)
+
+    def worker():
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            (scheduled, (form_fields, bad_token)) = item
+            error = target.submit(form_fields)
+            step.record(time.time() - scheduled, error, bad_token)
+
+    workers = [threading.Thread(target=worker) for _ in range(max_in_flight)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    interval = 1.0 / rate
+    n = 0
+    while True:
+        scheduled = start + n * interval
+        if start + duration <= scheduled:
+            break
+        now = time.time()
+        if now < scheduled:
+            time.sleep(scheduled - now)
+        try:
+            due.put_nowait((scheduled, next_submission()))
+            step.sent += 1
+        except Queue.Full:
+            # every worker is busy and the backlog is full; the server has fallen too far behind
+            step.late += 1
+            step.record(0, 'generator: too many in flight')
+        n += 1
+    for _ in workers:
+        due.put(None)
+    for thread in workers:
+        thread.join()
+    # throughput is over the time submissions were being started; a server which is keeping up finishes the last
+    # few just after that
+    return step, duration
+
+
+def run_concurrency(target, next_submission, concurrency, duration):
+    """
+    closed loop: keep concurrency submissions in progress
+    """
+    step = Load_Step()
+    lock = threading.Lock()
+    start = time.time()
+    deadline = start + duration
+
+    def worker():
+        while time.time() < deadline:
+            with lock:
+                (form_fields, bad_token) = next_submission()
+                step.sent += 1
+            begin = time.time()
+            error = target.submit(form_fields)
+            step.record(time.time() - begin, error, bad_token)
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return step, time.time() - start
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Cgi_Gateway:
+    """
+    A web server which runs lp.py as a CGI process for every request, as Apache does.
+    (CGIHTTPServer would do, except that it refuses to run scripts under /root when started as root.)
+    """
+
+    def __init__(self, env, port):
+        environ = env.subprocess_environ()
+        script = os.path.join(repo_directory, 'lp.py')
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                request_environ = dict(environ, REQUEST_METHOD='POST', CONTENT_LENGTH=str(len(body)),
+                                       CONTENT_TYPE=self.headers.get('Content-Type', ''),
+                                       REMOTE_ADDR=self.client_address[0], SCRIPT_NAME=self.path)
+                process = subprocess.Popen([sys.executable, script], cwd=env.directory, env=request_environ,
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                (output, _) = process.communicate(body)
+                (head, _, content) = output.replace('\r\n', '\n').partition('\n\n')
+                headers = [line.split(': ', 1) for line in head.split('\n') if ': ' in line]
+                status = dict(headers).pop('Status', '200 OK' if 0 == process.returncode else '500 CGI failed')
+                self.send_response(int(status.split()[0]), status.partition(' ')[2])
+                for (name, value) in headers:
+                    if 'Status' != name:
+                        self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Threading_HTTP_Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self._httpd = Threading_HTTP_Server(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+
+
+def start_local(kind, env):
+    """
+    run the landing page against the stand-ins
+    :param kind: 'server' for server.py in a child process, 'async' for async_server.py, 'cgi' for lp.py run as a
+                 CGI script
+    :return: (function to stop it, URL)
+    """
+    port = free_port()
+    if 'cgi' == kind:
+        gateway = Cgi_Gateway(env, port)
+        return gateway.stop, 'http://127.0.0.1:{port}/cgi-bin/lp.py'.format(port=port)
+
+    with open(os.devnull, 'w') as devnull:
+        script = 'async_server.py' if 'async' == kind else 'server.py'
+        process = subprocess.Popen([sys.executable, os.path.join(repo_directory, script), '--port', str(port)],
+                                   cwd=env.directory, env=env.subprocess_environ(), stdout=devnull, stderr=devnull)
+
+    def stop():
+        process.terminate()
+        process.wait()
+
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return stop, 'http://127.0.0.1:{port}/lp.py'.format(port=port)
+        except socket.error:
+            time.sleep(0.1)
+    stop()
+    raise RuntimeError('local {script} did not start'.format(script=script))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Push form submissions at a landing page URL.')
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--url', help='lp.py or server.py URL to load')
+    where.add_argument('--local', choices=('server', 'async', 'cgi'),
+                       help='start a local instance with stand-in backends')
+    how = parser.add_mutually_exclusive_group(required=True)
+    how.add_argument('--rate', type=float, help='submissions per second to start with')
+    how.add_argument('--concurrency', type=int, help='submissions in progress to start with')
+    parser.add_argument('--steps', type=int, default=1, help='number of load levels')
+    parser.add_argument('--step', type=float, default=0, help='added to the rate or concurrency at each level')
+    parser.add_argument('--duration', type=float, default=20, help='seconds per level')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='most submissions in progress with --rate')
+    parser.add_argument('--forms', help='comma-separated form names to submit (default: the local bench forms)')
+    parser.add_argument('--repeat', type=float, default=0.2, help='share of submissions from repeat contacts')
+    parser.add_argument('--free', type=float, default=0.3, help='share of new contacts with free email addresses')
+    parser.add_argument('--recaptcha', action='store_true', help='send fake reCAPTCHA tokens')
+    parser.add_argument('--bad-tokens', type=float, default=0.0, help='share of reCAPTCHA tokens which are bad')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--slo-p99', type=float, help='seconds; a level whose p99 is slower is not held')
+    parser.add_argument('--insightly-latency', type=float, default=0.05, help='local stand-in latency, seconds')
+    parser.add_argument('--insightly-error-rate', type=float, default=0.0)
+    parser.add_argument('--smtp-latency', type=float, default=0.01)
+    parser.add_argument('--recaptcha-latency', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(argv)
+
+    env = None
+    stop = None
+    url = args.url
+    if args.local is not None:
+        env = Bench_Environment(insightly_latency=args.insightly_latency,
+                                insightly_error_rate=args.insightly_error_rate, smtp_latency=args.smtp_latency,
+                                recaptcha=args.recaptcha, recaptcha_latency=args.recaptcha_latency).start()
+    try:
+        if env is not None:
+            (stop, url) = start_local(args.local, env)
+        form_names = args.forms.split(',') if args.forms else env.form_names if env else ['TestForm1']
+        mix = Submission_Mix(form_names, repeat=args.repeat, free=args.free, seed=args.seed)
+        tokens = random.Random(args.seed)
+
+        def next_submission():
+            """
+            :return: (form fields, True if they carry a bad reCAPTCHA token)
+            """
+            form_fields = mix.next()
+            del form_fields['ip_address']
+            bad_token = False
+            if args.recaptcha:
+                bad_token = tokens.random() < args.bad_tokens
+                form_fields['g-recaptcha-response'] = u'{kind}-{id}'.format(kind='bad' if bad_token else 'bench',
+                                                                           id=uuid.uuid4().hex)
+            return form_fields, bad_token
+
+        target = Target(url)
+        steps = []
+        print '{t:>8} {tp:>8} {p50:>8} {p90:>8} {p99:>8} {max:>8} {err:>7} {held:>5}'.format(
+            t='target', tp='req/s', p50='p50 ms', p90='p90 ms', p99='p99 ms', max='max ms', err='errors', held='held')
+        for i in range(args.steps):
+            if args.rate is not None:
+                level = args.rate + i * args.step
+                (step, elapsed) = run_rate(target, next_submission, level, args.duration, args.max_in_flight)
+            else:
+                level = int(args.concurrency + i * args.step)
+                (step, elapsed) = run_concurrency(target, next_submission, level, args.duration)
+            summary = step.summary(level, elapsed, args.rate is not None, args.max_error_rate, args.slo_p99)
+            steps.append(summary)
+            print '{t:8g} {tp:8.1f} {p50:8.0f} {p90:8.0f} {p99:8.0f} {max:8.0f} {err:6.1f}% {held:>5}'.format(
+                t=level, tp=summary['throughput'], p50=1000 * (summary['p50'] or 0),
+                p90=1000 * (summary['p90'] or 0), p99=1000 * (summary['p99'] or 0),
+                max=1000 * (summary['max'] or 0), err=100 * summary['error_rate'],
+                held='yes' if summary['held'] else 'no')
+    finally:
+        if stop is not None:
+            stop()
+        if env is not None:
+            env.stop()
+
+    errors = dict()
+    for summary in steps:
+        for (error, count) in summary['errors'].items():
+            errors[error] = errors.get(error, 0) + count
+    if errors:
+        print 'errors:'
+        for (error, count) in sorted(errors.items(), key=lambda item: -item[1]):
+            print '  {count:6d}  {error}'.format(count=count, error=error)
+    held = [summary['throughput'] for summary in steps if summary['held']]
+    max_held = max(held) if held else None
+    print 'maximum throughput held: ' + ('none' if max_held is None else '{t:.1f} req/s'.format(t=max_held))
+
+    if not args.no_save:
+        if not os.path.isdir(results_directory):
+            os.makedirs(results_directory)
+        filename = os.path.join(results_directory, 'loadgen-{stamp}.json'.format(stamp=time.strftime('%Y%m%d-%H%M%S')))
+        with open(filename, 'w') as f:
+            json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'url': args.url, 'local': args.local,
+                       'parameters': vars(args), 'steps': steps, 'errors': errors, 'max_throughput_held': max_held},
+                      f, indent=2, sort_keys=True)
+        print 'saved', filename
+
+
+if '__main__' == __name__:
+    main()
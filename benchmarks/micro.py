@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Microbenchmarks of the CPU-bound work done on every submission.
+
+    python benchmarks/micro.py              # all of them
+    python benchmarks/micro.py is_free      # those whose name contains "is_free"
+
+For each benchmark, prints the time per operation (best of several runs) and what it allocates:
+    peak B/op     the most memory the operation had allocated at once, if the interpreter has tracemalloc
+                  (Python 2.7 needs the pytracemalloc patch; without it this column shows "-")
+    retained/op   objects tracked by the garbage collector which are still alive after the operation, e.g.
+                  cache entries; anything above 0 in steady state is a leak
+
+Results are saved in benchmarks/results/ and compared with the previous run (or --compare FILE).
+"""
+
+import argparse
+import cgi
+import gc
+import glob
+import json
+import os
+import sys
+import time
+import urllib
+from StringIO import StringIO
+
+from environment import Bench_Environment
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Null_Insightly_Client:
+    """
+    Answers Landing_Page's Insightly calls from memory, so that only the landing page's own work is measured
+    """
+
+    users = [{'EMAIL_ADDRESS': 'user1@bench.example'}, {'EMAIL_ADDRESS': 'user2@bench.example'}]
+
+    def ownerinfo(self):
+        return {'email': 'owner@bench.example', 'name': u'Bench Owner', 'email_dropbox': 'dropbox@bench.example'}
+
+    def create(self, object_type, object_graph, id=None, sub_type=None):
+        return object_graph
+
+
+_form_fields = {
+    'email': u'robin.hood@sherwood.example',
+    'first_name': u'Robin',
+    'last_name': u'Hood',
+    'form_name': u'BenchForm1',
+    'company': u'Merry Men',
+    'phone': u'+1 314 555 0100',
+    'comments': u'Please send the ebook. \u00a1Gracias!',
+    'ip_address': u'10.1.2.3',
+}
+
+_contact = {'CONTACT_ID': 1, 'FIRST_NAME': u'Robin', 'LAST_NAME': u'Hood', 'BACKGROUND': None}
+
+
+def benchmarks():
+    """
+    :return: list of (name, function of no arguments); the landing page modules must be importable
+    """
+    from BackgroundPolicy import Background_Policy
+    from FreeEmailProviders import FreeEmailProviders
+    from LandingPage import Landing_Page
+    import FormHandler
+
+    class Bench_Landing_Page(Landing_Page):
+        insightly_factory = Null_Insightly_Client
+
+        # build the whole message, but don't send it
+        @staticmethod
+        def _send_mail(msg, to_list):
+            msg.as_string()
+
+    lp = Bench_Landing_Page()
+    lp._read_form_data('BenchForm1')
+
+    def read_form_data_uncached():
+        lp._form_data_cache.clear()
+        lp._read_form_data('BenchForm1')
+
+    existing_background = Background_Policy().merge(None, dict(_form_fields, comments=u'An earlier submission'))
+
+    body = urllib.urlencode(dict((k, v.encode('utf-8')) for (k, v) in _form_fields.items() if 'ip_address' != k))
+    environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': str(len(body))}
+
+    def parse_request():
+        field_storage = cgi.FieldStorage(fp=StringIO(body), environ=environ, keep_blank_values=False)
+        FormHandler.read_fields(field_storage, '10.1.2.3')
+
+    return [
+        ('is_free hit', lambda: FreeEmailProviders.is_free('gmail.com')),
+        ('is_free hit last', lambda: FreeEmailProviders.is_free('zzom.co.uk')),
+        ('is_free miss', lambda: FreeEmailProviders.is_free('sherwood.example')),
+        ('is_free subdomain', lambda: FreeEmailProviders.is_free('uk.gmail.com')),
+        ('_read_form_data cached', lambda: lp._read_form_data('BenchForm1')),
+        ('_read_form_data parse', read_form_data_uncached),
+        ('note body', lambda: lp._add_note(1, 'BenchForm1', _form_fields)),
+        ('BACKGROUND new contact', lambda: Background_Policy().merge(None, _form_fields)),
+        ('BACKGROUND repeat contact', lambda: Background_Policy().merge(existing_background, _form_fields)),
+        ('notification email', lambda: lp._notify_users(_contact, 'BenchForm1')),
+        ('thank-you email', lambda: lp._send_thank_you_email(_contact, 'robin.hood@sherwood.example')),
+        ('lp.py request parsing', parse_request),
+    ]
+
+
+def time_per_op(function, min_time=0.2, repeat=5):
+    """
+    :return: best seconds per call over repeat runs, each at least min_time long
+    """
+    n = 1
+    while True:
+        start = time.time()
+        for _ in xrange(n):
+            function()
+        elapsed = time.time() - start
+        if min_time <= elapsed:
+            break
+        n *= 2 if 0 == elapsed else max(2, min(10, int(min_time / elapsed * 1.2)))
+    best = elapsed / n
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in xrange(n):
+            function()
+        best = min(best, (time.time() - start) / n)
+    return best
+
+
+def allocations_per_op(function, n=200):
+    """
+    :return: (peak bytes allocated by one call, or None without tracemalloc; tracked objects retained per call)
+    """
+    function()
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            tracemalloc.clear_traces()
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    gc.collect()
+    before = len(gc.get_objects())
+    for _ in xrange(n):
+        function()
+    gc.collect()
+    return peak, max(0, len(gc.get_objects()) - before) / float(n)
+
+
+def previous_results(compare):
+    if compare is not None:
+        filename = compare
+    else:
+        candidates = sorted(glob.glob(os.path.join(results_directory, 'micro-*.json')))
+        if not candidates:
+            return None
+        filename = candidates[-1]
+    with open(filename) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the per-submission CPU work.')
+    parser.add_argument('names', nargs='*', help='run only benchmarks whose names contain one of these')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    parser.add_argument('--compare', help='results file to compare with, instead of the previous run')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args(argv)
+
+    env = Bench_Environment(forms=1).start()
+    try:
+        env.install()
+        selected = [(name, function) for (name, function) in benchmarks()
+                    if not args.names or any(n in name for n in args.names)]
+        previous = previous_results(args.compare)
+        previous = dict() if previous is None else previous['benchmarks']
+
+        results = dict()
+        print '{name:28} {ns:>12} {peak:>10} {retained:>12} {change:>8}'.format(
+            name='benchmark', ns='ns/op', peak='peak B/op', retained='retained/op', change='vs prev')
+        for (name, function) in selected:
+            seconds = time_per_op(function, min_time=args.min_time)
+            (peak, retained) = allocations_per_op(function)
+            results[name] = {'ns_per_op': seconds * 1e9, 'peak_bytes_per_op': peak, 'retained_per_op': retained}
+            change = ''
+            if name in previous:
+                change = '{p:+.1f}%'.format(p=100.0 * (seconds * 1e9 / previous[name]['ns_per_op'] - 1))
+            print '{name:28} {ns:12.0f} {peak:>10} {retained:12.2f} {change:>8}'.format(
+                name=name, ns=seconds * 1e9, peak='-' if peak is None else peak, retained=retained, change=change)
+    finally:
+        env.stop()
+
+    if not args.no_save and results:
+        if not os.path.isdir(results_directory):
+            os.makedirs(results_directory)
+        filename = os.path.join(results_directory, 'micro-{stamp}.json'.format(stamp=time.strftime('%Y%m%d-%H%M%S')))
+        with open(filename, 'w') as f:
+            json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                       'benchmarks': results}, f, indent=2, sort_keys=True)
+        print 'saved', filename
+
+
+if '__main__' == __name__:
+    main()
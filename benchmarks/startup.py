@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+How long lp.py takes to start, and which imports the time goes to.
+
+    python benchmarks/startup.py                 # cold start times and an import-time breakdown
+    python benchmarks/startup.py --budget 0.06   # exit status 1 if a rejected submission takes longer
+
+Every run is a new lp.py process, as under CGI, for two kinds of request: one rejected by validation (which
+should need hardly any imports) and one accepted and processed against the stand-ins. The breakdown lists
+every module imported while handling the request, with the time spent importing it and everything it imports
+(cumulative) and the time spent in the module itself (self), indented under the module which imported it, like
+Python 3's -X importtime.
+"""
+
+import sys
+import time
+
+
+def _child(output):
+    """
+    run lp.py in this process, timing every import it makes, and write the timings to output as JSON
+    """
+    import __builtin__
+    import os
+    original_import = __builtin__.__import__
+    imports = []
+    stack = []
+
+    def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = len(sys.modules)
+        # a slot now so that the list comes out in import order, parents before the modules they import
+        slot = len(imports)
+        imports.append(None)
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if len(sys.modules) != loaded:
+                imports[slot] = (len(stack), name or 'from . import ' + ', '.join(fromlist or ()), elapsed,
+                                 elapsed - children)
+
+    sys.argv = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lp.py')]
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        execfile(sys.argv[0], {'__name__': '__main__', '__file__': sys.argv[0]})
+    except SystemExit:
+        pass
+    total = time.time() - start
+    __builtin__.__import__ = original_import
+    import json
+    with open(output, 'w') as f:
+        json.dump({'total': total, 'imports': [i for i in imports if i is not None]}, f)
+
+
+if ['--child'] == sys.argv[1:2]:
+    # before anything else is imported, so that lp.py finds nothing already loaded that it would not in production
+    _child(sys.argv[2])
+    sys.exit(0)
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import urllib
+
+repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_requests = {
+    'rejected': {'email': 'robin@sherwood.example', 'first_name': 'Robin', 'form_name': 'BenchForm1'},
+    'accepted': {'email': 'robin@sherwood.example', 'first_name': 'Robin', 'last_name': 'Hood',
+                 'form_name': 'BenchForm1'},
+}
+
+
+def request_environ(env, kind, n):
+    fields = dict(_requests[kind], comments='run {n}'.format(n=n))
+    if 'accepted' == kind:
+        fields['email'] = 'robin{n}.{stamp}@sherwood.example'.format(n=n, stamp=int(time.time() * 1000))
+    return dict(env.subprocess_environ(), REQUEST_METHOD='GET', QUERY_STRING=urllib.urlencode(fields),
+                REMOTE_ADDR='10.0.0.{n}'.format(n=n % 250 + 1))
+
+
+def cold_start(env, kind, runs, script=None, fresh=False):
+    """
+    :param script: what to run, default lp.py from the repo
+    :param fresh: run every time from a new copy of the landing page modules without their bytecode, as on the
+                  first request after a deploy
+    :return: sorted wall-clock seconds of runs processes
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for n in range(runs):
+            command = [sys.executable, script or os.path.join(repo_directory, 'lp.py')]
+            environ = request_environ(env, kind, n)
+            copy = None
+            if fresh:
+                copy = tempfile.mkdtemp(dir=env.directory)
+                for name in os.listdir(repo_directory):
+                    if name.endswith('.py'):
+                        shutil.copy(os.path.join(repo_directory, name), copy)
+                command[1] = os.path.join(copy, 'lp.py')
+                environ['PYTHONPATH'] = os.pathsep.join([env.directory, copy])
+            start = time.time()
+            subprocess.check_call(command, cwd=env.directory, env=environ, stdout=devnull)
+            times.append(time.time() - start)
+            if copy is not None:
+                shutil.rmtree(copy)
+    return sorted(times)
+
+
+def interpreter_start(env, runs):
+    times = []
+    for n in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'pass'], cwd=env.directory, env=env.subprocess_environ())
+        times.append(time.time() - start)
+    return sorted(times)
+
+
+def import_breakdown(env, kind):
+    (fd, output) = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--child', output], cwd=env.directory,
+                                  env=request_environ(env, kind, 0), stdout=devnull)
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+def main(argv=None):
+    import argparse
+    from environment import Bench_Environment
+    parser = argparse.ArgumentParser(description='Measure lp.py cold start and its imports.')
+    parser.add_argument('--runs', type=int, default=10, help='processes started per kind of request')
+    parser.add_argument('--budget', type=float, help='seconds a rejected submission may take, median')
+    parser.add_argument('--min', type=float, default=1.0, help='leave out imports faster than this, in ms')
+    parser.add_argument('--bundle', action='store_true',
+                        help='also build lp.pyz and compare it with lp.py, and with lp.py on its first run')
+    args = parser.parse_args(argv)
+
+    env = Bench_Environment(forms=1).start()
+    try:
+        layouts = [('lp.py', dict())]
+        if args.bundle:
+            sys.path.insert(0, repo_directory)
+            import build_bundle
+            bundle = os.path.join(env.directory, 'lp.pyz')
+            build_bundle.build(os.path.join(repo_directory, 'lp.py'), bundle, os.path.join(env.directory, 'forms'),
+                               sys.executable)
+            layouts += [('lp.py, first run', dict(fresh=True)), ('lp.pyz', dict(script=bundle))]
+
+        baseline = interpreter_start(env, args.runs)
+        print '{name:35} median {m:7.1f} ms'.format(name='python -c pass', m=1000 * baseline[len(baseline) // 2])
+        medians = dict()
+        for kind in ('rejected', 'accepted'):
+            for (layout, options) in layouts:
+                times = cold_start(env, kind, args.runs, **options)
+                medians[(layout, kind)] = times[len(times) // 2]
+                print '{name:35} median {m:7.1f} ms   min {low:7.1f} ms   max {high:7.1f} ms'.format(
+                    name='{layout} {kind}'.format(layout=layout, kind=kind), m=1000 * times[len(times) // 2],
+                    low=1000 * times[0], high=1000 * times[-1])
+
+        for kind in ('rejected', 'accepted'):
+            breakdown = import_breakdown(env, kind)
+            imports = breakdown['imports']
+            print
+            print '{kind}: {n} modules imported, {t:.1f} ms in lp.py'.format(kind=kind, n=len(imports),
+                                                                             t=1000 * breakdown['total'])
+            print '{cumulative:>10} {own:>10}  module'.format(cumulative='cumul. ms', own='self ms')
+            for (depth, name, cumulative, own) in imports:
+                if args.min <= 1000 * cumulative:
+                    print '{cumulative:10.2f} {own:10.2f}  {indent}{name}'.format(
+                        cumulative=1000 * cumulative, own=1000 * own, indent='  ' * depth, name=name)
+    finally:
+        env.stop()
+
+    if args.budget is not None and args.budget < medians[('lp.py', 'rejected')]:
+        print
+        print 'Over budget: a rejected submission takes {m:.1f} ms, budget {b:.1f} ms'.format(
+            m=1000 * medians[('lp.py', 'rejected')], b=1000 * args.budget)
+        return 1
+    return 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Build the CGI entry point into a single executable zip file:
+
+    python build_bundle.py [--entry lp.py] [--output lp.pyz] [--forms forms]
+
+The bundle holds bytecode, compiled ahead of time by this interpreter, for the entry point and every module it
+can import which is not part of the standard library: the landing page modules, Requests and its dependencies
+and the Insightly SDK. The form data files in forms/ are compiled into it too. Nothing is compiled when the
+first request comes in, and imports search the bundle and the standard library only, never site-packages, the
+current directory or the vendored Requests checkout. config.py is not bundled: it is read from the directory
+the bundle is in, as before.
+
+Bytecode only runs on the Python version that compiled it, so build with the interpreter that will run the
+bundle; it refuses to run on any other. Rebuild after changing code or form data files.
+"""
+
+import argparse
+import hashlib
+import imp
+import marshal
+import modulefinder
+import os
+import stat
+import struct
+import sys
+import time
+import zipfile
+from distutils import sysconfig
+
+repo_directory = os.path.dirname(os.path.abspath(__file__))
+
+# modules which stay outside the bundle
+_excluded = ('__main__', 'config', 'sitecustomize', 'usercustomize', 'BundledForms')
+
+# run first, from the bundle; sets up the fixed import path and runs the entry point
+_bootstrap = '''
+import imp
+import os
+import sys
+
+bundle = os.path.abspath(sys.path[0])
+if imp.get_magic() != {magic!r}:
+    sys.exit('{{bundle}} was built for Python {version}; rebuild it with this Python'.format(bundle=bundle))
+# the bundle, then the directory it is in (for config.py), then the standard library
+sys.path[:] = [bundle, os.path.dirname(bundle)] + [path for path in sys.path[1:]
+                                                   if path and path.startswith(sys.prefix)
+                                                   and 'site-packages' not in path and 'dist-packages' not in path]
+cacert = {cacert!r}
+if cacert and 'REQUESTS_CA_BUNDLE' not in os.environ:
+    # certificates have to be in a real file for ssl; copy them out of the bundle once
+    from SharedTable import state_path
+    cacert_path = state_path(cacert)
+    if not os.path.exists(cacert_path):
+        import zipimport
+        with open(cacert_path + '.tmp', 'wb') as f:
+            f.write(zipimport.zipimporter(bundle).get_data(cacert))
+        os.rename(cacert_path + '.tmp', cacert_path)
+    os.environ['REQUESTS_CA_BUNDLE'] = cacert_path
+del imp, bundle, cacert
+
+import runpy
+runpy.run_module({entry!r}, run_name='__main__')
+'''
+
+
+def _in_bundle(module, standard_library, site_packages):
+    filename = module.__file__
+    if module.__name__ in _excluded or module.__name__.split('.')[0] in _excluded or filename is None:
+        return False
+    if not filename.endswith('.py'):
+        # extension modules can't be imported from a zip file
+        return False
+    filename = os.path.realpath(filename)
+    return filename.startswith(site_packages) or not filename.startswith(standard_library)
+
+
+def find_modules(entry):
+    """
+    :param entry: the entry point script
+    :return: (list of modulefinder.Module to bundle, names of modules imported but not found)
+    """
+    path = [repo_directory] + sys.path[1:] + [os.path.join(repo_directory, 'requests')]
+    finder = modulefinder.ModuleFinder(path, excludes=list(_excluded))
+    finder.run_script(entry)
+    standard_library = os.path.realpath(sysconfig.get_python_lib(standard_lib=True)) + os.sep
+    site_packages = tuple(os.path.realpath(sysconfig.get_python_lib(plat_specific=p)) + os.sep for p in (0, 1))
+    modules = [m for (name, m) in sorted(finder.modules.items()) if _in_bundle(m, standard_library, site_packages)]
+    # only worth mentioning if the landing page itself asked for it; Requests and others try optional modules
+    ours = set(['__main__'] + [m.__name__ for m in modules
+                               if os.path.dirname(os.path.realpath(m.__file__)) == repo_directory])
+    missing = sorted(name for (name, importers) in finder.badmodules.items()
+                     if name not in _excluded and ours.intersection(importers))
+    return modules, missing
+
+
+def _bytecode(source, archive_name):
+    """
+    :return: contents of a .pyc file for source
+    """
+    code = compile(source + '\n', archive_name, 'exec')
+    # zipimport does not check the timestamp when there is no source next to the bytecode
+    return imp.get_magic() + struct.pack('<I', int(time.time())) + marshal.dumps(code)
+
+
+def _read(filename):
+    with open(filename, 'rU') as f:
+        return f.read()
+
+
+def compile_forms(directory):
+    """
+    :param directory: of form data files
+    :return: source of a module with the url, subject and message of every form, and its latency_budget and
+             deferrable_steps if it sets them
+    """
+    forms = dict()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.txt'):
+            filename = os.path.join(directory, name)
+            namespace = dict()
+            with open(filename, 'r') as f:
+                # the same as Landing_Page._read_form_data, but a mistake stops the build instead of a submission
+                exec compile(f.read(), filename, 'exec') in namespace
+            forms[name[:-4]] = dict((key, namespace[key]) for key in ('url', 'subject', 'message'))
+            for key in ('latency_budget', 'deferrable_steps'):
+                if key in namespace:
+                    forms[name[:-4]][key] = namespace[key]
+    return '# compiled from {directory} by build_bundle.py\nforms = {forms!r}\n'.format(directory=directory,
+                                                                                   forms=forms)
+
+
+def _ca_bundle(modules):
+    for module in modules:
+        if module.__path__:
+            filename = os.path.join(os.path.dirname(module.__file__), 'cacert.pem')
+            if os.path.exists(filename):
+                return filename
+    return None
+
+
+def build(entry, output, forms_directory, python):
+    """
+    :param entry: the entry point script, e.g. lp.py
+    :param output: the bundle to write
+    :param forms_directory: form data files to compile in, or None
+    :param python: interpreter for the #! line
+    :return: (list of bundled module names, names of modules imported but not found)
+    """
+    (modules, missing) = find_modules(entry)
+    entry_name = os.path.splitext(os.path.basename(entry))[0]
+    cacert = _ca_bundle(modules)
+    cacert_name = None
+    if cacert is not None:
+        with open(cacert, 'rb') as f:
+            cacert_name = 'cacert-{digest}.pem'.format(digest=hashlib.sha1(f.read()).hexdigest()[:12])
+
+    temporary = output + '.tmp'
+    with open(temporary, 'wb') as f:
+        # -S: no site-packages to scan; the bundle has everything that is not in the standard library
+        f.write('#!{python} -S\n'.format(python=python))
+    with zipfile.ZipFile(temporary, 'a', zipfile.ZIP_DEFLATED) as bundle:
+        bootstrap = _bootstrap.format(magic=imp.get_magic(), version=sys.version.split()[0], cacert=cacert_name,
+                                      entry=entry_name)
+        bundle.writestr('__main__.pyc', _bytecode(bootstrap, '__main__.py'))
+        bundle.writestr(entry_name + '.pyc', _bytecode(_read(entry), os.path.basename(entry)))
+        for module in modules:
+            archive_name = module.__name__.replace('.', '/') + ('/__init__.py' if module.__path__ else '.py')
+            bundle.writestr(archive_name + 'c', _bytecode(_read(module.__file__), archive_name))
+        if forms_directory is not None:
+            bundle.writestr('BundledForms.pyc', _bytecode(compile_forms(forms_directory), 'BundledForms.py'))
+        if cacert is not None:
+            bundle.write(cacert, cacert_name)
+    os.chmod(temporary, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+    os.rename(temporary, output)
+    return [entry_name] + [m.__name__ for m in modules], missing
+
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description='Build the landing page into one executable zip file.')
+    parser.add_argument('--entry', default=os.path.join(repo_directory, 'lp.py'), help='entry point script')
+    parser.add_argument('--output', help='bundle to write (default: the entry point name with .pyz)')
+    parser.add_argument('--forms', default='forms', help='directory of form data files to compile in')
+    parser.add_argument('--no-forms', action='store_true', help='read form data files from forms/ at run time')
+    parser.add_argument('--python', default=sys.executable, help='interpreter for the #! line')
+    parser.add_argument('-v', '--verbose', action='store_true', help='list the bundled modules')
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(os.path.basename(args.entry))[0] + '.pyz'
+    (bundled, missing) = build(args.entry, output, None if args.no_forms else args.forms, args.python)
+    if args.verbose:
+        for name in bundled:
+            print '    ' + name
+    for name in missing:
+        print 'Warning: {name} is imported but was not found; it will not be available'.format(name=name)
+    print '{output}: {n} modules, {size} KB'.format(output=output, n=len(bundled),
+                                                   size=os.path.getsize(output) // 1024)
@@ -6,3 +6,147 @@ insightly_apikey = 'put-your-insightly-key-here'
 # or
 # recaptcha_secretkey = 'your key'
 recaptcha_secretkey = 'put-your-recaptcha-secret-key-here'
+
+# Form validation limits (optional). Submissions that break them are rejected before any network call.
+# max_field_length = 5000
+# field_length_limits = {'email': 254, 'first_name': 100, 'last_name': 100, 'form_name': 64}
+
+# Directory for state shared between CGI processes (rate limit counters and the like)
+# state_directory = '/var/tmp/landing-page'
+
+# Rate limits (optional): at most this many submissions per IP address and per email address
+# in any rate_limit_window seconds. Set a limit to None to turn it off.
+# rate_limit_window = 3600
+# rate_limit_per_ip = 20
+# rate_limit_per_email = 5
+
+# Honeypot fields (optional): hidden form fields that humans leave empty. A submission with any of them
+# filled in is rejected before reCAPTCHA or Insightly see it.
+# honeypot_fields = ('url_confirm',)
+
+# reCAPTCHA tuning (optional): seconds to wait for Google, and how long used tokens are remembered
+# so that replayed tokens are rejected without asking Google
+# recaptcha_timeout = 5
+# recaptcha_replay_ttl = 300
+# Only load tests change where tokens are verified; see benchmarks/
+# recaptcha_url = 'https://www.google.com/recaptcha/api/siteverify'
+
+# Duplicate submissions (optional): a resubmitted form within idempotency_ttl seconds gets the original
+# redirect without being processed again. Forms may send their own token in the idempotency_field field.
+# idempotency_ttl = 600
+# idempotency_wait = 30
+# idempotency_field = 'idempotency_key'
+
+# Longest Contact Background (optional), in characters. Only the latest value of each form field is kept there;
+# every submission is also recorded in full in a Note.
+# background_max_length = 4000
+
+# JSON batch endpoint lp_batch.py (optional): API keys allowed to use it, sent in the X-Api-Key header.
+# The endpoint is turned off while this is empty.
+# batch_api_keys = ('a-long-random-string',)
+# batch_max_items = 1000
+# batch_concurrency = 4
+
+# Stage timing (optional): how long each step of a submission takes and how many Insightly/SMTP/reCAPTCHA
+# calls it makes. Set stage_timing_log to a file name to get one JSON line per submission, then summarize it with
+#     python Instrumentation.py /path/to/stages.jsonl
+# stage_timing_enabled = True
+# stage_timing_log = None
+
+# Health check for server.py (optional): seconds of history, and the fraction of successful calls
+# below which Insightly, SMTP or reCAPTCHA is reported as down
+# health_window = 300
+# health_min_availability = 0.9
+
+# Trace log (optional): one JSON line per submission with its correlation ID (also sent back in the
+# X-Correlation-Id response header), every Insightly/SMTP/reCAPTCHA call, cache hits and misses, and the outcome.
+# Written in the background; rotated at trace_max_bytes, keeping trace_backups old files.
+# trace_log = '/var/tmp/landing-page-trace.jsonl'
+# trace_max_bytes = 10 * 1024 * 1024
+# trace_backups = 5
+
+# Mail server for the notification and thank-you emails (optional)
+# smtp_host = 'localhost'
+# smtp_port = 25
+
+# Profiling (optional): profile every request, a fraction of them, or those with an X-Profile header signed with
+# profile_secret (make one with: python Profiling.py --sign). profile_mode is 'deterministic' (cProfile) or
+# 'sampling'. Profiles go in profile_directory (default: state_directory/profiles), newest profile_keep kept.
+# Summarize them with: python Profiling.py
+# profile_enabled = False
+# profile_sample_rate = 0.01
+# profile_secret = 'a-long-random-string'
+# profile_mode = 'deterministic'
+# profile_interval = 0.005
+# profile_directory = '/var/tmp/landing-page/profiles'
+# profile_keep = 200
+
+# Insightly API quota (optional): calls allowed per day. Every call is counted (by endpoint, form and stage) in
+# state_directory whether or not this is set; see them with: python InsightlyQuota.py --days 7
+# At quota_warn_at of the quota, or when the current rate will use it all before midnight UTC, a warning goes to
+# the error log; at quota_shed_at (or on that forecast once past quota_warn_at), bulk imports and the batch
+# endpoint are put off while form submissions carry on.
+# insightly_daily_quota = 10000
+# quota_warn_at = 0.8
+# quota_shed_at = 0.95
+# quota_keep_days = 31
+
+# Long-running server (optional): seconds server.py reuses its Insightly connection (the list of users and the
+# account owner) before fetching them again
+# insightly_connection_ttl = 3600
+
+# Worker pool for server.py (optional): start prefork_workers processes (0 runs one multi-threaded process) and
+# grow to prefork_max_workers (default twice as many) when connections queue up, shrinking again after
+# prefork_idle_time seconds idle. Each handles prefork_threads requests at once and is replaced after
+# prefork_max_requests requests or prefork_max_memory MB. server.py's --workers, --max-workers and --threads
+# override these.
+# prefork_workers = 4
+# prefork_max_workers = 16
+# prefork_threads = 4
+# prefork_max_requests = 1000
+# prefork_max_memory = 256
+# prefork_idle_time = 30
+
+# async_server.py (optional): requests handled at once; --max-submissions overrides it
+# async_max_submissions = 1000
+
+# Latency budget (optional): seconds a submission may take before the steps in deferrable_steps which are still to do
+# are put off until after the redirect; None does everything first. Form data files can set their own. Put-off
+# steps wait in job_directory (default: state_directory/jobs); server.py runs them, and worker.py does for lp.py. A
+# failed step is retried after job_retry_delay seconds, doubling each time, job_max_attempts times in all. A job
+# claimed but neither finished nor saved for job_claim_timeout seconds runs again, and the process which claimed it
+# leaves it alone from then on.
+# latency_budget = 2.0
+# deferrable_steps = ('add_note', 'notify_users', 'send_thank_you_email')
+# job_directory = '/var/tmp/landing-page/jobs'
+# job_max_attempts = 8
+# job_retry_delay = 60
+# job_claim_timeout = 600
+# job_poll_interval = 5
+
+# Priority lanes for the job queue (optional): (lane, most of its jobs running at once in a process, share of
+# job_rate), highest priority first. A process runs job_threads jobs at once and starts at most job_rate per second
+# (None for no limit). A job due for job_aging seconds ranks with the lane above its own. Leads queued with
+# import_leads.py --queue for the forms in high_value_forms go in the high_value lane instead of bulk.
+# job_lanes = (
+#     ('live', 4, 0.4),
+#     ('high_value', 2, 0.3),
+#     ('bulk', 2, 0.2),
+#     ('resync', 1, 0.1),
+# )
+# job_threads = 4
+# job_rate = 20
+# job_aging = 60
+# high_value_forms = ('DemoRequest',)
+
+# Adaptive concurrency (optional): the seconds per call to aim for at Insightly and the mail server; {} for no limit.
+# A process starts with adaptive_limit_initial calls in flight to each, adds about one per round of calls that come
+# back in time while the limit holds calls back, and multiplies the limit by adaptive_limit_backoff when a call is
+# slower, staying between adaptive_limit_min and adaptive_limit_max. A call fails after waiting adaptive_limit_wait
+# seconds for a turn.
+# adaptive_limit_targets = {'insightly': 1.0, 'smtp': 1.0}
+# adaptive_limit_initial = 8
+# adaptive_limit_min = 1
+# adaptive_limit_max = 64
+# adaptive_limit_backoff = 0.8
+# adaptive_limit_wait = 30
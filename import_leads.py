@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Import leads from a CSV or JSONL file, running every row through the same organization, contact and note
+pipeline as a landing page form.
+
+    python import_leads.py tradeshow.csv --form-name TradeShow2016 --concurrency 4 --rate 5
+
+CSV files need a header row; JSONL files have one JSON object per line. Column names are form field names
+(email, first_name, last_name, company, ...). Progress goes to stderr. Finished rows are recorded in a
+checkpoint file (FILE.checkpoint by default), so an interrupted import picks up where it left off when it is
+run again. Rows which fail are written to FILE.errors.jsonl.
+
+Rows are read in batches (--batch-size); within a batch, rows from the same company domain or email address
+are processed together, so each organization is looked up once and each contact gets one merged update.
+
+With --queue the groups are put in the background job queue instead (see JobQueue.py), in the bulk lane or the
+lane given with --lane, and imported by worker.py or server.py behind the live submissions. Rows which then fail
+are retried there, and end up in the queue's failed directory rather than FILE.errors.jsonl.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import Queue
+
+import AdaptiveLimit
+import InsightlyQuota
+import Instrumentation
+import JobQueue
+import Trace
+from BatchPlanner import Batch_Planner, group_key
+from FormValidator import field_name, validate, Validation_Error
+from RateLimiter import Token_Bucket
+
+
+def read_rows(filename):
+    """
+    stream the rows of a CSV or JSONL file
+    :param filename: name ending in .jsonl or .json for JSON lines, anything else is CSV
+    :return: generator of (row number, dictionary of unicode field values); row numbers start at 1
+    """
+    with open(filename, 'rb') as f:
+        if filename.endswith('.jsonl') or filename.endswith('.json'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for (number, row) in enumerate(rows, 1):
+            fields = dict()
+            for (key, value) in row.items():
+                if key is None or value is None:
+                    continue
+                if isinstance(value, str):
+                    value = value.decode('utf8')
+                elif not isinstance(value, unicode):
+                    value = unicode(value)
+                value = value.strip()
+                if value:
+                    fields[field_name(key.strip())] = value
+            yield number, fields
+
+
+class Checkpoint:
+    """
+    Which rows of an import are finished. Rows finish out of order, so this keeps the number below which
+    every row is done plus the set of finished rows above it. Saved to disk every few seconds.
+    """
+
+    _save_interval = 2.0
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._done_below = 1
+        self._done = set()
+        self._saved = time.time()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            self._done_below = data['done_below']
+            self._done = set(data['done'])
+
+    def is_done(self, number):
+        with self._lock:
+            return number < self._done_below or number in self._done
+
+    def mark_done(self, number):
+        with self._lock:
+            self._done.add(number)
+            while self._done_below in self._done:
+                self._done.remove(self._done_below)
+                self._done_below += 1
+            if self._save_interval < time.time() - self._saved:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        temp = self._filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'done_below': self._done_below, 'done': sorted(self._done)}, f)
+        os.rename(temp, self._filename)
+        self._saved = time.time()
+
+
+class Batch_Importer:
+    """
+    Run rows through the landing page pipeline on a pool of threads, each with its own Landing_Page.
+    Rows are read batch_size at a time and grouped by Batch_Planner; each thread processes a whole group.
+    """
+
+    def __init__(self, concurrency=4, rate=None, send_mail=False, checkpoint=None, errors=None, form_name=None,
+                 batch_size=500, job_queue=None, lane=None):
+        """
+        :param concurrency: number of worker threads
+        :param rate: most rows started per second, or None
+        :param send_mail: send the notification and thank-you emails
+        :param checkpoint: Checkpoint, or None
+        :param errors: file to write failed rows to (as JSON lines), or None
+        :param form_name: form_name for rows which do not have one
+        :param batch_size: rows read and grouped at a time; 1 processes every row on its own
+        :param job_queue: JobQueue.Job_Queue to put each group in as a job, for worker.py or server.py to import,
+                          instead of importing it here
+        :param lane: lane for those jobs; default JobQueue.lane_for() the group's forms
+        """
+        self._concurrency = concurrency
+        self._bucket = Token_Bucket(rate)
+        self._send_mail = send_mail
+        self._checkpoint = checkpoint
+        self._errors = errors
+        self._form_name = form_name
+        self._batch_size = batch_size
+        self._job_queue = job_queue
+        self._lane = lane
+        self._planner = Batch_Planner()
+        self._lock = threading.Lock()
+        self.counts = {'done': 0, 'failed': 0, 'skipped': 0, 'deferred': 0, 'queued': 0}
+
+    def run(self, rows):
+        """
+        :param rows: iterable of (row number, fields), e.g. from read_rows()
+        :return: counts of done, failed, skipped, deferred and queued rows
+        """
+        queue = Queue.Queue(maxsize=self._concurrency * 2)
+        workers = [threading.Thread(target=self._work, args=(queue,)) for i in range(self._concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        started = time.time()
+        progress = threading.Thread(target=self._report, args=(started, workers))
+        progress.daemon = True
+        progress.start()
+
+        batch = []
+        for (number, fields) in rows:
+            if self._checkpoint is not None and self._checkpoint.is_done(number):
+                with self._lock:
+                    self.counts['skipped'] += 1
+                continue
+            if self._form_name is not None:
+                fields.setdefault('form_name', self._form_name)
+            try:
+                validate(fields)
+            except Validation_Error as ve:
+                # retrying will not help; record it and move on
+                self._failed(number, fields, ve.messages)
+                self._finished(number, 'failed')
+                continue
+            batch.append((number, fields))
+            if self._batch_size <= len(batch):
+                self._enqueue(queue, batch)
+                batch = []
+        self._enqueue(queue, batch)
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        if self._checkpoint is not None:
+            self._checkpoint.save()
+        self._print_progress(started)
+        sys.stderr.write('\n')
+        return self.counts
+
+    def _enqueue(self, queue, batch):
+        for group in self._planner.group(batch):
+            if self._job_queue is None:
+                queue.put(group)
+                continue
+            lane = self._lane or JobQueue.lane_for(fields['form_name'] for (number, fields) in group)
+            # a group is one organization or free email address; its jobs must not overlap, or run out of order
+            self._job_queue.put({'rows': group, 'nomail': not self._send_mail, 'nothankyou': not self._send_mail},
+                                lane, key=group_key(group[0][1]['email']))
+            for (number, fields) in group:
+                self._finished(number, 'queued')
+
+    def _work(self, queue):
+        from LandingPage import Landing_Page
+        lp = None
+        while True:
+            group = queue.get()
+            if group is None:
+                return
+            if not InsightlyQuota.allow('bulk'):
+                # leave it out of the checkpoint so that it is picked up when the import is run again
+                with self._lock:
+                    self.counts['deferred'] += len(group)
+                continue
+            for row in group:
+                self._bucket.take()
+            try:
+                if lp is None:
+                    lp = Landing_Page(nomail=not self._send_mail, nothankyou=not self._send_mail)
+                results = self._planner.run_group(lp, group)
+            except Exception as e:
+                results = dict((number, e) for (number, fields) in group)
+            for (number, fields) in group:
+                if isinstance(results[number], Exception):
+                    # leave it out of the checkpoint so that it is retried next time
+                    self._failed(number, fields, [repr(results[number])])
+                    with self._lock:
+                        self.counts['failed'] += 1
+                else:
+                    self._finished(number, 'done')
+
+    def _finished(self, number, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+        if self._checkpoint is not None:
+            self._checkpoint.mark_done(number)
+
+    def _failed(self, number, fields, messages):
+        if self._errors is None:
+            return
+        with self._lock:
+            self._errors.write(json.dumps({'row': number, 'fields': fields, 'errors': messages}) + '\n')
+            self._errors.flush()
+
+    def _report(self, started, workers):
+        while any(worker.is_alive() for worker in workers):
+            self._print_progress(started)
+            time.sleep(1)
+
+    def _print_progress(self, started):
+        with self._lock:
+            counts = self.counts.copy()
+        elapsed = max(time.time() - started, 0.001)
+        sys.stderr.write('\r{done} done, {failed} failed, {skipped} skipped, {deferred} deferred, {queued} queued, '
+                         '{rate:.1f} rows/s'.format(
+            rate=(counts['done'] + counts['failed'] + counts['queued']) / elapsed, **counts))
+        sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import leads from a CSV or JSONL file into Insightly.')
+    parser.add_argument('filename', help='CSV (with a header row) or JSONL (.jsonl) file')
+    parser.add_argument('--form-name', help='form_name for rows which do not have one')
+    parser.add_argument('--concurrency', type=int, default=4, help='rows in flight at once (default 4)')
+    parser.add_argument('--rate', type=float, default=None, help='most rows started per second (default no limit)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='rows grouped by domain and email at a time (default 500; 1 for no grouping)')
+    parser.add_argument('--mail', action='store_true',
+                        help='send the notification and thank-you emails (default: do not)')
+    parser.add_argument('--checkpoint', help='checkpoint file (default FILENAME.checkpoint)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the top')
+    parser.add_argument('--queue', action='store_true',
+                        help='put the rows in the background queue for worker.py or server.py instead of importing '
+                             'them now')
+    parser.add_argument('--lane', choices=JobQueue.lane_names,
+                        help='queue lane (default bulk, or high_value for the forms in high_value_forms)')
+    args = parser.parse_args(argv)
+
+    Trace.install()
+    InsightlyQuota.install()
+    AdaptiveLimit.install()
+    checkpoint_file = args.checkpoint or args.filename + '.checkpoint'
+    if args.restart and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    with open(args.filename + '.errors.jsonl', 'a') as errors:
+        importer = Batch_Importer(concurrency=args.concurrency, rate=args.rate, send_mail=args.mail,
+                                  checkpoint=Checkpoint(checkpoint_file), errors=errors, form_name=args.form_name,
+                                  batch_size=args.batch_size, job_queue=JobQueue.Job_Queue() if args.queue else None,
+                                  lane=args.lane)
+        counts = importer.run(read_rows(args.filename))
+    if Instrumentation.stage_timing_enabled:
+        sys.stderr.write(Instrumentation.report() + '\n')
+    if counts['deferred']:
+        sys.stderr.write('Insightly API quota is nearly used up; {n} rows were put off. Run again later to import '
+                         'them.\n'.format(n=counts['deferred']))
+    return 1 if counts['failed'] or counts['deferred'] else 0
+
+
+if '__main__' == __name__:
+    sys.exit(main())
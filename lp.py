@@ -7,55 +7,31 @@
 
 # https://hens-teeth.net/cgi-bin/landing-page/lp.py?first_name=Robin&last_name=Hood&email=art@zemon.name&form_name=TestForm1
 
-import cgi
-import cgitb
-cgitb.enable(display=0, logdir='/var/tmp')
-
 import sys
+
+
+def _log_exception(*exc_info):
+    # cgitb pulls in pydoc and inspect, which take longer to import than the rest of the script; only pay for
+    # them when something has actually gone wrong
+    import cgitb
+    cgitb.Hook(display=0, logdir='/var/tmp').handle(exc_info)
+
+
+sys.excepthook = _log_exception
+
+import cgi
 import os
 
-from config import recaptcha_secretkey
-import recaptcha
-from LandingPage import Landing_Page
-
-print 'Content-type: text/html'
-
-form = cgi.FieldStorage()
-form_fields = dict()
-
-for key in form.keys():
-    fieldname = str(key)
-    value = form.getvalue(fieldname).decode('utf8')
-    form_fields[fieldname] = value
-
-form_fields['ip_address'] = cgi.escape(os.environ['REMOTE_ADDR'])
-
-if recaptcha_secretkey is not None:
-    if 'g-recaptcha-response' in form_fields.keys():
-        results = recaptcha.check(form_fields['g-recaptcha-response'], form_fields['ip_address'])
-        # don't pass on the reCAPTCHA data; no one else cares about it
-        del form_fields['g-recaptcha-response']
-    else:
-        results = False
-    if False == results:
-        print '\n'
-        print '<html><head><title>Error</title></head><body>'
-        print '<p>reCATPCHA failure. Only humans allowed.</p>'
-        print '</body></html>'
-        sys.exit(0)
-
-if 1 < len(form_fields):
-    lp = Landing_Page()
-    try:
-        url = lp.do_form(form_fields)
-        print 'Location: ' + url
-        print '\n'
-        print 'Redirecting to: ' + url
-    except KeyError:
-        print '\n'
-        print '<html><head><title>Error</title></head><body>'
-        print '<p>Missing field(s): email, first_name, or last_name</p>'
-        print '<p>Press BACK and try again</p>'
-        print '</body></html>'
-else:
-    print '\nError: This script can only be called from a form'
+import Profiling
+
+with Profiling.profiled('lp', os.environ.get('HTTP_X_PROFILE')) as run:
+    import FormHandler
+    form_fields = FormHandler.read_fields(cgi.FieldStorage(), os.environ['REMOTE_ADDR'])
+    response = FormHandler.handle(form_fields)
+    run.name = dict(response.headers).get('X-Correlation-Id')
+
+print 'Status: ' + response.status
+for (name, value) in response.headers:
+    print name + ': ' + value
+print
+sys.stdout.write(response.body)
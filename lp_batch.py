@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+# Server-to-server lead submission. POST a JSON array of submissions, each an object of form fields:
+#
+#   curl -H 'Content-Type: application/json' -H 'X-Api-Key: your-key' \
+#        --data '[{"email": "robin@example.com", "first_name": "Robin", "last_name": "Hood", "form_name": "TestForm1"}]' \
+#        https://hens-teeth.net/cgi-bin/landing-page/lp_batch.py
+#
+# The response is a JSON document with one status per submission, in the same order.
+
+import sys
+
+
+def _log_exception(*exc_info):
+    # as in lp.py: cgitb is slow to import, so only when something has gone wrong
+    import cgitb
+    cgitb.Hook(display=0, logdir='/var/tmp').handle(exc_info)
+
+
+sys.excepthook = _log_exception
+
+import hmac
+import json
+import os
+
+import AdaptiveLimit
+import config
+from FormValidator import field_name, validate, Validation_Error
+from BatchPlanner import Batch_Planner
+import InsightlyQuota
+import Trace
+
+# keys which may use this endpoint; it is turned off unless at least one is configured
+batch_api_keys = getattr(config, 'batch_api_keys', ())
+batch_max_items = getattr(config, 'batch_max_items', 1000)
+batch_concurrency = getattr(config, 'batch_concurrency', 4)
+
+
+def respond(status, document):
+    print 'Status: ' + status
+    print 'Content-type: application/json'
+    print
+    print json.dumps(document)
+
+
+def authorized(api_key):
+    """
+    :param api_key: the X-Api-Key header, as bytes
+    """
+    for key in batch_api_keys:
+        # compare_digest needs bytes on both sides; keys in config.py may be unicode
+        if hmac.compare_digest(key.encode('utf8') if isinstance(key, unicode) else str(key), api_key):
+            return True
+    return False
+
+
+def submissions_from(items):
+    """
+    validate every item
+    :param items: list decoded from the request
+    :return: (list of (index, form fields) which passed, dictionary of index -> status for those which did not)
+    """
+    valid = []
+    statuses = dict()
+    for (index, item) in enumerate(items):
+        if not isinstance(item, dict):
+            statuses[index] = {'status': 'invalid', 'errors': ['Not an object']}
+            continue
+        form_fields = dict()
+        for (key, value) in item.items():
+            if value is not None:
+                form_fields[field_name(key)] = value if isinstance(value, unicode) else unicode(value)
+        try:
+            validate(form_fields)
+        except Validation_Error as ve:
+            statuses[index] = {'status': 'invalid', 'errors': ve.messages}
+            continue
+        valid.append((index, form_fields))
+    return valid, statuses
+
+
+def main():
+    Trace.install()
+    InsightlyQuota.install()
+    AdaptiveLimit.install()
+    if 'POST' != os.environ.get('REQUEST_METHOD'):
+        respond('405 Method Not Allowed', {'error': 'POST a JSON array of submissions'})
+        return
+    if not authorized(os.environ.get('HTTP_X_API_KEY', '')):
+        respond('403 Forbidden', {'error': 'Missing or unknown X-Api-Key'})
+        return
+
+    try:
+        items = json.loads(sys.stdin.read(int(os.environ.get('CONTENT_LENGTH') or 0)))
+    except ValueError:
+        respond('400 Bad Request', {'error': 'Body is not valid JSON'})
+        return
+    if not isinstance(items, list):
+        respond('400 Bad Request', {'error': 'Body must be a JSON array of submissions'})
+        return
+    if batch_max_items < len(items):
+        respond('413 Request Entity Too Large', {'error': 'At most {n} submissions per request'.format(n=batch_max_items)})
+        return
+
+    if not InsightlyQuota.allow('bulk'):
+        print 'Retry-After: 3600'
+        respond('503 Service Unavailable', {'error': 'Insightly API quota is nearly used up; try again later'})
+        return
+
+    # everything is validated before any Insightly work starts
+    (valid, statuses) = submissions_from(items)
+    if valid:
+        from LandingPage import Landing_Page
+        results = Batch_Planner().run(valid, Landing_Page, concurrency=batch_concurrency)
+        for (index, result) in results.items():
+            if isinstance(result, Exception):
+                statuses[index] = {'status': 'error', 'error': repr(result)}
+            else:
+                statuses[index] = {'status': 'ok', 'url': result}
+
+    document = {'items': [], 'ok': 0, 'invalid': 0, 'error': 0}
+    for index in range(len(items)):
+        status = statuses[index]
+        status['index'] = index
+        document['items'].append(status)
+        document[status['status']] += 1
+    respond('200 OK', document)
+
+
+if '__main__' == __name__:
+    main()
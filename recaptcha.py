@@ -4,31 +4,103 @@
 # Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
 
 import json
-try:
-    import requests
-except:
-    # no system version of Requests so use local copy
-    import os
-    import sys
-    parent_dir = os.path.abspath(os.path.dirname(__file__))
-    vendor_dir = os.path.join(parent_dir, 'requests')
-    sys.path.append(vendor_dir)
-    import requests
+import threading
+import time
 
+import config
 from config import recaptcha_secretkey
+from Instrumentation import current_timer, observe_cache, observe_call, use_timer
+from SharedTable import Shared_Table, state_path
+
+# where tokens are verified; only benchmarks and load tests point this somewhere else
+apiurl = getattr(config, 'recaptcha_url', 'https://www.google.com/recaptcha/api/siteverify')
+
+# seconds to wait for Google before giving up and treating the token as bad
+recaptcha_timeout = getattr(config, 'recaptcha_timeout', 5)
+# Google only accepts a token for two minutes; remember used ones a little longer than that
+recaptcha_replay_ttl = getattr(config, 'recaptcha_replay_ttl', 300)
+
+
+def requests_module():
+    """
+    :return: the Requests module, imported on first use because it is slow to load
+    """
+    try:
+        import requests
+    except ImportError:
+        # no system version of Requests so use local copy
+        import os
+        import sys
+        parent_dir = os.path.abspath(os.path.dirname(__file__))
+        vendor_dir = os.path.join(parent_dir, 'requests')
+        sys.path.append(vendor_dir)
+        import requests
+    return requests
 
-apiurl = 'https://www.google.com/recaptcha/api/siteverify'
 
 def check(recaptcha_response, remoteip):
+    """
+    verify a reCAPTCHA token with Google. A token which has been seen recently is rejected without asking Google.
+    :param recaptcha_response: the g-recaptcha-response form field
+    :param remoteip: the visitor's IP address
+    :return: True if the token is good
+    """
+    if not recaptcha_response or _replayed(recaptcha_response):
+        return False
+
     data = {
         'secret': recaptcha_secretkey,
         'response': recaptcha_response,
         'remoteip': remoteip,
     }
+    requests = requests_module()
+    start = time.time()
+    try:
+        r = requests.post(apiurl, data, timeout=recaptcha_timeout)
+        response = json.loads(r.content)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        observe_call('recaptcha', 'POST', 'siteverify', time.time() - start, e.__class__.__name__)
+        return False
+    observe_call('recaptcha', 'POST', 'siteverify', time.time() - start, str(r.status_code), len(r.content))
+    return True == response.get('success')
+
+
+def _replayed(recaptcha_response):
+    """
+    record a token as used
+    :return: True if it was already used within the last recaptcha_replay_ttl seconds
+    """
+    now = time.time()
+    table = Shared_Table(state_path('recaptcha-tokens.dat'), 'd', 4096)
+    try:
+        with table.locked():
+            used = table.get(recaptcha_response)
+            table.put(recaptcha_response, (now,))
+    finally:
+        table.close()
+    replayed = used is not None and now - used[0] < recaptcha_replay_ttl
+    observe_cache('recaptcha_tokens', replayed)
+    return replayed
+
+
+class Verification(threading.Thread):
+    """
+    run check() in the background so that other work can overlap with the round trip to Google.
+    After join(), success holds the result and duration how long it took, in seconds.
+    """
 
-    print 'data = ', data
+    def __init__(self, recaptcha_response, remoteip):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.success = False
+        self.duration = None
+        self._recaptcha_response = recaptcha_response
+        self._remoteip = remoteip
+        # so that the call to Google is traced with the submission it belongs to
+        self._timer = current_timer()
 
-    r = requests.post(apiurl, data)
-    response = json.loads(r.content)
-    print 'response = ', response
-    return response['success']
\ No newline at end of file
+    def run(self):
+        use_timer(self._timer)
+        start = time.time()
+        self.success = check(self._recaptcha_response, self._remoteip)
+        self.duration = time.time() - start
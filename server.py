@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Run the landing page as a long-running process instead of a CGI script.
+
+    python server.py --port 8080
+    python server.py --port 8080 --workers 4 --max-workers 16
+
+With --workers (or prefork_workers in config.py) it runs a pool of worker processes (see Prefork.py) instead of
+one multi-threaded process, warmed up once before they are forked. /metrics and /health then describe the
+worker which answered, apart from the pool gauges.
+
+Forms post to / (or /lp.py, so existing forms only need the host changed). The same process also serves
+    /metrics  Prometheus text format: submissions, stage latency histograms, upstream call and error counts,
+              cache hit counts, in-flight calls and requests
+    /health   JSON: recent latency and availability of Insightly, SMTP and reCAPTCHA; 503 if any of them is down
+
+Steps which a form's latency budget puts off until after the redirect, and leads queued by import_leads.py, are run
+by background threads in the same process (see JobQueue.py), so server.py does not need worker.py. /metrics
+includes the depth, longest wait and running jobs of each lane of the queue.
+
+`application` is a WSGI application, so this module can also be run under any WSGI server.
+"""
+
+import argparse
+import cgi
+import json
+import sys
+import threading
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+import AdaptiveLimit
+import FormHandler
+import InsightlyQuota
+import JobQueue
+import Metrics
+import Prefork
+import Profiling
+
+Metrics.install()
+
+_in_flight = [0]
+_in_flight_lock = threading.Lock()
+Metrics.gauges['landing_page_requests_in_flight'] = lambda: _in_flight[0]
+Metrics.gauges['landing_page_insightly_calls_today'] = lambda: InsightlyQuota.status()['total']
+Metrics.gauges['landing_page_insightly_calls_projected'] = lambda: InsightlyQuota.status()['projected']
+Metrics.gauges['landing_page_job_queue_depth'] = lambda: dict(
+    ((('lane', lane),), n) for (lane, n) in JobQueue.Job_Queue().depths().items())
+Metrics.gauges['landing_page_job_oldest_wait_seconds'] = lambda: dict(
+    ((('lane', lane),), wait) for (lane, wait) in JobQueue.Job_Queue().waits().items())
+Metrics.gauges['landing_page_jobs_running'] = lambda: dict(
+    ((('lane', lane),), n) for (lane, n) in JobQueue.running().items())
+Metrics.gauges['landing_page_upstream_concurrency_limit'] = lambda: dict(
+    ((('service', service),), n) for (service, n) in AdaptiveLimit.limits().items())
+
+
+def start_jobs():
+    """
+    run the background job queue on threads of this process (once per process; see JobQueue.py)
+    """
+    from LandingPage import Landing_Page
+    JobQueue.start_executor(Landing_Page.run_job)
+
+
+def application(environ, start_response):
+    path = environ.get('PATH_INFO', '/')
+    if '/metrics' == path:
+        start_response('200 OK', [('Content-type', 'text/plain; version=0.0.4')])
+        return [Metrics.prometheus()]
+    if '/health' == path:
+        (healthy, document) = Metrics.health()
+        start_response('200 OK' if healthy else '503 Service Unavailable', [('Content-type', 'application/json')])
+        return [json.dumps(document)]
+    if path not in ('/', '/lp.py'):
+        start_response('404 Not Found', [('Content-type', 'text/plain')])
+        return ['Not found\n']
+
+    # in case this runs under another WSGI server
+    start_jobs()
+    with _in_flight_lock:
+        _in_flight[0] += 1
+    try:
+        with Profiling.profiled('server', environ.get('HTTP_X_PROFILE')) as run:
+            field_storage = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ, keep_blank_values=False)
+            form_fields = FormHandler.read_fields(field_storage, environ.get('REMOTE_ADDR', ''))
+            response = FormHandler.handle(form_fields)
+            run.name = dict(response.headers).get('X-Correlation-Id')
+    finally:
+        with _in_flight_lock:
+            _in_flight[0] -= 1
+    start_response(response.status, response.headers)
+    return [response.body]
+
+
+class Threading_WSGI_Server(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class Prefork_WSGI_Server(WSGIServer):
+    # the pool adds workers when connections queue up, so let the queue get long enough to be seen
+    request_queue_size = 128
+
+
+class Quiet_Request_Handler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def warm():
+    """
+    do once, in the parent of the worker pool, everything a submission needs that can be done ahead of time
+    """
+    import recaptcha
+    from LandingPage import Landing_Page
+    recaptcha.requests_module()
+    try:
+        Landing_Page.warm()
+    except Exception as e:
+        # the workers will connect when they need to
+        sys.stderr.write('Warming up failed: {e!r}\n'.format(e=e))
+    # count the calls made connecting to Insightly here, not again in every worker
+    InsightlyQuota.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve landing page forms, /metrics and /health.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=Prefork.prefork_workers,
+                        help='worker processes to start with (0: one multi-threaded process)')
+    parser.add_argument('--max-workers', type=int, default=Prefork.prefork_max_workers,
+                        help='most worker processes to grow to')
+    parser.add_argument('--threads', type=int, default=Prefork.prefork_threads, help='threads per worker')
+    args = parser.parse_args(argv)
+    if not args.workers:
+        httpd = make_server(args.host, args.port, application, server_class=Threading_WSGI_Server,
+                            handler_class=Quiet_Request_Handler)
+        start_jobs()
+        httpd.serve_forever()
+        return
+
+    httpd = make_server(args.host, args.port, application, server_class=Prefork_WSGI_Server,
+                        handler_class=Quiet_Request_Handler)
+    pool = Prefork.Pool(httpd, workers=args.workers, max_workers=args.max_workers, threads=args.threads,
+                        worker_init=start_jobs)
+    Metrics.gauges['landing_page_workers'] = pool.worker_count
+    Metrics.gauges['landing_page_busy_threads'] = pool.busy_threads
+    Metrics.gauges['landing_page_accept_queue'] = lambda: Prefork.accept_queue(httpd.socket) or 0
+    pool.serve_forever(warm)
+
+
+if '__main__' == __name__:
+    main()
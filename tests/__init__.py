@@ -0,0 +1,35 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Unit tests, run from the top of the repository with
+
+    python -m unittest discover tests
+
+They run against the benchmarks' throwaway installation (benchmarks/environment.py): its config.py, and the
+fake Insightly and mail servers in benchmarks/fakes.py.
+"""
+
+import atexit
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from environment import Bench_Environment
+
+_environment = []
+
+
+def environment():
+    """
+    :return: the Bench_Environment shared by all the tests, started and installed in this process the first time
+    """
+    if not _environment:
+        env = Bench_Environment(forms=1).start()
+        env.install()
+        atexit.register(env.stop)
+        _environment.append(env)
+    return _environment[0]
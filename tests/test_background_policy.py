@@ -0,0 +1,56 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import unittest
+
+from tests import environment
+
+environment()
+
+from BackgroundPolicy import Background_Policy, form_fields_begin, form_fields_end
+
+
+def block(*entries):
+    return u'\n'.join((form_fields_begin,) + entries + (form_fields_end,))
+
+
+class Background_Policy_Test(unittest.TestCase):
+
+    def test_legacy_continuation_lines_go_with_their_entry(self):
+        legacy = u'Can you build...\ncomments: Can you build...\nAnd do it quick??\ncompany: Zemon'
+        self.assertEqual(u'Can you build...\n' + block(u'company: Zemon', u'comments: new'),
+                         Background_Policy().merge(legacy, {'comments': u'new'}))
+
+    def test_legacy_background_is_migrated_once(self):
+        legacy = u'comments: Can you build...\nAnd do it quick??'
+        migrated = Background_Policy().merge(legacy, {'comments': u'Can you build...\nAnd do it quick??'})
+        self.assertEqual(block(u'comments: Can you build...\n And do it quick??'), migrated)
+        again = Background_Policy().merge(migrated, {'comments': u'Can you build...\nAnd do it quick??'})
+        self.assertEqual(migrated, again)
+
+    def test_text_typed_in_is_kept(self):
+        background = u'Note: call back\n' + block(u'comments: x', u'ip_address: y') + u'\nCalled on Monday...'
+        merged = Background_Policy().merge(background, {'ip_address': u'z', 'Note': u'from the form'})
+        self.assertEqual(u'Note: call back\n' + block(u'comments: x', u'Note: from the form', u'ip_address: z') +
+                         u'\nCalled on Monday...', merged)
+
+    def test_unchanged_entries_stay_in_place(self):
+        policy = Background_Policy()
+        first = policy.merge(None, {'form_name': u'A', 'comments': u'hello'})
+        second = policy.merge(first, {'form_name': u'B', 'extra': u'e'})
+        self.assertEqual(second, policy.merge(second, {'form_name': u'B', 'extra': u'e'}))
+        self.assertEqual(block(u'comments: hello', u'extra: e', u'form_name: B'), second)
+
+    def test_oldest_entries_are_dropped_to_fit(self):
+        policy = Background_Policy(max_length=len(block(u'b: 2', u'c: 3')))
+        self.assertEqual(block(u'b: 2', u'c: 3'), policy.merge(block(u'a: 1', u'b: 2'), {'c': u'3'}))
+
+    def test_a_value_too_long_to_fit_is_cut_short(self):
+        policy = Background_Policy(max_length=len(block(u'comments: ')) + 5)
+        self.assertEqual(block(u'comments: 01234'), policy.merge(u'typed in', {'comments': u'0123456789'}))
+
+
+if '__main__' == __name__:
+    unittest.main()
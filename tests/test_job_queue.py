@@ -0,0 +1,85 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tests import environment
+
+environment()
+
+import JobQueue
+from JobQueue import Job_Queue, Lost_Claim
+
+
+def age(path):
+    """
+    make a file look untouched for longer than job_claim_timeout
+    """
+    then = time.time() - JobQueue.job_claim_timeout - 60
+    os.utime(path, (then, then))
+
+
+class Job_Queue_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = Job_Queue(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def claimed_path(self, job_id, job):
+        return self.queue._claimed_path(job_id, job['claim'])
+
+    def place_path(self, job):
+        return os.path.join(self.directory, 'keys', job['key'], job['place'])
+
+    def test_recovered_job_is_left_to_its_new_claim(self):
+        first = self.queue.put({}, key='example.com')
+        second = self.queue.put({}, key='example.com')
+        (job_id, slow) = self.queue.claim()
+        self.assertEqual(first, job_id)
+        age(self.claimed_path(job_id, slow))
+        (job_id, again) = self.queue.claim()
+        self.assertEqual(first, job_id)
+
+        self.assertRaises(Lost_Claim, self.queue.save, job_id, slow)
+        self.assertRaises(Lost_Claim, self.queue.done, job_id, slow)
+        self.assertRaises(Lost_Claim, self.queue.retry, job_id, slow, 'slow')
+        self.assertTrue(os.path.exists(self.claimed_path(job_id, again)))
+        # the later job with the key still waits for it
+        self.assertEqual((None, None), self.queue.claim())
+
+        self.queue.done(job_id, again)
+        self.assertEqual(second, self.queue.claim()[0])
+
+    def test_place_of_a_waiting_job_is_kept(self):
+        first = self.queue.put({}, key='example.com')
+        self.queue.put({}, key='example.com')
+        (job_id, job) = self.queue.claim()
+        self.queue.retry(job_id, job, 'failed')
+        # waiting out its retry delay, for longer than job_claim_timeout
+        age(self.place_path(job))
+        self.assertEqual((None, None), self.queue.claim())
+        self.assertTrue(os.path.exists(self.place_path(job)))
+        self.assertTrue(self.queue.first_in_line(job['key'], first))
+
+    def test_place_of_a_job_which_was_never_written_is_let_go(self):
+        # as left by a process which died in put()
+        job = {'id': 'abandoned', 'lane': 'live', 'key': hashlib.sha1('example.com').hexdigest()[:16]}
+        self.queue._take_place(job, self.queue._pending_name(time.time(), job))
+        second = self.queue.put({}, key='example.com')
+        self.assertEqual((None, None), self.queue.claim())
+        age(self.place_path(job))
+        self.assertEqual(second, self.queue.claim()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+import unittest
+
+from tests import environment
+
+env = environment()
+
+from LandingPage import Landing_Page
+
+
+class Contact_Update_Test(unittest.TestCase):
+
+    def submit(self, **fields):
+        form_fields = {'email': u'robin@sherwood.example', 'first_name': u'Robin', 'last_name': u'Hood',
+                       'form_name': env.form_names[0]}
+        form_fields.update(fields)
+        Landing_Page(nomail=True, nothankyou=True).do_form(form_fields)
+        contacts = [c for c in env.insightly.contacts.values()
+                    if any(u'robin@sherwood.example' == ci['DETAIL'] for ci in c.get('CONTACTINFOS') or [])]
+        self.assertEqual(1, len(contacts))
+        return contacts[0]
+
+    def test_update_keeps_unchanged_collections(self):
+        first = self.submit(phone=u'555-1234', comments=u'first')
+        # a new first name and comment, and nothing new for the contact infos, tags or links
+        second = self.submit(first_name=u'Robert', comments=u'second')
+        self.assertEqual(first['CONTACT_ID'], second['CONTACT_ID'])
+        self.assertEqual(u'Robert', second['FIRST_NAME'])
+        self.assertEqual(first['CONTACTINFOS'], second['CONTACTINFOS'])
+        self.assertEqual(first['TAGS'], second['TAGS'])
+        self.assertEqual(first['LINKS'], second['LINKS'])
+        self.assertIn(u'comments: second', second['BACKGROUND'])
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Author: Art Zemon art@zemon.name https://cheerfulcurmudgeon.com/
+#
+# License: This work is licensed under a
+# Creative Commons Attribution-ShareAlike 4.0 International License http://creativecommons.org/licenses/by-sa/4.0/
+
+"""
+Run the jobs in the queue (see JobQueue.py): the notes, notifications and thank-you emails which lp.py put off
+until after the redirect because a form's latency budget ran out, and leads queued by import_leads.py --queue.
+
+    python worker.py                  # run them as they come due, until stopped
+    python worker.py --once           # run those due now and exit, e.g. every minute from cron
+    python worker.py --status         # jobs waiting in each lane, running and failed
+    python worker.py --retry-failed   # try the failed jobs again
+
+Jobs are taken lane by lane, live first, within each lane's limits (job_lanes). server.py and async_server.py run
+their own; this is for CGI. Any number of these can run at once.
+"""
+
+import argparse
+import signal
+import threading
+
+import AdaptiveLimit
+import InsightlyQuota
+import JobQueue
+import Trace
+from LandingPage import Landing_Page
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the jobs in the background queue, highest lane first.')
+    parser.add_argument('--once', action='store_true', help='run the jobs which are due now, then exit')
+    parser.add_argument('--status', action='store_true',
+                        help='show how many jobs are waiting in each lane, running and failed')
+    parser.add_argument('--retry-failed', action='store_true', help='put the failed jobs back in the queue')
+    args = parser.parse_args(argv)
+
+    queue = JobQueue.Job_Queue()
+    if args.status:
+        (depths, waits) = (queue.depths(), queue.waits())
+        for lane in JobQueue.lane_names:
+            print '{lane:12} {n:6} waiting, longest {wait:.0f} s'.format(lane=lane, n=depths[lane], wait=waits[lane])
+        print '{running} running, {failed} failed'.format(**queue.counts())
+        return
+    if args.retry_failed:
+        print '{n} failed jobs put back in the queue'.format(n=queue.requeue_failed())
+        return
+
+    Trace.install()
+    InsightlyQuota.install()
+    AdaptiveLimit.install()
+    stopping = threading.Event()
+    # finish the job in hand before stopping
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    JobQueue.Executor(Landing_Page.run_job, queue).run(stopping, once=args.once)
+
+
+if '__main__' == __name__:
+    main()